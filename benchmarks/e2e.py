@@ -0,0 +1,604 @@
+"""
+End-to-end benchmarks against simulated boards.
+
+Measures discovery time against the number of DKMs and macro length,
+``configure_boards`` throughput for a full board, and key press to
+``BoardSyncPacket`` written latency through ``dumang-sync``, also with a
+stream of configuration packets queued on the other half, and how long
+``dumang-sync`` takes to sync a replugged half again, or both halves after
+a resume from suspend, how many re-initializations and how much CPU a
+storm of hotplug events costs it, and per-pair sync latency as more pairs
+are synced by one ``dumang-sync``. Results can
+be saved as a JSON baseline and later runs compared against it:
+
+    $ python -m benchmarks.e2e run --output baseline.json
+    $ python -m benchmarks.e2e compare baseline.json
+
+``compare`` exits with status 1 if any result regressed by more than
+``--threshold``.
+"""
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+
+import click
+import yaml
+
+from dumang_ctrl.dumang import common
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.simulator import (SIMULATOR_PATH_PREFIX,
+                                          FakeUSBContext, FakeUSBDevice,
+                                          SimulatedBoard, SimulatorBackend,
+                                          default_dkms, hotplug_storm)
+from dumang_ctrl.dumang.stats import STAGE_TOTAL, PipelineStats
+from dumang_ctrl.tools import config, sync
+
+DISCOVERY_KEYS = (11, 22, MAX_KEYS)
+DISCOVERY_MACRO_LENS = (0, 8, 32)
+DISCOVERY_DEFAULT_KEYS = MAX_KEYS // 2
+DISCOVERY_DEFAULT_MACRO_LEN = 4
+SYNC_EVENTS = 500
+SYNC_INTERVAL_S = 0.001
+# NOTE: Configuration packets queued on the other half with every key
+# event in the sync benchmark under load.
+SYNC_BULK_PER_EVENT = 20
+STORM_FLAPS = 50
+# NOTE: Well within HOTPLUG_SETTLE_S, like the bounces of a bad contact.
+STORM_INTERVAL_S = 0.002
+PAIR_COUNTS = (1, 2, 4, 8)
+PAIR_EVENTS = 200
+PAIR_INTERVAL_S = 0.005
+
+LOWER = "lower"
+HIGHER = "higher"
+# NOTE: Counts are compared by how much they changed rather than by how
+# much relative to the baseline, which is often 0 or next to it, eg.
+# allocs/op of interned values. Up to COUNT_TOLERANCE either way is noise.
+COUNT_UNITS = ("count", "allocs")
+COUNT_TOLERANCE = 0.5
+
+
+def start_board(sim):
+    kbd = DuMangBoard(sim.serial, sim)
+    threads = [
+        Job(target=kbd.send_thread, daemon=True),
+        Job(target=kbd.receive_thread, daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    return kbd, threads
+
+
+def stop_boards(kbds, threads):
+    # NOTE: Stop first, so no Job goes back to waiting after its JobKiller.
+    for t in threads:
+        t.stop()
+    for kbd in kbds:
+        kbd.kill_threads()
+    for t in threads:
+        t.join()
+    for kbd in kbds:
+        kbd.close()
+
+
+def bench_discovery(keys, macro_len, latency_ms):
+    sim = SimulatedBoard(
+        dkms=default_dkms(keys, macro_len), latency_ms=latency_ms)
+    kbd, threads = start_board(sim)
+    start = time.perf_counter()
+    found = kbd.configured_keys
+    elapsed = time.perf_counter() - start
+    stop_boards([kbd], threads)
+    assert len(found) == keys
+    return elapsed * 1000
+
+
+def full_board_yaml():
+    """A config touching every layer, macro and color of a full board."""
+    cfg = []
+    for n in range(2):
+        keys = []
+        for key, dkm in default_dkms(
+                MAX_KEYS // 2, serial_base=0x10000000 + n * 0x100).items():
+            keys.append({
+                config.LABEL_KEY: {
+                    config.LABEL_SERIAL: f"{dkm.serial:08X}",
+                    "layer_0": "MACRO",
+                    "layer_1": "Z",
+                    "layer_2": "Y",
+                    "layer_3": "X",
+                    config.LABEL_MACRO: [{
+                        config.LABEL_TYPE: "KEYDOWN",
+                        config.LABEL_KEY: "Q",
+                        config.LABEL_DELAY_MS: 100 + i,
+                    } for i in range(8)],
+                    config.LABEL_COLOR: "0f0000",
+                }
+            })
+        cfg.append({
+            config.LABEL_BOARD: {
+                config.LABEL_SERIAL: f"SIM{n}",
+                config.LABEL_NKRO: True,
+                config.LABEL_REPORT_RATE: 500,
+                config.LABEL_KEYS: keys,
+            }
+        })
+    return yaml.dump(cfg, sort_keys=False)
+
+
+def bench_configure(cfg_yaml, latency_ms, verify=False):
+    sims = [
+        SimulatedBoard(
+            serial=f"SIM{n}",
+            dkms=default_dkms(
+                MAX_KEYS // 2, serial_base=0x10000000 + n * 0x100),
+            latency_ms=latency_ms) for n in range(2)
+    ]
+    started = [start_board(sim) for sim in sims]
+    kbds = [kbd for kbd, _ in started]
+    threads = [t for _, ts in started for t in ts]
+    for kbd in kbds:
+        kbd.configured_keys
+
+    start = time.perf_counter()
+    plan = config.plan_config(yaml.safe_load(cfg_yaml), kbds)
+    if verify:
+        assert not any(plan.apply_verified().values())
+    else:
+        plan.apply()
+    for kbd in kbds:
+        kbd.drain()
+    elapsed = time.perf_counter() - start
+
+    # NOTE: Only configuration writes count, not the readbacks verifying them.
+    stop_boards(kbds, threads)
+    return plan.packets / elapsed
+
+
+def bench_sync(fast_path, latency_ms, bulk=0):
+    sim1 = SimulatedBoard(serial="SIM0", latency_ms=latency_ms)
+    sim2 = SimulatedBoard(serial="SIM1", latency_ms=latency_ms)
+    kbd1 = DuMangBoard(sim1.serial, sim1)
+    kbd2 = DuMangBoard(sim2.serial, sim2)
+    if fast_path:
+        sync.init_fast_path(kbd1, kbd2)
+    threads = []
+    threads.extend(sync.init_send_threads(kbd1, kbd2))
+    threads.extend(sync.init_receive_threads(kbd1, kbd2))
+    threads.extend(sync.init_synchronization_threads(kbd1, kbd2))
+    sync.pipeline_stats = PipelineStats()
+    for t in threads:
+        t.start()
+
+    bulk_packet = MacroConfigurePacket(0x00, 0, MacroType(MacroType.KEYDOWN),
+                                       Keycode(Keycode.A), 100)
+    for n in range(SYNC_EVENTS):
+        for _ in range(bulk):
+            kbd2.put(bulk_packet)
+        if n % 2:
+            sim1.key_up(0x25, 0x01)
+        else:
+            sim1.key_down(0x25, 0x01)
+        time.sleep(SYNC_INTERVAL_S)
+    # NOTE: Layer changes superseded while queued are coalesced, not sent.
+    coalesced = kbd2.send_q.stats[SEND_REALTIME]
+    deadline = time.monotonic() + 5
+    while (len(sim2.synced) + coalesced.coalesced < SYNC_EVENTS and
+           time.monotonic() < deadline):
+        time.sleep(0.01)
+
+    stop_boards([kbd1, kbd2], threads)
+    arrived = len(sim2.synced) + coalesced.coalesced
+    if arrived < SYNC_EVENTS:
+        raise click.ClickException(
+            f"Only {arrived}/{SYNC_EVENTS} layer changes arrived")
+    total = sync.pipeline_stats.histograms[sim1.serial][STAGE_TOTAL]
+    return total.percentile(50) / 1000, total.percentile(99) / 1000
+
+
+class ReplugDevice:
+    """Stands in for the monitor's DetectedDevice of a simulated board."""
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.bus = None
+        self.address = None
+        self.arrived_ns = time.monotonic_ns()
+
+
+def bench_reconnect(latency_ms, cached_info=True):
+    sims = [
+        SimulatedBoard(serial=f"SIM{n}", latency_ms=latency_ms)
+        for n in range(2)
+    ]
+    backend = SimulatorBackend(sims)
+    common.device_backend = backend
+    session = sync.SyncSession()
+    devices = [ReplugDevice(sim.serial) for sim in sims]
+    for device in devices:
+        session.arrived(device)
+
+    session.left(devices[1])
+    if not cached_info:
+        session.info.clear()
+    backend.boards[1] = SimulatedBoard(serial="SIM1", latency_ms=latency_ms)
+    replugged = ReplugDevice("SIM1")
+    session.arrived(replugged)
+    elapsed_ns = time.monotonic_ns() - replugged.arrived_ns
+
+    assert len(session.kbds) == 2 and session.sync_threads
+    session.close()
+    common.device_backend = None
+    return elapsed_ns / 1e6
+
+
+class ResumeWakeup:
+    """Stands in for the ClockSetWatcher of a SyncSession, resumed() is a resume."""
+
+    def __init__(self):
+        self._callback = None
+
+    def start(self, callback):
+        self._callback = callback
+
+    def stop(self):
+        self._callback = None
+
+    def resumed(self):
+        if self._callback:
+            self._callback()
+
+
+def bench_resume(latency_ms, silent=False):
+    """
+    How long until sync works again after a resume. The board's old
+    handle either fails, or with ``silent`` just never answers again, so
+    only the resume wakes the watchdog up.
+    """
+    sims = [
+        SimulatedBoard(serial=f"SIM{n}", latency_ms=latency_ms)
+        for n in range(2)
+    ]
+    backend = SimulatorBackend(sims)
+    common.device_backend = backend
+    # NOTE: Stands in for CLOCK_BOOTTIME, which jumps ahead on resume.
+    slept = [0.0]
+    wakeup = ResumeWakeup()
+    session = sync.SyncSession(resume=ResumeDetector(lambda: slept[0]),
+                               resume_wakeup=wakeup)
+    for sim in sims:
+        session.arrived(ReplugDevice(sim.serial))
+    session.start()
+
+    # NOTE: Across a suspend the board re-enumerates, so the open handle
+    # is dead and the board answers on a new one.
+    if silent:
+        sims[1].freeze()
+    else:
+        sims[1].unplug()
+    resumed = SimulatedBoard(serial="SIM1", latency_ms=latency_ms)
+    backend.boards[1] = resumed
+    start = time.perf_counter()
+    slept[0] += 60
+    wakeup.resumed()
+    deadline = time.monotonic() + 5
+    while not resumed.synced and time.monotonic() < deadline:
+        sims[0].key_down(0x25, 0x01)
+        time.sleep(SYNC_INTERVAL_S)
+    elapsed = time.perf_counter() - start
+
+    session.close()
+    common.device_backend = None
+    if not resumed.synced:
+        raise click.ClickException("Sync did not resume")
+    return elapsed * 1000
+
+
+class StormBackend(SimulatorBackend):
+    """Opens a freshly plugged in simulated board every time, like a re-enumerated one."""
+
+    def __init__(self, serials, latency_ms):
+        self.latency_ms = latency_ms
+        self.opened = []
+        super().__init__(
+            [SimulatedBoard(serial=serial, latency_ms=latency_ms)
+             for serial in serials])
+        self.opened.extend(self.boards)
+
+    def open(self, path):
+        n = int(path[len(SIMULATOR_PATH_PREFIX):])
+        board = SimulatedBoard(serial=self.boards[n].serial,
+                               latency_ms=self.latency_ms)
+        self.boards[n] = board
+        self.opened.append(board)
+        return board
+
+    def unplug_all(self):
+        for board in self.opened:
+            board.unplug()
+
+
+def bench_hotplug_storm(latency_ms, settle_s=HOTPLUG_SETTLE_S):
+    serials = ["SIM0", "SIM1"]
+    backend = StormBackend(serials, latency_ms)
+    common.device_backend = backend
+    context = FakeUSBContext()
+    monitor = USBConnectionMonitorRunner(
+        VENDOR_ID, PRODUCT_ID, context=context, settle_s=settle_s)
+    session = sync.SyncSession()
+    handled = [0]
+
+    def consume():
+        while True:
+            status, device = monitor.get_event()
+            if status == NOTIFY_STATUS_READY:
+                session.arrived(device)
+            elif status == NOTIFY_STATUS_WAIT:
+                session.left(device)
+            else:
+                return
+            handled[0] += 1
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    monitor.start()
+    devices = [
+        FakeUSBDevice(serial, address=n + 1)
+        for n, serial in enumerate(serials)
+    ]
+    context.replay((d, usb1.HOTPLUG_EVENT_DEVICE_ARRIVED) for d in devices)
+    deadline = time.monotonic() + 5
+    while len(session.kbds) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    before = dict(monitor.stats)
+    settled = handled[0]
+
+    events, devices = hotplug_storm(devices, STORM_FLAPS, seed=0)
+    start = time.process_time()
+    context.replay(events, STORM_INTERVAL_S)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        notified = monitor.stats["ready"] + monitor.stats["wait"]
+        if not monitor.settling and handled[0] == notified:
+            break
+        time.sleep(0.01)
+    cpu = time.process_time() - start
+    reinits = handled[0] - settled
+    synced = len(session.kbds) == 2 and bool(session.sync_threads)
+
+    monitor.stop()
+    monitor.join()
+    consumer.join()
+    session.close()
+    backend.unplug_all()
+    common.device_backend = None
+    if not synced:
+        raise click.ClickException(
+            f"Not synced after the storm, stats before {before}, "
+            f"after {dict(monitor.stats)}")
+    return reinits, cpu * 1000
+
+
+def bench_pairs(pair_count, latency_ms):
+    sims = [
+        SimulatedBoard(serial=f"SIM{n}", latency_ms=latency_ms)
+        for n in range(2 * pair_count)
+    ]
+    common.device_backend = SimulatorBackend(sims)
+    pairs = [
+        sync.PairConfig(f"pair{n}", [sims[2 * n].serial,
+                                     sims[2 * n + 1].serial])
+        for n in range(pair_count)
+    ]
+    sync.pipeline_stats = PipelineStats()
+    paired = sync.PairedSync(pairs)
+    for sim in sims:
+        paired.arrived(ReplugDevice(sim.serial))
+    deadline = time.monotonic() + 5
+    while (len(paired.sessions) < pair_count or not all(
+            s.sync_threads for s in paired.sessions.values())):
+        if time.monotonic() > deadline:
+            raise click.ClickException("Pairs did not all start syncing")
+        time.sleep(0.01)
+    # NOTE: Each pair reads its DKMs once syncing, not part of the steady state.
+    discover_boards(list(paired.kbds.values()))
+
+    # NOTE: Every pair gets the same stream of layer changes, so each one's
+    # load stays the same as pairs are added.
+    # NOTE: Spread over the interval, like separate people typing.
+    stagger_s = PAIR_INTERVAL_S / pair_count
+    for n in range(PAIR_EVENTS):
+        for sim in sims[::2]:
+            if n % 2:
+                sim.key_up(0x25, 0x01)
+            else:
+                sim.key_down(0x25, 0x01)
+            time.sleep(stagger_s)
+    deadline = time.monotonic() + 5
+    while (any(not sim.synced for sim in sims[1::2]) and
+           time.monotonic() < deadline):
+        time.sleep(0.01)
+    time.sleep(0.05)
+
+    paired.close()
+    common.device_backend = None
+    histograms = [
+        sync.pipeline_stats.histograms[sim.serial][STAGE_TOTAL]
+        for sim in sims[::2]
+    ]
+    if any(h.count == 0 for h in histograms):
+        raise click.ClickException("A pair synced no layer changes")
+    # NOTE: The typical pair's median and the worst pair's tail.
+    return (statistics.median(h.percentile(50) for h in histograms) / 1000,
+            max(h.percentile(99) for h in histograms) / 1000)
+
+
+def result(samples, unit, better):
+    return {
+        "value": round(statistics.median(samples), 3),
+        "unit": unit,
+        "better": better,
+        "samples": [round(s, 3) for s in samples],
+    }
+
+
+def run_suite(repeat, latency_ms):
+    results = {}
+
+    def record(name, unit, better, fn):
+        click.echo(f"{name} ...", err=True)
+        results[name] = result([fn() for _ in range(repeat)], unit, better)
+
+    for keys in DISCOVERY_KEYS:
+        record(f"discovery/keys={keys}/macro={DISCOVERY_DEFAULT_MACRO_LEN}",
+               "ms", LOWER, lambda: bench_discovery(
+                   keys, DISCOVERY_DEFAULT_MACRO_LEN, latency_ms))
+    for macro_len in DISCOVERY_MACRO_LENS:
+        record(f"discovery/keys={DISCOVERY_DEFAULT_KEYS}/macro={macro_len}",
+               "ms", LOWER, lambda: bench_discovery(
+                   DISCOVERY_DEFAULT_KEYS, macro_len, latency_ms))
+
+    cfg_yaml = full_board_yaml()
+    record("configure/full-board", "packets/s", HIGHER,
+           lambda: bench_configure(cfg_yaml, latency_ms))
+    record("configure/full-board-verified", "packets/s", HIGHER,
+           lambda: bench_configure(cfg_yaml, latency_ms, verify=True))
+
+    record("reconnect/cached-info", "ms", LOWER,
+           lambda: bench_reconnect(latency_ms))
+    record("reconnect/uncached-info", "ms", LOWER,
+           lambda: bench_reconnect(latency_ms, cached_info=False))
+    record("resume/restore", "ms", LOWER, lambda: bench_resume(latency_ms))
+    record("resume/restore-silent", "ms", LOWER,
+           lambda: bench_resume(latency_ms, silent=True))
+
+    for mode, settle_s in (("debounced", HOTPLUG_SETTLE_S),
+                           ("undebounced", 0)):
+        samples = [
+            bench_hotplug_storm(latency_ms, settle_s) for _ in range(repeat)
+        ]
+        click.echo(f"hotplug-storm/{mode} ...", err=True)
+        results[f"hotplug-storm/{mode}/reinitializations"] = result(
+            [s[0] for s in samples], "count", LOWER)
+        results[f"hotplug-storm/{mode}/cpu"] = result(
+            [s[1] for s in samples], "ms", LOWER)
+
+    for mode, fast_path, bulk in (("queued", False, 0),
+                                  ("fast-path", True, 0),
+                                  ("queued+bulk", False, SYNC_BULK_PER_EVENT)):
+        samples = [
+            bench_sync(fast_path, latency_ms, bulk) for _ in range(repeat)
+        ]
+        click.echo(f"sync/{mode} ...", err=True)
+        results[f"sync/{mode}/p50"] = result([s[0] for s in samples], "us",
+                                             LOWER)
+        results[f"sync/{mode}/p99"] = result([s[1] for s in samples], "us",
+                                             LOWER)
+
+    for pair_count in PAIR_COUNTS:
+        samples = [
+            bench_pairs(pair_count, latency_ms) for _ in range(repeat)
+        ]
+        click.echo(f"pairs/n={pair_count} ...", err=True)
+        results[f"pairs/n={pair_count}/p50"] = result(
+            [s[0] for s in samples], "us", LOWER)
+        results[f"pairs/n={pair_count}/p99"] = result(
+            [s[1] for s in samples], "us", LOWER)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "repeat": repeat,
+            "latency_ms": latency_ms,
+        },
+        "results": results,
+    }
+
+
+def print_results(suite):
+    for name, r in suite["results"].items():
+        click.echo(f"{name:<44} {r['value']:12.3f} {r['unit']}")
+
+
+def compare_results(baseline, current, threshold):
+    """
+    Prints every shared result and returns the names that regressed, by
+    more than ``threshold`` relative to the baseline or, for counts, by
+    more than COUNT_TOLERANCE.
+    """
+    regressions = []
+    for name, new in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            click.echo(f"{name:<44} {new['value']:12.3f} {new['unit']} (new)")
+            continue
+        if new["unit"] in COUNT_UNITS:
+            change = new["value"] - old["value"]
+            limit = COUNT_TOLERANCE
+            shown = f"{change:+7.2f}"
+        elif old["value"] == 0:
+            # NOTE: No relative change from nothing, see COUNT_UNITS.
+            change = limit = 0
+            shown = f"{'n/a':>7}"
+        else:
+            change = (new["value"] - old["value"]) / old["value"]
+            limit = threshold
+            shown = f"{change:+7.1%}"
+        worse = change > limit if new["better"] == LOWER else change < -limit
+        flag = "REGRESSION" if worse else ""
+        click.echo(f"{name:<44} {old['value']:12.3f} -> {new['value']:12.3f} "
+                   f"{new['unit']:<10} {shown} {flag}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+@click.group(help="End-to-end benchmarks against simulated boards")
+def cli():
+    pass
+
+
+@cli.command(help="Run the suite")
+@click.option("--output", help="Write results to this JSON file")
+@click.option("--repeat", default=5, help="Runs per measurement")
+@click.option(
+    "--latency-ms",
+    default=1.0,
+    help="Simulated board response latency",
+    show_default=True)
+def run(output, repeat, latency_ms):
+    suite = run_suite(repeat, latency_ms)
+    print_results(suite)
+    if output:
+        with open(output, "w") as f:
+            json.dump(suite, f, indent=2)
+
+
+@cli.command(help="Compare against a baseline, running the suite if needed")
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File(), required=False)
+@click.option(
+    "--threshold",
+    default=0.1,
+    help="Relative change counted as a regression",
+    show_default=True)
+@click.option("--repeat", default=5, help="Runs per measurement")
+def compare(baseline, current, threshold, repeat):
+    baseline = json.load(baseline)
+    if current:
+        current = json.load(current)
+    else:
+        current = run_suite(repeat, baseline["meta"]["latency_ms"])
+    regressions = compare_results(baseline, current, threshold)
+    if regressions:
+        click.echo(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
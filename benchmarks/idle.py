@@ -0,0 +1,109 @@
+"""
+Idle cost and shutdown latency of a board's receive thread.
+
+An idle board is emulated with one end of a socketpair that never sends
+anything. The receive thread is run against it for a while, counting how
+often it wakes up and how much CPU it burns, then stopped with
+``kill_threads()`` to measure how long shutdown takes. This is done once
+polling with ``READ_TIMEOUT_MS`` (as with ``hid.device``) and once with a
+``HIDRawDevice`` blocking read.
+
+    $ python -m benchmarks.idle
+"""
+import random
+import select
+import socket
+import time
+
+import click
+
+from dumang_ctrl.dumang.common import *
+
+BOARD_INFO_RESPONSE = bytes([BOARD_INFO_RESPONSE_CMD, 0, 0, 1, 2, 1, 0, 4])
+
+
+class PollingDevice:
+    """Mimics ``hid.device`` reads, which can only be interrupted by a timeout."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        return os.write(self.fd, bytes(data))
+
+    def read(self, max_length, timeout_ms=None):
+        timeout = None if timeout_ms is None else timeout_ms / 1000
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        return os.read(self.fd, max_length) if r else []
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CountingDevice:
+
+    def __init__(self, device):
+        self.device = device
+        self.wakeups = 0
+        if hasattr(device, "cancel"):
+            self.cancel = device.cancel
+
+    def write(self, data):
+        return self.device.write(data)
+
+    def read(self, *args, **kwargs):
+        self.wakeups += 1
+        return self.device.read(*args, **kwargs)
+
+    def close(self):
+        self.device.close()
+
+
+def measure(make_device, idle_s):
+    ours, peer = socket.socketpair()
+    peer.send(BOARD_INFO_RESPONSE)
+    device = CountingDevice(make_device(os.dup(ours.fileno())))
+    board = DuMangBoard("IDLE", device)
+    # NOTE: HIDRawDevice is wrapped, so tell the board it may block.
+    board.blocking_reads = hasattr(device, "cancel")
+    thread = Job(target=board.receive_thread, daemon=True)
+
+    thread.start()
+    time.sleep(0.1)
+    wakeups = device.wakeups
+    cpu = time.process_time()
+    time.sleep(idle_s)
+    cpu = time.process_time() - cpu
+    # NOTE: Don't let the shutdown line up with the polling period.
+    time.sleep(random.uniform(0, DuMangBoard.READ_TIMEOUT_MS / 1000))
+    wakeups = device.wakeups - wakeups
+
+    start = time.monotonic()
+    board.kill_threads()
+    thread.join()
+    shutdown = time.monotonic() - start
+
+    device.close()
+    ours.close()
+    peer.close()
+    return wakeups / idle_s, cpu / idle_s, shutdown
+
+
+@click.command(help="Measure idle wakeups and shutdown latency of the receive thread")
+@click.option("--idle", default=5.0, help="Seconds to stay idle")
+@click.option("--runs", default=5, help="Shutdowns to measure")
+def cli(idle, runs):
+    for name, make_device in (("polling", PollingDevice), ("blocking",
+                                                           HIDRawDevice)):
+        results = [measure(make_device, idle / runs) for _ in range(runs)]
+        wakeups = sum(r[0] for r in results) / runs
+        cpu = sum(r[1] for r in results) / runs
+        shutdown = [r[2] * 1000 for r in results]
+        click.echo(
+            f"{name:<9} {wakeups:6.1f} wakeups/s  {cpu * 100:5.2f}% CPU  "
+            f"shutdown avg {sum(shutdown) / runs:5.1f} ms max {max(shutdown):5.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    cli()
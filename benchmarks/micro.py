@@ -0,0 +1,153 @@
+"""
+Microbenchmarks for the per-packet primitives in ``common.py``.
+
+Every case reports the time per operation (best of ``--repeat`` timeit
+runs) and what tracemalloc sees one operation leave behind: the number
+of memory blocks still allocated and their size, with results kept
+alive. Cached or interned values show up as zero.
+
+    $ python -m benchmarks.micro
+    $ python -m benchmarks.micro --filter parse --output micro.json
+    $ python -m benchmarks.micro --compare micro.json
+"""
+import json
+import sys
+import timeit
+import tracemalloc
+
+import click
+
+from dumang_ctrl.dumang.common import *
+
+from .e2e import LOWER, compare_results, result
+
+REPORT_SIZE = 64
+ALLOC_NUMBER = 1000
+
+
+def report(*fields):
+    # NOTE: hid.device.read() hands back a list of ints padded to 64 bytes.
+    return list(fields) + [0x00] * (REPORT_SIZE - len(fields))
+
+
+SAMPLES = {
+    "KeyDownPacket": report(KEY_UP_CMD, 0x10, 0x01, 0xD5),
+    "KeyUpPacket": report(KEY_DOWN_CMD, 0x10, 0x01, 0xD5),
+    "BoardInfoResponsePacket": report(BOARD_INFO_RESPONSE_CMD, 0x00, 0x00,
+                                      0x01, 0x02, 0x01, 0x00, 0x04),
+    "DKMInfoResponsePacket": report(DKM_INFO_RESPONSE_CMD, 0x00, 0x00, 0x01,
+                                    0x03),
+    "DKMColorResponsePacket": report(DKM_COLOR_RESPONSE_CMD, 0x00, 0x00, 0x0F,
+                                     0x00, 0x0F),
+    "LightPulsePacket": report(LIGHT_PULSE_CMD, 0x10, 0x03),
+    "DKMReportResponsePacket": report(DKM_REPORT_RESPONSE_CMD, 0x10, 0x28,
+                                      0x28, 0x76, 0x02, 0x00, 0x31, 0x03,
+                                      0xFF, 0xD5),
+    "DKMAddedPacket": report(DKM_ADDED_CMD, 0x10, 0x28, 0x28, 0x76, 0x02,
+                             0x00, 0x31, 0x03, 0xFF, 0xD5),
+    "DKMRemovedPacket": report(DKM_REMOVED_CMD, 0x10, 0x28, 0x28, 0x76, 0x02,
+                               0x00, 0x31, 0x03, 0xFF, 0xD5),
+    "MacroReportResponsePacket": report(MACRO_REPORT_RESPONSE_CMD, 0x10,
+                                        MACRO_MIN_IDX, 0x01, 0x04, 0x00,
+                                        0x0A),
+    "DuMangPacket (unknown)": report(0x7F, 0x01, 0x02),
+}
+
+LAYERS = {0: Keycode.A, 1: Keycode.MACRO, 2: Keycode.TRANSPARENT, 3: Keycode.B}
+
+PACKETS = [
+    BoardInfoRequestPacket(),
+    DKMInfoRequestPacket(0x10),
+    BoardSyncPacket(0x25, True, 0x01),
+    LightPulsePacket(True, 0x10),
+    DKMReportRequestPacket(0x10),
+    DKMConfigurePacket(0x10, LAYERS),
+    MacroReportRequestPacket(0x10, 3),
+    MacroConfigurePacket(0x10, 3, MacroType(MacroType.KEYDOWN),
+                         Keycode(Keycode.A), 100),
+    NKROConfigurePacket(True),
+    ReportRateConfigurePacket(500),
+    DKMColorRequestPacket(0x10),
+    DKMColorConfigurePacket(0x10, 0x0F, 0x00, 0x0F),
+]
+
+
+def cases():
+    for name, rawbytes in SAMPLES.items():
+        yield f"parse/{name}", lambda r=rawbytes: DuMangPacket.parse(r)
+    for p in PACKETS:
+        yield f"encode/{p.__class__.__name__}", p.encode
+    yield "Keycode(int)", lambda: Keycode(0x04)
+    yield "Keycode(unknown int)", lambda: Keycode(0x1FF)
+    yield "Keycode.fromstr", lambda: Keycode.fromstr("LAYER_TOGGLE_1")
+    yield "Macro.__init__", lambda: Macro(
+        Keycode(Keycode.A), 0, MacroType(MacroType.KEYDOWN), 100)
+    yield "DKMConfigurePacket()", lambda: DKMConfigurePacket(0x10, LAYERS)
+
+
+def time_per_op(fn, number, repeat):
+    timer = timeit.Timer(fn)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def allocations_per_op(fn, number=ALLOC_NUMBER):
+    """Returns (blocks, bytes) still allocated per call, with results kept."""
+    results = [None] * number
+    fn()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(number):
+        results[i] = fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), "filename")
+    blocks = sum(s.count_diff for s in diff)
+    size = sum(s.size_diff for s in diff)
+    # NOTE: The list of results was allocated up front.
+    return max(blocks, 0) / number, max(size, 0) / number
+
+
+def run_micro(name_filter, number, repeat):
+    results = {}
+    for name, fn in cases():
+        if name_filter and name_filter not in name:
+            continue
+        ns = time_per_op(fn, number, repeat) * 1e9
+        blocks, size = allocations_per_op(fn)
+        click.echo(f"{name:<40} {ns:8.0f} ns/op {blocks:6.2f} allocs/op "
+                   f"{size:8.1f} B/op")
+        results[f"micro/{name}/ns"] = result([ns], "ns", LOWER)
+        results[f"micro/{name}/allocs"] = result([blocks], "allocs", LOWER)
+    return {"meta": {"number": number, "repeat": repeat}, "results": results}
+
+
+@click.command(help="Microbenchmarks for packet encode/decode and keycodes")
+@click.option("--number", default=20000, help="Calls per timing run")
+@click.option("--repeat", default=5, help="Timing runs per case")
+@click.option("--filter", "name_filter", help="Only run cases containing this")
+@click.option("--output", help="Write results to this JSON file")
+@click.option(
+    "--compare", "baseline", type=click.File(), help="Baseline JSON to compare")
+@click.option(
+    "--threshold",
+    default=0.1,
+    help="Relative change counted as a regression",
+    show_default=True)
+def cli(number, repeat, name_filter, output, baseline, threshold):
+    suite = run_micro(name_filter, number, repeat)
+    if output:
+        with open(output, "w") as f:
+            json.dump(suite, f, indent=2)
+    if baseline:
+        click.echo()
+        regressions = compare_results(json.load(baseline), suite, threshold)
+        if regressions:
+            click.echo(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,154 @@
+"""
+Layer sync latency and CPU cost.
+
+Each board is a ``HIDRawDevice`` on one end of a socketpair. A key press
+is written to the first board's peer end, and the time until the matching
+``BoardSyncPacket`` shows up at the second board's peer end is recorded.
+This is done for the queued threads used by ``dumang-sync``, for
+``dumang-sync --fast-path`` and for ``dumang-sync --asyncio``.
+
+    $ python -m benchmarks.sync_latency
+"""
+import asyncio
+import socket
+import statistics
+import threading
+import time
+
+import click
+
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.aio import AsyncDuMangBoard
+from dumang_ctrl.dumang.stats import PipelineStats
+from dumang_ctrl.tools import sync
+from dumang_ctrl.tools.sync import (async_sync_loop, init_fast_path,
+                                    init_receive_threads, init_send_threads,
+                                    init_synchronization_threads)
+
+BOARD_INFO_RESPONSE = bytes([BOARD_INFO_RESPONSE_CMD, 0, 0, 1, 2, 1, 0, 4])
+KEY_PRESS = bytes([KEY_UP_CMD, 0x10, 0x01, 0xD5])
+
+
+def loopback_board():
+    """Returns (HIDRawDevice, peer socket), with board info already queued."""
+    ours, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    peer.send(BOARD_INFO_RESPONSE)
+    device = HIDRawDevice(os.dup(ours.fileno()))
+    ours.close()
+    return device, peer
+
+
+def drive(peer1, peer2, events, interval_s):
+    # NOTE: Skip the board info requests sent while the boards were opened.
+    for peer in (peer1, peer2):
+        peer.recv(64)
+
+    latencies = []
+    for _ in range(events):
+        start = time.perf_counter_ns()
+        peer1.send(KEY_PRESS)
+        peer2.recv(64)
+        latencies.append(time.perf_counter_ns() - start)
+        time.sleep(interval_s)
+    return latencies
+
+
+def run_threaded(events, interval_s, fast_path=False):
+    (d1, peer1), (d2, peer2) = loopback_board(), loopback_board()
+    kbd1 = DuMangBoard("A", d1)
+    kbd2 = DuMangBoard("B", d2)
+    if fast_path:
+        init_fast_path(kbd1, kbd2)
+    threads = []
+    threads.extend(init_send_threads(kbd1, kbd2))
+    threads.extend(init_receive_threads(kbd1, kbd2))
+    threads.extend(init_synchronization_threads(kbd1, kbd2))
+    for t in threads:
+        t.start()
+
+    nthreads = threading.active_count()
+    cpu = time.process_time()
+    latencies = drive(peer1, peer2, events, interval_s)
+    cpu = time.process_time() - cpu
+
+    # NOTE: Stop first, so no Job goes back to waiting after its JobKiller.
+    for t in threads:
+        t.stop()
+    for kbd in (kbd1, kbd2):
+        kbd.kill_threads()
+    for t in threads:
+        t.join()
+    return latencies, cpu, nthreads
+
+
+def run_asyncio(events, interval_s):
+    (d1, peer1), (d2, peer2) = loopback_board(), loopback_board()
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+
+    async def start():
+        kbd1 = await AsyncDuMangBoard.open("A", d1)
+        kbd2 = await AsyncDuMangBoard.open("B", d2)
+        tasks = [
+            asyncio.create_task(async_sync_loop(kbd1, kbd2)),
+            asyncio.create_task(async_sync_loop(kbd2, kbd1)),
+        ]
+        return kbd1, kbd2, tasks
+
+    async def stop(kbds, tasks):
+        for t in tasks:
+            t.cancel()
+        for kbd in kbds:
+            kbd.close()
+
+    kbd1, kbd2, tasks = asyncio.run_coroutine_threadsafe(start(),
+                                                         loop).result()
+    nthreads = threading.active_count()
+    cpu = time.process_time()
+    latencies = drive(peer1, peer2, events, interval_s)
+    cpu = time.process_time() - cpu
+
+    asyncio.run_coroutine_threadsafe(stop((kbd1, kbd2), tasks),
+                                     loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    loop.close()
+    return latencies, cpu, nthreads
+
+
+def run_fast_path(events, interval_s):
+    return run_threaded(events, interval_s, fast_path=True)
+
+
+def report(name, latencies, cpu, nthreads, wall):
+    us = sorted(l / 1000 for l in latencies)
+    p99 = us[int(len(us) * 0.99) - 1]
+    click.echo(f"{name:<9} threads {nthreads:2d}  "
+               f"p50 {statistics.median(us):7.1f} us  p99 {p99:7.1f} us  "
+               f"max {us[-1]:7.1f} us  cpu {100 * cpu / wall:5.1f}%")
+
+
+@click.command(help="Compare layer sync latency across sync modes")
+@click.option("--events", default=2000, help="Key presses forwarded per run")
+@click.option(
+    "--interval-ms", default=1.0, help="Delay between key presses")
+@click.option(
+    "--stages", help="Also print dumang-sync's per-stage stats", is_flag=True)
+def cli(events, interval_ms, stages):
+    for name, run in (("threaded", run_threaded), ("fast-path", run_fast_path),
+                      ("asyncio", run_asyncio)):
+        sync.pipeline_stats = PipelineStats()
+        start = time.monotonic()
+        latencies, cpu, nthreads = run(events, interval_ms / 1000)
+        report(name, latencies, cpu, nthreads, time.monotonic() - start)
+        if stages:
+            for stage, s in sync.pipeline_stats.summary()["A"].items():
+                if s["count"]:
+                    click.echo(f"  {stage:<7} p50 {s['p50_us']:7.1f} us  "
+                               f"p99 {s['p99_us']:7.1f} us  "
+                               f"max {s['max_us']:7.1f} us")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+
+from .common import *
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDuMangBoard:
+    """
+    An asyncio counterpart to DuMangBoard.
+
+    The board's HID node is switched to non-blocking mode and registered
+    with the event loop, so any number of boards run on the loop's thread
+    without send or receive threads. This needs a handle with a file
+    descriptor, ie. a HIDRawDevice on Linux.
+
+    ``request()`` follows the same matching rules as
+    ``DuMangBoard.request``, but returns an asyncio Task instead of a
+    concurrent Future.
+    """
+
+    def __init__(self, serial, handle, capture=None):
+        self.serial = serial
+        self.handle = handle
+        self.capture = capture
+        self.fd = handle.fileno()
+        self.nkro = DEFAULT_NKRO_VALUE
+        self.report_rate = DEFAULT_REPORT_RATE
+        self.version = None
+        self.discovery_timings = {}
+        self.stats = defaultdict(RequestStats)
+        self.recv_q = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._waiting = {}
+        self._late = LateResponses()
+        self._key_locks = defaultdict(asyncio.Lock)
+        self._tasks = set()
+        self._configured_keys = None
+        os.set_blocking(self.fd, False)
+        self._loop.add_reader(self.fd, self._on_readable)
+
+    @classmethod
+    async def open(cls, serial, handle, capture=None):
+        board = cls(serial, handle, capture)
+        await board._initialize()
+        return board
+
+    async def _initialize(self):
+        try:
+            p = await self.request(
+                BoardInfoRequestPacket(),
+                expect=BOARD_INFO_RESPONSE_CMD,
+                retries=0)
+        except TimeoutError:
+            return
+
+        self.nkro = p.nkro
+        self.report_rate = p.report_rate
+        self.version = p.version
+
+    def _on_readable(self):
+        try:
+            rawbytes = os.read(self.fd, 64)
+            read_ns = time.monotonic_ns()
+        except BlockingIOError:
+            return
+        except OSError as ex:
+            logger.error(f"Board {self.serial}: {ex}")
+            self._loop.remove_reader(self.fd)
+            return
+        if rawbytes and self.capture:
+            self.capture.read(rawbytes)
+
+        p = DuMangPacket.parse(rawbytes)
+        if not p:
+            return
+        p.read_ns = read_ns
+        logger.debug(p)
+
+        key = (p.cmd, p.match_key())
+        response = self._waiting.get(key)
+        if response is not None and not response.done():
+            if self._late.drop(key, time.monotonic()):
+                logger.debug(f"Dropping late response {p!r}")
+                return
+            response.set_result(p)
+        else:
+            self.recv_q.put_nowait(p)
+
+    def _writable(self):
+        future = self._loop.create_future()
+
+        def on_writable():
+            self._loop.remove_writer(self.fd)
+            if not future.done():
+                future.set_result(None)
+
+        self._loop.add_writer(self.fd, on_writable)
+        return future
+
+    async def send(self, packet):
+        data = bytes(packet.encode())
+        while True:
+            try:
+                n = os.write(self.fd, data)
+                if self.capture:
+                    self.capture.written(data)
+                break
+            except BlockingIOError:
+                await self._writable()
+        if packet.trace is not None:
+            packet.trace.written(time.monotonic_ns())
+        return n
+
+    async def recv(self):
+        return await self.recv_q.get()
+
+    async def _request(self, packet, expect, timeout, retries):
+        if expect is None:
+            expect = packet.RESPONSE_CMD
+        stats = self.stats[packet.cmd]
+        if expect is None:
+            start = time.monotonic()
+            await self.send(packet)
+            stats.completed += 1
+            stats.latencies.append(time.monotonic() - start)
+            return None
+
+        key = (expect, packet.match_key())
+        # NOTE: One request per key on the wire at a time, see
+        # TransactionManager.
+        async with self._key_locks[key]:
+            start = time.monotonic()
+            attempts_sent = []
+            for attempt in range(retries + 1):
+                if attempt > 0:
+                    stats.retries += 1
+                response = self._loop.create_future()
+                self._waiting[key] = response
+                await self.send(packet)
+                attempt_timeout = timeout / 1000 * REQUEST_BACKOFF_FACTOR**attempt
+                attempts_sent.append(time.monotonic())
+                try:
+                    p = await asyncio.wait_for(response, attempt_timeout)
+                except TimeoutError:
+                    continue
+                finally:
+                    del self._waiting[key]
+
+                now = time.monotonic()
+                self._late.answered(key, attempts_sent,
+                                    attempts_sent[-1] + attempt_timeout, now)
+                stats.completed += 1
+                stats.latencies.append(now - start)
+                return p
+
+        stats.timeouts += 1
+        raise TimeoutError(f"No response to {packet!r}")
+
+    def request(self,
+                packet,
+                expect=None,
+                timeout=DEFAULT_REQUEST_TIMEOUT_MS,
+                retries=DEFAULT_REQUEST_RETRIES):
+        """Sends ``packet`` and returns a Task resolving to the board's response."""
+        task = self._loop.create_task(
+            self._request(packet, expect, timeout, retries))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def drain(self, timeout=None):
+        """Waits for every outstanding request. Returns those that did not complete."""
+        if not self._tasks:
+            return set()
+        _, not_done = await asyncio.wait(list(self._tasks), timeout=timeout)
+        return not_done
+
+    async def discover(self, window=DEFAULT_DISCOVERY_WINDOW):
+        """Reads back every DKM, see DKMDiscovery."""
+        finished = self._loop.create_future()
+        discovery = DKMDiscovery(self, window)
+        discovery.start(lambda keys: self._loop.call_soon(
+            finished.set_result, keys))
+        self._configured_keys = await finished
+        self.discovery_timings = discovery.timings
+        return self._configured_keys
+
+    def request_stats(self):
+        return {cmd: stats.summary() for cmd, stats in self.stats.items()}
+
+    @property
+    def configured_keys(self):
+        if self._configured_keys is None:
+            raise RuntimeError("Call discover() before using configured_keys")
+        return self._configured_keys
+
+    def close(self):
+        self._loop.remove_reader(self.fd)
+        self._loop.remove_writer(self.fd)
+        for task in list(self._tasks):
+            task.cancel()
+        self.handle.close()
+
+
+async def initialize_async_devices(capture=None):
+    """Like initialize_devices(), but opens AsyncDuMangBoards on the running loop."""
+    boards = []
+    for d in find_devices():
+        try:
+            h = open_device(d["path"])
+        except OSError as ex:
+            logger.error(ex, exc_info=True)
+            logger.error("Likely permissions error.")
+            sys.exit(1)
+        if not hasattr(h, "fileno"):
+            logger.error("asyncio boards need a hidraw device node")
+            h.close()
+            sys.exit(1)
+        serial = d["serial_number"]
+        boards.append(await AsyncDuMangBoard.open(
+            serial, h, capture.channel(serial) if capture else None))
+
+    return boards
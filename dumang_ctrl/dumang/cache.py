@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import random
+from concurrent.futures import wait
+from pathlib import Path
+
+from .common import *
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+CACHE_DIR_NAME = "dumang-ctrl"
+
+# NOTE: Number of DKM report requests used to check a cached board is
+# still what is plugged in. Checking every slot is the default since load
+# addresses DKMs by slot, and a module moved between runs must never be
+# missed. Reports are cheap next to macros, colors and versions.
+DEFAULT_CACHE_SAMPLE_SIZE = MAX_KEYS
+CACHE_VALIDATE_TIMEOUT_S = 2
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return Path(base) / CACHE_DIR_NAME
+
+
+def encode_dkm(dkm):
+    return {
+        "key": dkm.key,
+        "serial": dkm.serial,
+        "layers": [dkm.layer_keycodes[l].keycode for l in range(MAX_LAYERS)],
+        "macro": [[m.keycode.keycode, m.type.type, m.delay] for m in dkm.macro],
+        "color": list(dkm.color) if dkm.color is not None else None,
+        "version": list(dkm.version) if dkm.version is not None else None,
+    }
+
+
+def decode_dkm(d):
+    dkm = DuMangKeyModule(
+        d["key"],
+        {l: Keycode(kc) for l, kc in enumerate(d["layers"])},
+        d["serial"],
+        tuple(d["color"]) if d["color"] is not None else None,
+        tuple(d["version"]) if d["version"] is not None else None,
+    )
+    dkm.macro = [
+        Macro(Keycode(kc), idx, MacroType(type_), delay)
+        for idx, (kc, type_, delay) in enumerate(d["macro"])
+    ]
+    return dkm
+
+
+def _fingerprint(board):
+    version = getattr(board, "version", None)
+    return {
+        "serial": board.serial,
+        "version": list(version) if version is not None else None,
+        "nkro": board.nkro,
+        "report_rate": board.report_rate,
+    }
+
+
+class DiscoveryCache:
+    """
+    Persists the DKM state read by discovery, one file per board serial.
+
+    A cached board is only used if its board info matches and the DKM
+    reports read back from a sample of slots (all of them by default)
+    agree with it.
+    """
+
+    def __init__(self, path=None, sample_size=DEFAULT_CACHE_SAMPLE_SIZE):
+        self.path = Path(path) if path is not None else default_cache_dir()
+        self.sample_size = sample_size
+
+    def _file(self, board_serial):
+        return self.path / f"{board_serial}.json"
+
+    def load(self, board):
+        """Returns the validated cached keys for ``board``, or None."""
+        if not board.serial:
+            return None
+
+        try:
+            with open(self._file(board.serial)) as f:
+                cached = json.load(f)
+            if cached["format"] != CACHE_FORMAT_VERSION:
+                return None
+            if cached["board"] != _fingerprint(board):
+                logger.debug(f"Board {board.serial} info changed")
+                return None
+            keys = {d["serial"]: decode_dkm(d) for d in cached["keys"]}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            logger.warning(f"Ignoring unreadable cache for {board.serial}: {ex}")
+            return None
+
+        if not self._validate(board, keys):
+            logger.debug(f"Cached DKMs for board {board.serial} are stale")
+            return None
+
+        logger.debug(f"Using cached DKMs for board {board.serial}")
+        return keys
+
+    def _validate(self, board, keys):
+        by_key = {dkm.key: dkm for dkm in keys.values()}
+        sample = random.sample(range(MAX_KEYS),
+                               min(self.sample_size, MAX_KEYS))
+        futures = {
+            k: board.request(DKMReportRequestPacket(k))
+            for k in sample
+        }
+        _, not_done = wait(futures.values(), timeout=CACHE_VALIDATE_TIMEOUT_S)
+        if not_done:
+            return False
+
+        for k, future in futures.items():
+            if future.exception() is not None:
+                return False
+            p = future.result()
+            dkm = by_key.get(k)
+            present = any(kc.keycode != 0 for kc in p.layer_keycodes.values())
+            if dkm is None:
+                if present:
+                    return False
+            elif not present or (p.serial, p.layer_keycodes) != (
+                    dkm.serial, dkm.layer_keycodes):
+                return False
+
+        return True
+
+    def store(self, board, keys):
+        if not board.serial:
+            return
+
+        cached = {
+            "format": CACHE_FORMAT_VERSION,
+            "board": _fingerprint(board),
+            "keys": [encode_dkm(dkm) for dkm in keys.values()],
+        }
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            path = self._file(board.serial)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(cached, f)
+            os.replace(tmp, path)
+        except OSError as ex:
+            logger.warning(f"Could not write cache for {board.serial}: {ex}")
+
+    def invalidate(self, board_serial):
+        try:
+            self._file(board_serial).unlink()
+            logger.debug(f"Invalidated cached DKMs for board {board_serial}")
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            logger.warning(f"Could not invalidate cache for {board_serial}: {ex}")
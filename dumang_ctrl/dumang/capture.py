@@ -0,0 +1,304 @@
+"""
+Recording of raw HID traffic, and replaying it through the real code.
+
+A capture starts with ``CAPTURE_MAGIC`` followed by records, each a
+``RECORD_HEADER`` (monotonic ns, channel, kind, payload length) and the
+payload. A ``RECORD_BOARD`` record names the board serial of a channel
+before its first report. Reads are stored without their zero padding,
+writes exactly as written.
+"""
+import logging
+import struct
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from .common import *
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_MAGIC = b"DMCAP\x01"
+RECORD_HEADER = struct.Struct("<QBBH")
+
+RECORD_READ = 0
+RECORD_WRITE = 1
+RECORD_BOARD = 2
+
+REPORT_SIZE = 64
+
+
+class CaptureChannel:
+    """What a board records its traffic through, see DuMangBoard.capture."""
+
+    def __init__(self, writer, channel):
+        self.writer = writer
+        self.channel = channel
+
+    def read(self, data):
+        self.writer.record(self.channel, RECORD_READ,
+                           bytes(data).rstrip(b"\0"))
+
+    def written(self, data):
+        self.writer.record(self.channel, RECORD_WRITE, bytes(data))
+
+
+class CaptureWriter:
+    """Appends records to a capture file, from any number of threads."""
+
+    def __init__(self, path):
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+        self._channels = {}
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+
+    def channel(self, board_serial):
+        # NOTE: A board that reconnects keeps its channel.
+        with self._lock:
+            channel = self._channels.setdefault(board_serial,
+                                                len(self._channels))
+        self.record(channel, RECORD_BOARD, str(board_serial).encode())
+        return CaptureChannel(self, channel)
+
+    def record(self, channel, kind, payload):
+        header = RECORD_HEADER.pack(time.monotonic_ns(), channel, kind,
+                                    len(payload))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(header + payload)
+            # NOTE: Flushed every time so a capture survives a hung or
+            # killed process, which is when one is most useful.
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """Yields (t_ns, board_serial, kind, payload) for every report in a capture."""
+    boards = {}
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture")
+        # NOTE: Appending to an existing capture starts new channels over
+        # from 0, which the board records take care of.
+        while header := f.read(RECORD_HEADER.size):
+            if len(header) < RECORD_HEADER.size:
+                logger.warning(f"Ignoring truncated record in {path}")
+                return
+            t_ns, channel, kind, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                logger.warning(f"Ignoring truncated record in {path}")
+                return
+            if kind == RECORD_BOARD:
+                boards[channel] = payload.decode()
+            else:
+                yield t_ns, boards.get(channel), kind, payload
+
+
+# NOTE: Bytes after the command that pair a response with the request it
+# answers, by request command. Every response command is its request's
+# plus one. Reads that answer no captured write are events, eg. key presses.
+REQUEST_KEY_LENGTHS = {
+    BOARD_INFO_REQUEST_CMD: 0,
+    DKM_INFO_REQUEST_CMD: 0,
+    DKM_REPORT_REQUEST_CMD: 1,
+    MACRO_REPORT_REQUEST_CMD: 2,
+    DKM_COLOR_REQUEST_CMD: 0,
+}
+
+# NOTE: How long a replay may go without a report or write before the
+# reports still held back are given up on, see ReplayDevice.stalled.
+REPLAY_STALL_S = 2
+
+
+def request_key(data):
+    """The key of the responses a written ``data`` asks for, or None."""
+    n = REQUEST_KEY_LENGTHS.get(data[0])
+    if n is None:
+        return None
+    return (data[0] + 1, bytes(data[1:1 + n]))
+
+
+def response_key(data):
+    """The key of the request a read ``data`` would answer, or None."""
+    n = REQUEST_KEY_LENGTHS.get(data[0] - 1)
+    if n is None:
+        return None
+    return (data[0], bytes(data[1:1 + n]))
+
+
+class ReplayDevice:
+    """
+    A handle that plays back one board's side of a capture.
+
+    A captured response is only handed back once the request it answered
+    has been written, matched by content rather than by position, so
+    requests pipelined in a different order than when capturing still get
+    their own responses. Other reads, eg. key presses, are played back in
+    order, with ``realtime`` at their original time offset. Writes not
+    found in the capture are counted in ``mismatched``.
+
+    Once nothing was read or written for ``stall_s`` while responses are
+    still held back, the replay is ``stalled``: those responses answer
+    requests that were never made.
+    """
+
+    def __init__(self,
+                 records,
+                 start_ns=None,
+                 realtime=False,
+                 stall_s=REPLAY_STALL_S):
+        self.records = records
+        self.realtime = realtime
+        self.stall_s = stall_s
+        self.start_ns = start_ns if start_ns is not None else (
+            records[0][0] if records else 0)
+        self.writes = []
+        self.mismatched = 0
+        self.stalled = False
+        self._captured_writes = Counter()
+        self._events = deque()
+        self._responses = defaultdict(deque)
+        self._answers = deque()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._cancelled = False
+        self._replay_start = time.monotonic_ns()
+        self._progress = time.monotonic()
+
+        # NOTE: Responses are tied to the captured request they answered,
+        # the oldest one outstanding with a matching key, and handed back
+        # in the order the same requests are written again. Color and
+        # firmware version responses don't say which DKM they are for.
+        outstanding = defaultdict(deque)
+        for n, (t_ns, kind, payload) in enumerate(records):
+            if kind == RECORD_WRITE:
+                self._captured_writes[payload] += 1
+                key = request_key(payload)
+                if key is not None:
+                    outstanding[key].append(payload)
+                continue
+            self._pending += 1
+            requests = outstanding.get(response_key(payload))
+            if requests:
+                self._responses[requests.popleft()].append((n, payload))
+            else:
+                self._events.append((n, t_ns, payload))
+
+    @property
+    def done(self):
+        return self._pending == 0
+
+    @property
+    def unanswered(self):
+        """Captured responses still held back, to requests not written (yet)."""
+        return sum(len(q) for q in self._responses.values())
+
+    def write(self, data):
+        data = bytes(data)
+        with self._cond:
+            self.writes.append(data)
+            if self._captured_writes[data] > 0:
+                self._captured_writes[data] -= 1
+            else:
+                self.mismatched += 1
+            responses = self._responses.get(data)
+            if responses:
+                self._answers.append(responses.popleft())
+            self._touch()
+        return len(data)
+
+    def _touch(self):
+        self._progress = time.monotonic()
+        self.stalled = False
+        self._cond.notify_all()
+
+    def _next(self):
+        """Returns the next captured read that can be handed back, or how long until one is due."""
+        answer = self._answers[0] if self._answers else None
+        if self._events:
+            n, t_ns, payload = self._events[0]
+            due = self._replay_start + t_ns - self.start_ns
+            wait = (due - time.monotonic_ns()) / 1e9
+            if (not self.realtime or wait <= 0) and (answer is None or
+                                                     n < answer[0]):
+                self._events.popleft()
+                return payload, None
+        if answer is not None:
+            self._answers.popleft()
+            return answer[1], None
+        return None, wait if self.realtime and self._events else None
+
+    def read(self, max_length, timeout_ms=None):
+        deadline = None if timeout_ms is None else (
+            time.monotonic() + timeout_ms / 1000)
+        with self._cond:
+            while not self._cancelled:
+                payload, wait = self._next()
+                if payload is not None:
+                    self._pending -= 1
+                    self._touch()
+                    return payload.ljust(REPORT_SIZE, b"\0")[:max_length]
+
+                if not self.done and not self.stalled:
+                    idle = time.monotonic() - self._progress
+                    if idle >= self.stall_s:
+                        self.stalled = True
+                        logger.debug(f"Replay stalled, {self.unanswered} "
+                                     f"responses were never asked for")
+                        self._cond.notify_all()
+                    else:
+                        remaining = self.stall_s - idle
+                        wait = remaining if wait is None else min(
+                            wait, remaining)
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return b""
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+        return b""
+
+    def wait_done(self, timeout=None):
+        """Waits for every captured read to be handed back. Returns False if it stalled or timed out first."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.done or self.stalled, timeout)
+            return self.done
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def close(self):
+        self.cancel()
+
+
+class ReplayBackend:
+    """Stands in for hidapi in find_devices()/open_device(), one device per captured board."""
+
+    def __init__(self, path, realtime=False):
+        per_board = {}
+        start_ns = None
+        for t_ns, serial, kind, payload in read_capture(path):
+            if start_ns is None:
+                start_ns = t_ns
+            per_board.setdefault(serial, []).append((t_ns, kind, payload))
+        self.devices = {
+            serial: ReplayDevice(records, start_ns, realtime)
+            for serial, records in per_board.items()
+        }
+
+    def enumerate(self):
+        return [{
+            "path": f"replay:{serial}".encode(),
+            "serial_number": serial,
+            "interface_number": 1,
+        } for serial in self.devices]
+
+    def open(self, path):
+        return self.devices[path.decode().split(":", 1)[1]]
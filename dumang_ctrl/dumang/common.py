@@ -1,12 +1,22 @@
+import ctypes
+import errno
 import logging
+import os
 import queue
+import select
+import struct
 import sys
 import threading
-from collections import deque
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from types import MappingProxyType
 
 import hid
 import usb1
 
+from .stats import LatencyHistogram
+
 logger = logging.getLogger(__name__)
 
 BOARD_INFO_REQUEST_CMD = 0x30
@@ -41,6 +51,9 @@ DEFAULT_REPORT_RATE = 1000
 
 VENDOR_ID = 0x0483
 PRODUCT_ID = 0x5710
+
+SIMULATOR_ENV = "DUMANG_SIMULATOR"
+
 KBD_1_ID = 0x25
 KBD_2_ID = 0x0D
 
@@ -50,10 +63,63 @@ MAX_KEYS = 44
 MAX_LAYERS = 4
 UNKNOWN_MACROTYPE_STR = "UNKNOWN"
 
+# NOTE: Number of requests kept in flight while reading back DKM state.
+DEFAULT_DISCOVERY_WINDOW = 8
+
+DEFAULT_REQUEST_TIMEOUT_MS = 250
+DEFAULT_REQUEST_RETRIES = 3
+REQUEST_BACKOFF_FACTOR = 2
+REQUEST_LATENCY_SAMPLES = 1024
+
+# NOTE: Classes of outgoing packets, in the order they are sent.
+SEND_REALTIME = 0
+SEND_INTERACTIVE = 1
+SEND_BULK = 2
+SEND_CLASS_NAMES = ("realtime", "interactive", "bulk")
+# NOTE: Longest a packet waits behind higher classes before it is sent
+# anyway, so a steady stream of them cannot starve it.
+SEND_MAX_WAIT_S = {SEND_INTERACTIVE: 0.05, SEND_BULK: 0.2}
+
+# NOTE: Bulk writes are paced by a window of packets written between
+# readbacks, see BulkPacer.
+PACING_INITIAL_WINDOW = 8
+PACING_MAX_WINDOW = 256
+PACING_RETRIES = 3
+
+SYSFS_HIDRAW = "/sys/class/hidraw"
+# NOTE: How long to wait for udev to create the hidraw node of a board
+# libusb reported, and how often to look.
+HIDRAW_SETTLE_S = 2
+HIDRAW_POLL_S = 0.02
+
+# NOTE: A handle is stale, eg. after a suspend libusb did not report, once
+# this many reads or writes in a row failed or a heartbeat went unanswered.
+STALE_IO_ERRORS = 3
+STALE_READ_BACKOFF_S = 0.05
+# NOTE: Boards that read nothing for this long are asked for a heartbeat.
+HEARTBEAT_INTERVAL_S = 10
+HEARTBEAT_TIMEOUT_MS = 100
+HEARTBEAT_RETRIES = 2
+# NOTE: How often a stale board that isn't back yet is looked for, from
+# the first to the last retry, doubling in between.
+STALE_RETRY_MIN_S = 0.1
+STALE_RETRY_MAX_S = 5
+# NOTE: How far CLOCK_BOOTTIME has to get ahead of CLOCK_MONOTONIC between
+# two checks to count as a suspend, see ResumeDetector.
+SUSPEND_THRESHOLD_S = 1
+
+# NOTE: How long a board has to stay arrived or left before it is notified,
+# so a flaky hub or cable bouncing it costs one re-initialization, not one
+# per hotplug event. See USBConnectionMonitor.
+HOTPLUG_SETTLE_S = 0.2
+
 NOTIFY_STATUS_READY = "ready"
 NOTIFY_STATUS_WAIT = "wait"
 NOTIFY_STATUS_STOP = "stop"
 
+KEYS_EVENT_ADDED = "added"
+KEYS_EVENT_REMOVED = "removed"
+
 
 class Keycode:
     """These are HID Keycodes and can be found here: https://usb.org/sites/default/files/hut1_3_0.pdf"""
@@ -359,17 +425,44 @@ class Keycode:
     DISABLED = 0xFE
     """Disabled"""
 
-    def __init__(self, keycode):
-        self.keycode = keycode
-        self.keystr = []
+    __slots__ = ("keycode", "keystr")
+
+    _interned = {}
+    by_name = {}
+    """Keycode value for every name, aliases included, in definition order."""
+
+    def __new__(cls, keycode):
+        try:
+            return cls._interned[keycode]
+        except (KeyError, TypeError):
+            return cls._create(keycode)
+
+    @classmethod
+    def _create(cls, keycode):
+        self = object.__new__(cls)
+        # NOTE: Aliases keep their definition order in this class.
+        # The first one is used by str().
+        keystr = tuple(
+            name for name, value in cls.by_name.items() if value == keycode)
+        if not keystr:
+            keystr = (f"UNKNOWN_{keycode:02X}",)
+        object.__setattr__(self, "keycode", keycode)
+        object.__setattr__(self, "keystr", keystr)
+        return self
+
+    @classmethod
+    def _intern(cls):
+        cls.by_name = MappingProxyType(_collect_codes(cls))
+        cls._interned = {
+            keycode: cls._create(keycode)
+            for keycode in range(256)
+        }
 
-        for attribute in Keycode.__dict__:
-            if attribute[:2] != "__":
-                value = getattr(Keycode, attribute)
-                if not callable(value) and self.keycode == value:
-                    self.keystr.append(attribute)
-        if not self.keystr:
-            self.keystr = [f"UNKNOWN_{self.keycode:02X}"]
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __reduce__(self):
+        return (self.__class__, (self.keycode,))
 
     def __lt__(self, other):
         return self.keycode < other.keycode
@@ -382,21 +475,15 @@ class Keycode:
 
     @classmethod
     def fromstr(cls, keystr):
-        for attribute in Keycode.__dict__:
-            if attribute[:2] != "__":
-                value = getattr(Keycode, attribute)
-                if not callable(value) and keystr == attribute:
-                    return cls(value)
+        if not isinstance(keystr, str):
+            return None
+        keycode = cls.by_name.get(keystr)
+        if keycode is not None:
+            return cls(keycode)
 
     @classmethod
     def keys(cls):
-        result = []
-        for attribute in Keycode.__dict__:
-            if attribute[:2] != "__":
-                value = getattr(Keycode, attribute)
-                if not callable(value):
-                    result.append(attribute)
-        return result
+        return list(cls.by_name)
 
     def encode(self):
         return self.keycode
@@ -417,32 +504,74 @@ class MacroType:
     WAIT_KEYUP = 0x04
     """Used to define Split Section Macros (ie. execute part 1 on key down and part 2 on key up)"""
 
-    def __init__(self, type_):
-        self.type = type_
-        self.typestr = UNKNOWN_MACROTYPE_STR
-        for attribute in MacroType.__dict__:
-            if attribute[:2] != "__":
-                value = getattr(MacroType, attribute)
-                if not callable(value) and self.type == value:
-                    self.typestr = attribute
-        if self.typestr is UNKNOWN_MACROTYPE_STR:
-            self.typestr = f"UNKNOWN_{self.type:02X}"
+    __slots__ = ("type", "typestr")
+
+    _interned = {}
+    by_name = {}
+    """MacroType value for every name."""
+
+    def __new__(cls, type_):
+        try:
+            return cls._interned[type_]
+        except (KeyError, TypeError):
+            return cls._create(type_)
+
+    @classmethod
+    def _create(cls, type_):
+        self = object.__new__(cls)
+        typestr = UNKNOWN_MACROTYPE_STR
+        for name, value in cls.by_name.items():
+            if value == type_:
+                typestr = name
+        if typestr is UNKNOWN_MACROTYPE_STR:
+            typestr = f"UNKNOWN_{type_:02X}"
+        object.__setattr__(self, "type", type_)
+        object.__setattr__(self, "typestr", typestr)
+        return self
+
+    @classmethod
+    def _intern(cls):
+        cls.by_name = MappingProxyType(_collect_codes(cls))
+        cls._interned = {type_: cls._create(type_) for type_ in range(256)}
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __reduce__(self):
+        return (self.__class__, (self.type,))
 
     @classmethod
     def fromstr(cls, typestr):
-        for attribute in MacroType.__dict__:
-            if attribute[:2] != "__":
-                value = getattr(MacroType, attribute)
-                if not callable(value) and typestr == attribute:
-                    return cls(value)
+        if not isinstance(typestr, str):
+            return None
+        type_ = cls.by_name.get(typestr)
+        if type_ is not None:
+            return cls(type_)
 
     def __eq__(self, other):
         return self.type == other.type
 
+    def __hash__(self):
+        return hash(self.type)
+
     def __repr__(self):
         return self.typestr
 
 
+def _collect_codes(cls):
+    return {
+        name: value
+        for name, value in vars(cls).items()
+        if not name.startswith("_") and isinstance(value, int)
+    }
+
+
+# NOTE: Every possible code is built exactly once here and shared from then
+# on, since DKM reports and config files construct these constantly.
+Keycode._intern()
+MacroType._intern()
+
+
 class Macro:
 
     def __init__(self, keycode, idx, type, delay):
@@ -519,6 +648,452 @@ class JobKiller:
         self.init = True
 
 
+class Transaction:
+    """
+    A request in flight. ``future`` resolves to the matching response, or
+    to ``None`` once written if no response is expected.
+    """
+
+    def __init__(self, packet, expect, timeout_ms, retries):
+        self.packet = packet
+        self.expect = expect
+        self.match_key = packet.match_key()
+        self.timeout = timeout_ms / 1000
+        self.retries = retries
+        self.attempt = 0
+        self.deadline = None
+        self.sent_at = None
+        # NOTE: When each attempt was written, see TransactionManager.
+        self.attempts_sent = []
+        self.future = Future()
+
+    @property
+    def key(self):
+        return (self.expect, self.match_key)
+
+    def __repr__(self):
+        return f"Transaction({self.packet!r}, attempt={self.attempt})"
+
+
+class RequestStats:
+    """Latency samples and failure counts for one request command."""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=REQUEST_LATENCY_SAMPLES)
+        self.completed = 0
+        self.retries = 0
+        self.timeouts = 0
+
+    def percentile(self, q):
+        samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q / 100 * len(samples)))]
+
+    def summary(self):
+        return {
+            "completed": self.completed,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "p50_ms": _to_ms(self.percentile(50)),
+            "p99_ms": _to_ms(self.percentile(99)),
+            "max_ms": _to_ms(max(self.latencies, default=None)),
+        }
+
+
+def _to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class LateResponses:
+    """
+    Responses still expected to the earlier attempts of requests that were
+    answered after being re-sent, by key. See TransactionManager.
+    """
+
+    def __init__(self):
+        # NOTE: [responses still expected, until when] by key.
+        self._late = {}
+        self._min_latency = None
+
+    def answered(self, key, attempts_sent, deadline, now):
+        """Records the request on ``key`` with attempts written at ``attempts_sent`` as answered ``now``."""
+        if len(attempts_sent) == 1:
+            latency = now - attempts_sent[0]
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            return
+        if self._min_latency is None:
+            late = len(attempts_sent) - 1
+        else:
+            late = sum(1 for sent in attempts_sent
+                       if now - sent < self._min_latency)
+        if late:
+            self._late[key] = [late, deadline]
+
+    def drop(self, key, now):
+        """Whether a response on ``key`` answers an earlier attempt of a request already answered."""
+        late = self._late.get(key)
+        if late is None:
+            return False
+        if now > late[1]:
+            del self._late[key]
+            return False
+        late[0] -= 1
+        if late[0] == 0:
+            del self._late[key]
+        return True
+
+    def clear(self):
+        self._late.clear()
+
+
+class TransactionManager:
+    """
+    Pairs responses read from a board with the requests waiting on them.
+
+    Requests are matched on the expected response command and the
+    packet's ``match_key()``. Only one request per key is on the wire at a
+    time, the rest are held back and sent by ``send`` in order. Otherwise a
+    lost response would shift every later match for responses that carry
+    no key (eg. DKMColorResponsePacket). Requests that time out are re-sent
+    with an exponentially growing timeout until their retries run out.
+
+    A request answered after being re-sent may still get the responses to
+    its other attempts. Those written too recently to have been answered,
+    going by the fastest answer seen to a request sent once, are dropped
+    on its key until its last timeout would have passed, rather than
+    matched to the next request. Until there is such an answer, every
+    other attempt counts. Attempts written long enough ago were either
+    answered already or lost.
+    """
+
+    def __init__(self, send):
+        self.stats = defaultdict(RequestStats)
+        self._send = send
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._in_flight = set()
+        self._open = set()
+        self._late = LateResponses()
+
+    def submit(self, tx):
+        self._open.add(tx.future)
+        tx.future.add_done_callback(self._open.discard)
+        if tx.expect is None:
+            self._send(tx)
+            return
+
+        with self._lock:
+            waiting = self._waiting.setdefault(tx.key, deque())
+            waiting.append(tx)
+            send_now = len(waiting) == 1
+
+        if send_now:
+            self._send(tx)
+
+    def _pop(self, tx):
+        """Removes ``tx`` from the head of its queue. Returns the next request to send."""
+        waiting = self._waiting.get(tx.key)
+        if not waiting:
+            return None
+        if waiting[0] is not tx:
+            # NOTE: Already resolved some other way, eg. cancelled.
+            if tx in waiting:
+                waiting.remove(tx)
+            return None
+        waiting.popleft()
+        if not waiting:
+            del self._waiting[tx.key]
+            return None
+        return waiting[0]
+
+    def sending(self, tx):
+        if tx.sent_at is None:
+            tx.sent_at = time.monotonic()
+
+    def sent(self, tx):
+        now = time.monotonic()
+        if tx.expect is None:
+            self._finish(tx, None, now)
+            return
+
+        with self._lock:
+            # NOTE: The response may already have been read.
+            if tx.future.done():
+                return
+            tx.deadline = now + tx.timeout * REQUEST_BACKOFF_FACTOR**tx.attempt
+            tx.attempts_sent.append(now)
+            self._in_flight.add(tx)
+
+    def complete(self, p):
+        """Resolves the oldest request waiting on ``p``. Returns True if there was one."""
+        if not self._waiting:
+            return False
+
+        now = time.monotonic()
+        key = (p.cmd, p.match_key())
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if not waiting:
+                return False
+            if self._late.drop(key, now):
+                logger.debug(f"Dropping late response {p!r}")
+                return True
+            tx = waiting[0]
+            if tx.sent_at is None:
+                # NOTE: Can't be the answer to a request not written yet.
+                logger.debug(f"Dropping unexpected response {p!r}")
+                return True
+            self._in_flight.discard(tx)
+            next_tx = self._pop(tx)
+            if tx.attempts_sent:
+                self._late.answered(key, tx.attempts_sent, tx.deadline, now)
+
+        self._finish(tx, p, now)
+        if next_tx is not None:
+            self._send(next_tx)
+        return True
+
+    def _finish(self, tx, result, now):
+        if tx.future.done():
+            return
+        stats = self.stats[tx.packet.cmd]
+        stats.completed += 1
+        if tx.sent_at is not None:
+            stats.latencies.append(now - tx.sent_at)
+        tx.future.set_result(result)
+
+    def next_timeout(self):
+        """Seconds until the next request times out, or None if none are in flight."""
+        with self._lock:
+            if not self._in_flight:
+                return None
+            deadline = min(tx.deadline for tx in self._in_flight)
+        return max(0.0, deadline - time.monotonic())
+
+    def expire(self):
+        """Returns the requests to re-send, failing those out of retries."""
+        now = time.monotonic()
+        resend = []
+        failed = []
+        with self._lock:
+            for tx in [tx for tx in self._in_flight if tx.deadline <= now]:
+                self._in_flight.discard(tx)
+                stats = self.stats[tx.packet.cmd]
+                if tx.future.done():
+                    next_tx = self._pop(tx)
+                    if next_tx is not None:
+                        resend.append(next_tx)
+                elif tx.attempt < tx.retries:
+                    tx.attempt += 1
+                    stats.retries += 1
+                    resend.append(tx)
+                else:
+                    stats.timeouts += 1
+                    failed.append(tx)
+                    next_tx = self._pop(tx)
+                    if next_tx is not None:
+                        resend.append(next_tx)
+
+        for tx in failed:
+            if not tx.future.done():
+                tx.future.set_exception(
+                    TimeoutError(f"No response to {tx.packet!r}"))
+        return resend
+
+    def pending(self):
+        return list(self._open)
+
+    def cancel_all(self):
+        with self._lock:
+            self._waiting.clear()
+            self._in_flight.clear()
+            self._late.clear()
+
+        # NOTE: Also packets without a response still waiting to be written.
+        for future in list(self._open):
+            future.cancel()
+
+    def summary(self):
+        return {cmd: stats.summary() for cmd, stats in self.stats.items()}
+
+
+class SendClassStats:
+    """Queueing metrics of one class of a SendScheduler."""
+
+    def __init__(self):
+        self.wait = LatencyHistogram()
+        self.promoted = 0
+        """Packets sent ahead of higher classes after waiting too long."""
+        self.coalesced = 0
+        """Packets dropped because a later one for the same key replaced them."""
+
+    def summary(self, depth):
+        return {
+            "depth": depth,
+            "promoted": self.promoted,
+            "coalesced": self.coalesced,
+            **self.wait.summary()
+        }
+
+
+class SendScheduler:
+    """
+    What a board's send thread writes next, in place of a plain FIFO.
+
+    Packets go out by their ``SEND_CLASS``: realtime (layer sync) before
+    interactive (requests, light pulses) before bulk (configuration), in
+    FIFO order within a class. A packet that has waited longer than
+    ``SEND_MAX_WAIT_S`` for its class is sent next regardless, but never
+    twice in a row, so a starved backlog delays higher classes by at most
+    one packet at a time. Offers the ``put()``/``get()`` of the
+    ``queue.Queue`` it replaces.
+
+    A packet with a ``coalesce_key()`` replaces a still queued one with
+    the same command and key, in its place in the queue, since only the
+    latest state matters. Requests that expect a response are never
+    coalesced, and the futures of those replaced resolve to None.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = [deque() for _ in SEND_CLASS_NAMES]
+        self.stats = [SendClassStats() for _ in SEND_CLASS_NAMES]
+        self._promoted_last = False
+        self._coalescable = {}
+
+    @staticmethod
+    def send_class(item):
+        if isinstance(item, JobKiller):
+            return SEND_REALTIME
+        if isinstance(item, Transaction):
+            item = item.packet
+        return getattr(item, "SEND_CLASS", SEND_INTERACTIVE)
+
+    @staticmethod
+    def coalesce_key(item):
+        if isinstance(item, Transaction):
+            if item.expect is not None:
+                return None
+            item = item.packet
+        key = item.coalesce_key() if isinstance(item, DuMangPacket) else None
+        return None if key is None else (item.cmd, key)
+
+    def put(self, item):
+        cls = self.send_class(item)
+        key = self.coalesce_key(item)
+        replaced = None
+        with self._cond:
+            entry = self._coalescable.get(key) if key is not None else None
+            if entry is not None:
+                replaced, entry[1] = entry[1], item
+                self.stats[cls].coalesced += 1
+            else:
+                entry = [time.monotonic_ns(), item]
+                self._queues[cls].append(entry)
+                if key is not None:
+                    self._coalescable[key] = entry
+                self._cond.notify()
+
+        # NOTE: Queued requests are cancelled when the board stops.
+        if isinstance(replaced, Transaction) and not replaced.future.done():
+            replaced.future.set_result(None)
+
+    def get(self, timeout=None):
+        """Like ``queue.Queue.get()``, raising queue.Empty on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not any(self._queues):
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
+            return self._pop()
+
+    def _pop(self):
+        now = time.monotonic_ns()
+        cls = next(c for c, q in enumerate(self._queues) if q)
+        overdue = [] if self._promoted_last else [
+            c for c in range(cls + 1, len(self._queues))
+            if self._queues[c] and
+            now - self._queues[c][0][0] > SEND_MAX_WAIT_S[c] * 1e9
+        ]
+        self._promoted_last = bool(overdue)
+        if overdue:
+            cls = min(overdue, key=lambda c: self._queues[c][0][0])
+            self.stats[cls].promoted += 1
+        queued_ns, item = self._queues[cls].popleft()
+        key = self.coalesce_key(item)
+        if key is not None:
+            del self._coalescable[key]
+        self.stats[cls].wait.record(now - queued_ns)
+        return item
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def depth(self):
+        """Packets waiting, by class name."""
+        with self._cond:
+            return {
+                name: len(q)
+                for name, q in zip(SEND_CLASS_NAMES, self._queues)
+            }
+
+    def summary(self):
+        with self._cond:
+            return {
+                name: stats.summary(len(q)) for name, stats, q in zip(
+                    SEND_CLASS_NAMES, self.stats, self._queues)
+            }
+
+
+class BulkPacer:
+    """
+    Additive increase, multiplicative decrease window for writes the
+    board never acknowledges. The window is how many packets are written
+    before reading them back: it halves after a batch that did not read
+    back as written, and otherwise grows by one. Until the first loss it
+    doubles instead, so it finds what the board sustains in a few batches.
+    """
+
+    def __init__(self,
+                 window=PACING_INITIAL_WINDOW,
+                 max_window=PACING_MAX_WINDOW):
+        self.window = window
+        self.max_window = max_window
+        self.batches = 0
+        self.losses = 0
+        self.peak = window
+
+    def verified(self):
+        self.batches += 1
+        grow = self.window if not self.losses else 1
+        self.window = min(self.max_window, self.window + grow)
+        self.peak = max(self.peak, self.window)
+
+    def lost(self):
+        self.batches += 1
+        self.losses += 1
+        self.window = max(1, self.window // 2)
+
+    def summary(self):
+        return {
+            "batches": self.batches,
+            "losses": self.losses,
+            "window": self.window,
+            "peak_window": self.peak,
+        }
+
+
 class DuMangKeyModule:
 
     def __init__(self,
@@ -554,48 +1129,213 @@ class DuMangKeyModule:
 class DuMangBoard:
     READ_TIMEOUT_MS = 50
 
-    def __init__(self, serial, handle):
+    def __init__(self, serial, handle, capture=None, info=None):
         self.serial = serial
         self.handle = handle
+        # NOTE: Optional capture.CaptureChannel recording raw reports.
+        self.capture = capture
+        # NOTE: Handles that can be woken up (HIDRawDevice) are read
+        # blocking. Others are polled so that threads notice should_stop.
+        self.blocking_reads = hasattr(handle, "cancel")
         self._keys_initialized = False
         self._configured_keys = {}
-        self.send_q = queue.Queue()
+        self._keys_by_id = {}
+        self._keys_lock = threading.Lock()
+        self._discovery_lock = threading.Lock()
+        self._subscribers = []
+        self.send_q = SendScheduler()
         self.recv_q = queue.Queue()
         self.should_stop = False
-        self._initialize()
-
-    def _initialize(self):
-        # NOTE: Because threads aren't started yet, it is important,
-        # to use write/read_packet().
-        self.write_packet(BoardInfoRequestPacket())
-        p = self.read_packet()
-
-        if isinstance(p, BoardInfoResponsePacket):
-            self.nkro = p.nkro
-            self.report_rate = p.report_rate
-            self.version = p.version
+        self.transactions = TransactionManager(self.send_q.put)
+        self.discovery_window = DEFAULT_DISCOVERY_WINDOW
+        self.discovery_timings = {}
+        # NOTE: Optional DiscoveryCache used by configured_keys.
+        self.cache = None
+        # NOTE: Called by the receive thread with each packet before it is
+        # queued. Returning True means it was handled, see sync's fast path.
+        self.forward = None
+        # NOTE: The send thread is not the only writer once another board's
+        # receive thread forwards packets directly to this one.
+        self._write_lock = threading.Lock()
+        # NOTE: Held while reading, so reopen() knows the old handle is done.
+        self._read_lock = threading.Lock()
+        self.io_errors = 0
+        """Reads and writes in a row that failed, see stale."""
+        self._stale = False
+        # NOTE: Called with the board once it goes stale, see SyncSession.
+        self.on_stale = None
+        self.last_read = time.monotonic()
+        # NOTE: ``info`` is the BoardInfoResponsePacket of an earlier
+        # connection of this board, which saves asking for it again.
+        self._initialize(info)
+
+    def _initialize(self, info=None):
+        if info is None:
+            # NOTE: Because threads aren't started yet, it is important,
+            # to use write/read_packet().
+            self.write_packet(BoardInfoRequestPacket())
+            info = self.read_packet(timeout_ms=DuMangBoard.READ_TIMEOUT_MS)
+
+        if isinstance(info, BoardInfoResponsePacket):
+            self.info = info
+            self.nkro = info.nkro
+            self.report_rate = info.report_rate
+            self.version = info.version
         else:
+            self.info = None
             self.nkro = DEFAULT_NKRO_VALUE
             self.report_rate = DEFAULT_REPORT_RATE
 
+    def board_info(self):
+        """The board's BoardInfoResponsePacket, with what was configured since. See __init__."""
+        if self.info is not None:
+            self.info.nkro = self.nkro
+            self.info.report_rate = self.report_rate
+        return self.info
+
     def write(self, rawbytes):
-        self.handle.write(rawbytes)
+        with self._write_lock:
+            # NOTE: Recorded before writing, the response may be read (and
+            # recorded) before write() returns.
+            if self.capture:
+                self.capture.written(rawbytes)
+            try:
+                self.handle.write(rawbytes)
+            except OSError:
+                self._io_failed()
+                raise
+            self.io_errors = 0
+
+    def read(self, timeout_ms=None):
+        with self._read_lock:
+            try:
+                if timeout_ms is None and self.blocking_reads:
+                    d = self.handle.read(64)
+                else:
+                    d = self.handle.read(
+                        64,
+                        timeout_ms=timeout_ms or DuMangBoard.READ_TIMEOUT_MS)
+            except:
+                d = None
+        if d is None:
+            self._io_failed()
+            # NOTE: A dead handle fails every read at once, don't spin on it.
+            time.sleep(STALE_READ_BACKOFF_S)
+            return None
+        self.io_errors = 0
+        if d:
+            self.last_read = time.monotonic()
+            if self.capture:
+                self.capture.read(d)
+        return d
+
+    def _io_failed(self):
+        self.io_errors += 1
+        if self.io_errors == STALE_IO_ERRORS:
+            self._went_stale()
+
+    def _went_stale(self):
+        if self.on_stale:
+            self.on_stale(self)
 
-    def read(self):
+    @property
+    def stale(self):
+        """Whether the handle looks dead even though the board never left. See reopen()."""
+        return self._stale or self.io_errors >= STALE_IO_ERRORS
+
+    def mark_stale(self):
+        self._stale = True
+        self._went_stale()
+
+    def heartbeat(self):
+        """Asks for the board info, marking the board stale if it doesn't answer."""
+        future = self.request(BoardInfoRequestPacket(),
+                              expect=BOARD_INFO_RESPONSE_CMD,
+                              timeout=HEARTBEAT_TIMEOUT_MS,
+                              retries=HEARTBEAT_RETRIES)
+        future.add_done_callback(self._on_heartbeat)
+        return future
+
+    def _on_heartbeat(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug(f"Board {self.serial}: no heartbeat")
+            self.mark_stale()
+
+    def reopen(self, handle):
+        """
+        Swaps in a new ``handle`` to this same board and closes the old one.
+        Queues, threads, requests in flight and DKMs are all kept, requests
+        lost with the old handle are retried on the new one.
+        """
+        old = self.handle
+        if handle is old:
+            # NOTE: Backends with one handle per board, eg. the simulator.
+            self.io_errors = 0
+            self._stale = False
+            return
+        if hasattr(old, "cancel"):
+            old.cancel()
+        with self._read_lock, self._write_lock:
+            self.handle = handle
+            self.blocking_reads = hasattr(handle, "cancel")
+            self.io_errors = 0
+            self._stale = False
         try:
-            # NOTE: Needs to be non-blocking so thread can be killed atm.
-            # Ideally I prefer it to be blocking.
-            return self.handle.read(64, timeout_ms=DuMangBoard.READ_TIMEOUT_MS)
-        except:
-            return None
+            old.close()
+        except (OSError, ValueError):
+            pass
 
     def put(self, v):
         self.send_q.put(v)
 
-    def get(self):
-        return self.recv_q.get()
+    def get(self, timeout=None):
+        try:
+            return self.recv_q.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def request(self,
+                packet,
+                expect=None,
+                timeout=DEFAULT_REQUEST_TIMEOUT_MS,
+                retries=DEFAULT_REQUEST_RETRIES):
+        """
+        Queues ``packet`` and returns a Future for the board's response.
+
+        ``expect`` is the response command to wait for and defaults to the
+        packet's ``RESPONSE_CMD``. Packets without a response resolve to
+        ``None`` once written. ``timeout`` is in milliseconds and doubles
+        with every retry.
+        """
+        if expect is None:
+            expect = packet.RESPONSE_CMD
+        tx = Transaction(packet, expect, timeout, retries)
+        if self.should_stop:
+            # NOTE: The send thread is gone or going, nothing would send it.
+            tx.future.cancel()
+            return tx.future
+        self.transactions.submit(tx)
+        return tx.future
+
+    def drain(self, timeout=None):
+        """Waits for every outstanding request. Returns those that did not complete."""
+        _, not_done = wait(self.transactions.pending(), timeout=timeout)
+        return not_done
+
+    def request_stats(self):
+        return self.transactions.summary()
+
+    def send_stats(self):
+        return self.send_q.summary()
 
     def close(self):
+        # NOTE: The send thread may have stopped before it got to its
+        # JobKiller, and nothing answers requests still open from now on.
+        self.transactions.cancel_all()
+        if isinstance(self.handle, HIDRawDevice):
+            self.handle.close()
+            return
+
         # NOTE: A hacky way of verifying if the handle is still valid.
         # I wonder if there is a cleaner way to do this.
         valid = True
@@ -610,102 +1350,363 @@ class DuMangBoard:
         if valid:
             self.handle.close()
 
-    def read_packet(self):
-        d = self.read()
-        return DuMangPacket.parse(d)
+    def read_packet(self, timeout_ms=None):
+        d = self.read(timeout_ms)
+        read_ns = time.monotonic_ns()
+        p = DuMangPacket.parse(d)
+        if p:
+            p.read_ns = read_ns
+        return p
 
     def write_packet(self, p):
         self.write(p.encode())
+        if p.trace is not None:
+            p.trace.written(time.monotonic_ns())
 
     def kill_threads(self):
+        # NOTE: Set first, so requests made from now on are cancelled
+        # rather than queued behind the JobKiller.
+        self.should_stop = True
         self.send_q.put(JobKiller())
         self.recv_q.put(JobKiller())
-        self.should_stop = True
+        if self.blocking_reads:
+            self.handle.cancel()
 
     def receive_thread(self):
         p = self.read_packet()
 
         if p:
             logger.debug(p)
-            self.recv_q.put(p)
+            # NOTE: One bad packet must not take the thread down with it.
+            try:
+                self._on_packet(p)
+            except Exception:
+                logger.exception(f"Failed to handle {p!r}")
 
         if self.should_stop:
             sys.exit(0)
 
+    def _on_packet(self, p):
+        if self.forward and self.forward(p):
+            return
+        if isinstance(p, (DKMAddedPacket, DKMRemovedPacket)):
+            self._on_dkm_event(p)
+        # NOTE: Responses to a request go to whoever is waiting on it,
+        # everything else (eg. key presses) is queued as before.
+        if not self.transactions.complete(p):
+            self.recv_q.put(p)
+
+    def _write_transaction(self, tx):
+        self.transactions.sending(tx)
+        try:
+            self.write_packet(tx.packet)
+        except OSError as ex:
+            if tx.expect is None:
+                logger.error(f"Failed to write {tx.packet!r}: {ex}")
+                if not tx.future.done():
+                    tx.future.set_exception(ex)
+                return
+            # NOTE: Treated as lost, so it is retried, possibly on the
+            # handle the board is reopened with. See stale.
+            logger.debug(f"Failed to write {tx.packet!r}: {ex}")
+        self.transactions.sent(tx)
+
     def send_thread(self):
-        p = self.send_q.get()
+        try:
+            # NOTE: Wake up in time to re-send requests that timed out.
+            p = self.send_q.get(timeout=self.transactions.next_timeout())
+        except queue.Empty:
+            p = None
+
+        # NOTE: Like the receive thread, this one must outlive any packet.
+        try:
+            for tx in self.transactions.expire():
+                logger.debug(f"Retrying {tx}")
+                self._write_transaction(tx)
+        except Exception:
+            logger.exception("Failed to re-send timed out requests")
 
         # NOTE: Allows for thread to be killed with blocking queue
         if isinstance(p, JobKiller):
+            self.transactions.cancel_all()
             sys.exit(0)
+        try:
+            self._send_one(p)
+        except Exception:
+            logger.exception(f"Failed to send {p!r}")
+
+    def _send_one(self, p):
+        if isinstance(p, Transaction):
+            self._write_transaction(p)
+        elif p is not None:
+            try:
+                self.write_packet(p)
+            except OSError as ex:
+                # NOTE: Counted towards stale, the thread must live on
+                # to write to the reopened handle.
+                logger.debug(f"Failed to write {p!r}: {ex}")
 
-        self.write_packet(p)
-
-    def _handle_dkm_reports(self):
-        pending = 0
-        for k in range(MAX_KEYS):
-            self.put(DKMReportRequestPacket(k))
-            pending += 1
-
-        while pending > 0:
-            p = self.get()
-            if isinstance(p, DKMReportResponsePacket):
-                pending -= 1
-                if any([kc.keycode != 0 for kc in p.layer_keycodes.values()]):
-                    # NOTE: We add the layer_keycodes to the DKM
-                    p.key.layer_keycodes = p.layer_keycodes
-                    self._configured_keys[p.serial] = DuMangKeyModule(
-                        p.key.key, p.layer_keycodes, p.serial)
-
-    def _handle_dkm_macros(self):
-        for _, dkm in self._configured_keys.items():
-            pending = 0
+    @property
+    def configured_keys(self):
+        if not self._keys_initialized:
+            # NOTE: Only the first of several threads asking reads the board.
+            with self._discovery_lock:
+                if not self._keys_initialized:
+                    self._discover()
+
+        return self._configured_keys
+
+    def _discover(self):
+        cached = self.cache.load(self) if self.cache else None
+        if cached is not None:
+            keys = cached
+        else:
+            discovery = DKMDiscovery(self, self.discovery_window)
+            keys = discovery.run()
+            self.discovery_timings = discovery.timings
+            if self.cache:
+                self.cache.store(self, keys)
+
+        with self._keys_lock:
+            self._configured_keys = keys
+            self._keys_by_id = {dkm.key: dkm for dkm in keys.values()}
+        self._keys_initialized = True
+
+    def key_by_id(self, key):
+        return self._keys_by_id.get(key)
+
+    def subscribe(self, callback):
+        """Calls ``callback(board, event, dkm)`` whenever a DKM is added or removed."""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def _notify(self, event, dkm):
+        for callback in list(self._subscribers):
+            try:
+                callback(self, event, dkm)
+            except Exception:
+                logger.exception(f"DKM {event} subscriber failed")
+
+    def _on_dkm_event(self, p):
+        if self.cache:
+            self.cache.invalidate(self.serial)
+
+        # NOTE: Until the keys are first read there is nothing to update,
+        # discovery will pick the change up.
+        if not self._keys_initialized:
+            return
+
+        if isinstance(p, DKMRemovedPacket):
+            self._remove_key(p.key.key)
+        else:
+            # NOTE: Only the slot that changed is read back.
+            DKMDiscovery(
+                self, self.discovery_window,
+                keys=[p.key.key]).start(self._on_key_rediscovered)
+
+    def _on_key_rediscovered(self, keys):
+        for dkm in keys.values():
+            self._put_key(dkm)
+        if self.cache:
+            self.cache.store(self, self._configured_keys)
+
+    def _put_key(self, dkm):
+        # NOTE: Indexes are replaced rather than mutated so callers
+        # iterating configured_keys never see them change underneath.
+        with self._keys_lock:
+            by_serial = dict(self._configured_keys)
+            by_id = dict(self._keys_by_id)
+            for old in (by_id.pop(dkm.key, None),
+                        by_serial.pop(dkm.serial, None)):
+                if old is not None:
+                    by_serial.pop(old.serial, None)
+                    by_id.pop(old.key, None)
+            by_serial[dkm.serial] = dkm
+            by_id[dkm.key] = dkm
+            self._configured_keys = by_serial
+            self._keys_by_id = by_id
+        logger.debug(f"DKM {dkm.serial} added at {dkm!r}")
+        self._notify(KEYS_EVENT_ADDED, dkm)
+
+    def _remove_key(self, key):
+        with self._keys_lock:
+            dkm = self._keys_by_id.get(key)
+            if dkm is None:
+                return
+            by_serial = dict(self._configured_keys)
+            by_id = dict(self._keys_by_id)
+            del by_serial[dkm.serial]
+            del by_id[key]
+            self._configured_keys = by_serial
+            self._keys_by_id = by_id
+        logger.debug(f"DKM {dkm.serial} removed from {dkm!r}")
+        self._notify(KEYS_EVENT_REMOVED, dkm)
+
+
+class DKMDiscovery:
+    """
+    Reads back the state of the DKMs attached to a board, either every slot
+    or just the ones in ``keys``.
+
+    Requests for all keys and facets (reports, macros, colors, firmware
+    versions) are pipelined through ``DuMangBoard.request``, keeping up to
+    ``window`` of them in flight. ``start()`` never blocks, so discovery can
+    also be driven from the receive thread.
+    """
+
+    def __init__(self, board, window=DEFAULT_DISCOVERY_WINDOW, keys=None):
+        self.board = board
+        self.window = max(1, window)
+        self.keys = range(MAX_KEYS) if keys is None else keys
+        self.timings = {}
+        self._start = None
+        self._phase_start = None
+        self._next_phase = None
+        self._lock = threading.RLock()
+        self._queued = deque()
+        self._outstanding = 0
+        self._found = []
+        self._result = None
+        self._on_finished = None
+        self._finished = threading.Event()
+
+    def _submit(self, request, on_response):
+        with self._lock:
+            self._queued.append((request, on_response))
+
+    def _pump(self):
+        with self._lock:
+            while self._queued and self._outstanding < self.window:
+                request, on_response = self._queued.popleft()
+                self._outstanding += 1
+                future = self.board.request(request)
+                future.add_done_callback(
+                    lambda f, cb=on_response: self._on_done(f, cb))
+
+            if self._queued or self._outstanding > 0:
+                return
+            phase, self._next_phase = self._next_phase, None
+
+        if phase is not None:
+            phase()
+
+    def _on_done(self, future, on_response):
+        with self._lock:
+            self._outstanding -= 1
+            if future.cancelled():
+                pass
+            elif future.exception() is not None:
+                logger.warning(f"Discovery: {future.exception()}")
+            else:
+                on_response(future.result())
+        self._pump()
+
+    def _on_report(self, p):
+        if any([kc.keycode != 0 for kc in p.layer_keycodes.values()]):
+            # NOTE: We add the layer_keycodes to the DKM
+            p.key.layer_keycodes = p.layer_keycodes
+            self._found.append(
+                DuMangKeyModule(p.key.key, p.layer_keycodes, p.serial))
+
+    def _on_macro(self, dkm, p):
+        if p.type.type not in [0, 0xFF]:
+            dkm.macro.append(Macro.frompacket(p))
+            if p.idx + 1 < MACRO_MAX_IDX - MACRO_MIN_IDX:
+                self._request_macro(dkm, p.idx + 1)
+
+    def _request_macro(self, dkm, idx):
+        self._submit(
+            MacroReportRequestPacket(dkm, idx),
+            self._timed("macros", lambda p: self._on_macro(dkm, p)),
+        )
+
+    def _on_color(self, dkm, p):
+        dkm.color = (p.red, p.green, p.blue)
+
+    def _on_info(self, dkm, p):
+        dkm.version = p.version
+
+    def _timed(self, facet, on_response):
+        # NOTE: A facet's time is when its last response arrived,
+        # measured from the start of the current phase.
+        def handler(p):
+            on_response(p)
+            self.timings[facet] = time.monotonic() - self._phase_start
+
+        return handler
+
+    def start(self, on_finished=None):
+        """Starts discovery. ``on_finished`` is called with the DKMs found, keyed by serial."""
+        self._on_finished = on_finished
+        self._start = self._phase_start = time.monotonic()
+        for k in self.keys:
+            self._submit(
+                DKMReportRequestPacket(k),
+                self._timed("reports", self._on_report),
+            )
+        self._next_phase = self._read_details
+        self._pump()
+
+    def _read_details(self):
+        # NOTE: Everything past the reports only depends on which DKMs
+        # exist, so macros, colors and versions share one pipeline.
+        self._result = {dkm.serial: dkm for dkm in sorted(self._found)}
+        self._phase_start = time.monotonic()
+        for dkm in self._result.values():
             if any([
                     kc.keycode == Keycode.MACRO
                     for kc in dkm.layer_keycodes.values()
             ]):
-                self.put(MacroReportRequestPacket(dkm, 0))
-                pending += 1
-
-            while pending > 0:
-                p = self.get()
-                if isinstance(p, MacroReportResponsePacket):
-                    pending -= 1
-                    if p.type.type not in [0, 0xFF]:
-                        dkm.macro.append(Macro.frompacket(p))
-                        self.put(MacroReportRequestPacket(dkm, p.idx + 1))
-                        pending += 1
-
-    def _handle_dkm_colors(self):
-        for _, dkm in self._configured_keys.items():
-            self.put(DKMColorRequestPacket(dkm))
-
-            p = self.get()
-            if isinstance(p, DKMColorResponsePacket):
-                dkm.color = (p.red, p.green, p.blue)
-
-    def _handle_dkm_info(self):
-        for _, dkm in self._configured_keys.items():
-            self.put(DKMInfoRequestPacket(dkm))
-
-            p = self.get()
-            if isinstance(p, DKMInfoResponsePacket):
-                dkm.version = p.version
-
-    @property
-    def configured_keys(self):
-        if not self._keys_initialized:
-            self._handle_dkm_reports()
-            self._handle_dkm_macros()
-            self._handle_dkm_colors()
-            self._handle_dkm_info()
+                self._request_macro(dkm, 0)
+            self._submit(
+                DKMColorRequestPacket(dkm),
+                self._timed("colors", lambda p, dkm=dkm: self._on_color(dkm, p)),
+            )
+            self._submit(
+                DKMInfoRequestPacket(dkm),
+                self._timed("info", lambda p, dkm=dkm: self._on_info(dkm, p)),
+            )
+        self._next_phase = self._finish
+        self._pump()
+
+    def _finish(self):
+        self.timings["total"] = time.monotonic() - self._start
+        for phase, elapsed in self.timings.items():
+            logger.debug(
+                f"Board {self.board.serial} discovery {phase}: {elapsed * 1000:.1f} ms"
+            )
 
-            self._keys_initialized = True
+        self._finished.set()
+        if self._on_finished is not None:
+            self._on_finished(self._result)
 
-        return self._configured_keys
+    def run(self):
+        """Runs discovery to completion and returns the DKMs found, keyed by serial."""
+        self.start()
+        self._finished.wait()
+        return self._result
 
 
 class DuMangPacket:
+    LAYOUT = None
+    """Precompiled ``struct`` layout of a report, starting at the command byte."""
+
+    malformed = Counter()
+    """Number of reports rejected by :meth:`parse`, keyed by command byte."""
+
+    RESPONSE_CMD = None
+    """Command byte the board answers a request with, if any."""
+
+    read_ns = None
+    """``time.monotonic_ns()`` at which a received packet was read."""
+
+    trace = None
+    """Told when the packet has been written, see ``stats.SyncTrace``."""
+
+    SEND_CLASS = SEND_INTERACTIVE
+    """Priority of the packet when queued for sending, see SendScheduler."""
 
     def __init__(self, cmd, rawbytes):
         self.cmd = cmd
@@ -713,42 +1714,53 @@ class DuMangPacket:
 
     @classmethod
     def parse(cls, rawbytes):
-        c = None
-        if rawbytes:
-            cmd = rawbytes[0]
-
-            if cmd == KEY_UP_CMD:
-                c = KeyDownPacket.fromrawbytes(rawbytes)
-            elif cmd == KEY_DOWN_CMD:
-                c = KeyUpPacket.fromrawbytes(rawbytes)
-            elif cmd == BOARD_INFO_RESPONSE_CMD:
-                c = BoardInfoResponsePacket.fromrawbytes(rawbytes)
-            elif cmd == DKM_INFO_RESPONSE_CMD:
-                c = DKMInfoResponsePacket.fromrawbytes(rawbytes)
-            elif cmd == DKM_COLOR_RESPONSE_CMD:
-                c = DKMColorResponsePacket.fromrawbytes(rawbytes)
-            elif cmd == LIGHT_PULSE_CMD:
-                c = LightPulsePacket.fromrawbytes(rawbytes)
-            elif cmd == DKM_REPORT_RESPONSE_CMD:
-                c = DKMReportResponsePacket.fromrawbytes(rawbytes)
-            elif cmd == DKM_ADDED_CMD:
-                c = DKMAddedPacket.fromrawbytes(rawbytes)
-            elif cmd == DKM_REMOVED_CMD:
-                c = DKMRemovedPacket.fromrawbytes(rawbytes)
-            elif cmd == MACRO_REPORT_RESPONSE_CMD:
-                c = MacroReportResponsePacket.fromrawbytes(rawbytes)
-            else:
-                c = cls(cmd, rawbytes[1:])
+        if not rawbytes:
+            return None
+
+        cmd = rawbytes[0]
+        decoder = PACKET_DECODERS.get(cmd)
+        if decoder is None:
+            return cls(cmd, rawbytes[1:])
+
+        if isinstance(rawbytes, list):
+            # NOTE: hid.device.read() returns a list of ints. Only copy
+            # the bytes covered by the layout, the rest is padding.
+            rawbytes = bytes(rawbytes[:decoder.LAYOUT.size])
 
-        return c
+        try:
+            return decoder.fromrawbytes(rawbytes)
+        except (struct.error, KeyError):
+            # NOTE: Short or garbled reports must never take down
+            # the receive thread.
+            DuMangPacket.malformed[cmd] += 1
+            logger.debug(f"Dropping malformed report CMD:{cmd:02X}")
+            return None
 
     def encode(self):
         pass
 
+    def match_key(self):
+        """
+        Pairs a response with the request it answers. Packets returning
+        ``None`` are matched in the order their requests were sent.
+        """
+        return None
+
+    def coalesce_key(self):
+        """
+        Identifies what an outgoing packet sets, so a later packet with the
+        same command and key supersedes it while both are queued. ``None``
+        means the packet is always sent.
+        """
+        return None
+
     def __repr__(self):
+        # NOTE: Outgoing packets have no rawbytes until encoded.
+        rawbytes = self.rawbytes if self.rawbytes is not None else (
+            self.encode() or [])
         return "{} - CMD:{:02X} raw:[{}]".format(
             self.__class__.__name__, self.cmd,
-            ", ".join(hex(x) for x in self.rawbytes))
+            ", ".join(hex(x) for x in rawbytes))
 
 
 class BoardInfoRequestPacket(DuMangPacket):
@@ -770,6 +1782,7 @@ class BoardInfoResponsePacket(DuMangPacket):
         0x02: 500,
         0x01: 1000
     }
+    LAYOUT = struct.Struct("3xBBBxB")
 
     def __init__(self, report_rate, nkro_enabled, version):
         super().__init__(BOARD_INFO_RESPONSE_CMD, None)
@@ -779,9 +1792,10 @@ class BoardInfoResponsePacket(DuMangPacket):
 
     @classmethod
     def fromrawbytes(cls, rawbytes):
-        # NOTE: rawbytes[7] is a bit-vector. We currently only know
+        major, minor, report_rate, flags = cls.LAYOUT.unpack_from(rawbytes)
+        # NOTE: flags is a bit-vector. We currently only know
         # that bit 3 corresponds to NKRO.
-        return cls(rawbytes[5], rawbytes[7] & 0b100, (rawbytes[3], rawbytes[4]))
+        return cls(report_rate, flags & 0b100, (major, minor))
 
     def __repr__(self):
         return "{} - CMD:{:02X} NKRO:{} Report Rate:{}".format(
@@ -789,6 +1803,7 @@ class BoardInfoResponsePacket(DuMangPacket):
 
 
 class DKMInfoRequestPacket(DuMangPacket):
+    RESPONSE_CMD = DKM_INFO_RESPONSE_CMD
 
     def __init__(self, key):
         super().__init__(DKM_INFO_REQUEST_CMD, None)
@@ -799,6 +1814,7 @@ class DKMInfoRequestPacket(DuMangPacket):
 
 
 class DKMInfoResponsePacket(DuMangPacket):
+    LAYOUT = struct.Struct("3xBB")
 
     def __init__(self, version):
         super().__init__(DKM_INFO_RESPONSE_CMD, None)
@@ -806,7 +1822,7 @@ class DKMInfoResponsePacket(DuMangPacket):
 
     @classmethod
     def fromrawbytes(cls, rawbytes):
-        return cls((rawbytes[3], rawbytes[4]))
+        return cls(cls.LAYOUT.unpack_from(rawbytes))
 
     def __repr__(self):
         return "{} - CMD:{:02X} Version:{}".format(self.__class__.__name__,
@@ -814,6 +1830,7 @@ class DKMInfoResponsePacket(DuMangPacket):
 
 
 class KeyDownPacket(DuMangPacket):
+    LAYOUT = struct.Struct("xBBB")
 
     def __init__(self, ID, flag, layer_info):
         super().__init__(KEY_UP_CMD, None)
@@ -823,7 +1840,7 @@ class KeyDownPacket(DuMangPacket):
 
     @classmethod
     def fromrawbytes(cls, rawbytes):
-        return cls(rawbytes[1], rawbytes[2], rawbytes[3])
+        return cls(*cls.LAYOUT.unpack_from(rawbytes))
 
     def __repr__(self):
         return "{} - CMD:{:02X} ID:{:02X} Flag:{:02X} LayerInfo:{:02X}".format(
@@ -832,6 +1849,7 @@ class KeyDownPacket(DuMangPacket):
 
 
 class KeyUpPacket(DuMangPacket):
+    LAYOUT = struct.Struct("xBBB")
 
     def __init__(self, ID, flag, layer_info):
         super().__init__(KEY_DOWN_CMD, None)
@@ -841,7 +1859,7 @@ class KeyUpPacket(DuMangPacket):
 
     @classmethod
     def fromrawbytes(cls, rawbytes):
-        return cls(rawbytes[1], rawbytes[2], rawbytes[3])
+        return cls(*cls.LAYOUT.unpack_from(rawbytes))
 
     def __repr__(self):
         return "{} - CMD:{:02X} ID:{:02X} Flag:{:02X} LayerInfo:{:02X}".format(
@@ -850,6 +1868,7 @@ class KeyUpPacket(DuMangPacket):
 
 
 class BoardSyncPacket(DuMangPacket):
+    SEND_CLASS = SEND_REALTIME
 
     def __init__(self, ID, layer_active, layer_info):
         super().__init__(BOARD_SYNC_CMD, None)
@@ -863,8 +1882,12 @@ class BoardSyncPacket(DuMangPacket):
             self.layer_info & 0x03, 0x00
         ]
 
+    def coalesce_key(self):
+        return (self.ID, self.layer_info)
+
 
 class LightPulsePacket(DuMangPacket):
+    LAYOUT = struct.Struct("xBB")
 
     def __init__(self, onoff, key):
         super().__init__(LIGHT_PULSE_CMD, None)
@@ -873,13 +1896,18 @@ class LightPulsePacket(DuMangPacket):
 
     @classmethod
     def fromrawbytes(cls, rawbytes):
-        return cls(bool(rawbytes[2] == 3), rawbytes[1])
+        key, onoff = cls.LAYOUT.unpack_from(rawbytes)
+        return cls(bool(onoff == 3), key)
 
     def encode(self):
         return [self.cmd, self.key.encode(), self.onoff, 0x0F, 0x0F, 0x0F]
 
+    def coalesce_key(self):
+        return self.key.key
+
 
 class DKMReportRequestPacket(DuMangPacket):
+    RESPONSE_CMD = DKM_REPORT_RESPONSE_CMD
 
     def __init__(self, key):
         super().__init__(DKM_REPORT_REQUEST_CMD, None)
@@ -888,8 +1916,12 @@ class DKMReportRequestPacket(DuMangPacket):
     def encode(self):
         return [self.cmd, self.key.encode(), 0x00, 0x00, 0x00]
 
+    def match_key(self):
+        return self.key.key
+
 
 class KeyReportBasePacket(DuMangPacket):
+    LAYOUT = struct.Struct(">xBIxBBBB")
 
     def __init__(self, cmd, key, layer_keycodes, serial):
         super().__init__(cmd, None)
@@ -899,19 +1931,21 @@ class KeyReportBasePacket(DuMangPacket):
 
     @classmethod
     def fromrawbytes(cls, rawbytes):
-        serial = (rawbytes[2] << 24) + (rawbytes[3] << 16) + (
-            rawbytes[4] << 8) + rawbytes[5]
+        key, serial, l0, l1, l2, l3 = cls.LAYOUT.unpack_from(rawbytes)
         return cls(
-            rawbytes[1],
+            key,
             {
-                0: Keycode(rawbytes[7]),
-                1: Keycode(rawbytes[8]),
-                2: Keycode(rawbytes[9]),
-                3: Keycode(rawbytes[10])
+                0: Keycode(l0),
+                1: Keycode(l1),
+                2: Keycode(l2),
+                3: Keycode(l3)
             },
             f"{serial:08X}",
         )
 
+    def match_key(self):
+        return self.key.key
+
     def __repr__(self):
         return "{} - CMD:{:02X} Key:{} Serial:{} LayerKeycodes:{}".format(
             self.__class__.__name__, self.cmd, self.key, self.serial,
@@ -949,6 +1983,7 @@ class DKMRemovedPacket(KeyReportBasePacket):
 
 
 class DKMConfigurePacket(DuMangPacket):
+    SEND_CLASS = SEND_BULK
 
     def __init__(self, key, layer_keycodes):
         super().__init__(DKM_CONFIGURE_CMD, None)
@@ -972,8 +2007,12 @@ class DKMConfigurePacket(DuMangPacket):
     def __repr__(self):
         return f"{self.__class__.__name__} - CMD:{self.cmd:02X} Key:{self.key} LayerKeycodes:{self.layer_keycodes}"
 
+    def coalesce_key(self):
+        return self.key.key
+
 
 class MacroReportRequestPacket(DuMangPacket):
+    RESPONSE_CMD = MACRO_REPORT_RESPONSE_CMD
 
     def __init__(self, key, idx):
         super().__init__(MACRO_REPORT_REQUEST_CMD, None)
@@ -986,8 +2025,12 @@ class MacroReportRequestPacket(DuMangPacket):
             self.key.encode(), self.idx + MACRO_MIN_IDX, 0x00, 0x00
         ]
 
+    def match_key(self):
+        return (self.key.key, self.idx)
+
 
 class MacroReportResponsePacket(DuMangPacket):
+    LAYOUT = struct.Struct(">xBBBBH")
 
     def __init__(self, key, idx, type_, keycode, delay):
         super().__init__(MACRO_REPORT_RESPONSE_CMD, None)
@@ -999,14 +2042,18 @@ class MacroReportResponsePacket(DuMangPacket):
 
     @classmethod
     def fromrawbytes(cls, rawbytes):
+        key, idx, type_, keycode, delay = cls.LAYOUT.unpack_from(rawbytes)
         return cls(
-            rawbytes[1],
-            rawbytes[2] - MACRO_MIN_IDX,
-            MacroType(rawbytes[3]),
-            Keycode(rawbytes[4]),
-            rawbytes[5] * 256 + rawbytes[6],
+            key,
+            idx - MACRO_MIN_IDX,
+            MacroType(type_),
+            Keycode(keycode),
+            delay,
         )
 
+    def match_key(self):
+        return (self.key.key, self.idx)
+
     def __repr__(self):
         return "{} - CMD:{:02X} Key:{} Idx:{} Type:{} Keycode:{} Delay:{}".format(
             self.__class__.__name__, self.cmd, self.key, self.idx, self.type,
@@ -1014,6 +2061,7 @@ class MacroReportResponsePacket(DuMangPacket):
 
 
 class MacroConfigurePacket(DuMangPacket):
+    SEND_CLASS = SEND_BULK
 
     def __init__(self, key, idx, type_, keycode, delay):
         super().__init__(MACRO_CONFIGURE_CMD, None)
@@ -1041,6 +2089,7 @@ class MacroConfigurePacket(DuMangPacket):
 
 
 class NKROConfigurePacket(DuMangPacket):
+    SEND_CLASS = SEND_BULK
 
     def __init__(self, onoff):
         super().__init__(NKRO_CONFIGURE_CMD, None)
@@ -1051,6 +2100,7 @@ class NKROConfigurePacket(DuMangPacket):
 
 
 class ReportRateConfigurePacket(DuMangPacket):
+    SEND_CLASS = SEND_BULK
 
     REPORT_RATES = {
         100: 0x0A,
@@ -1080,6 +2130,7 @@ class ReportRateConfigurePacket(DuMangPacket):
 
 
 class DKMColorRequestPacket(DuMangPacket):
+    RESPONSE_CMD = DKM_COLOR_RESPONSE_CMD
 
     def __init__(self, key):
         super().__init__(DKM_COLOR_REQUEST_CMD, None)
@@ -1090,6 +2141,7 @@ class DKMColorRequestPacket(DuMangPacket):
 
 
 class DKMColorResponsePacket(DuMangPacket):
+    LAYOUT = struct.Struct("3xBBB")
 
     def __init__(self, red, green, blue):
         super().__init__(DKM_COLOR_RESPONSE_CMD, None)
@@ -1100,7 +2152,7 @@ class DKMColorResponsePacket(DuMangPacket):
     @classmethod
     def fromrawbytes(cls, rawbytes):
         # TODO: It's possible the key is encoded in this packet type.
-        return cls(rawbytes[3], rawbytes[4], rawbytes[5])
+        return cls(*cls.LAYOUT.unpack_from(rawbytes))
 
     def __repr__(self):
         return "{} - CMD:{:02X} Color: ({}, {}, {})".format(
@@ -1108,6 +2160,7 @@ class DKMColorResponsePacket(DuMangPacket):
 
 
 class DKMColorConfigurePacket(DuMangPacket):
+    SEND_CLASS = SEND_BULK
 
     def __init__(self, key, red, green, blue):
         super().__init__(DKM_COLOR_CONFIGURE_CMD, None)
@@ -1123,26 +2176,217 @@ class DKMColorConfigurePacket(DuMangPacket):
             self.key.encode(), 0x00, self.red, self.green, self.blue
         ]
 
+    def coalesce_key(self):
+        return self.key.key
+
+
+# NOTE: Keyed by the command byte at the start of a report.
+# Anything not listed here is parsed as a generic DuMangPacket.
+PACKET_DECODERS = {
+    KEY_UP_CMD: KeyDownPacket,
+    KEY_DOWN_CMD: KeyUpPacket,
+    BOARD_INFO_RESPONSE_CMD: BoardInfoResponsePacket,
+    DKM_INFO_RESPONSE_CMD: DKMInfoResponsePacket,
+    DKM_COLOR_RESPONSE_CMD: DKMColorResponsePacket,
+    LIGHT_PULSE_CMD: LightPulsePacket,
+    DKM_REPORT_RESPONSE_CMD: DKMReportResponsePacket,
+    DKM_ADDED_CMD: DKMAddedPacket,
+    DKM_REMOVED_CMD: DKMRemovedPacket,
+    MACRO_REPORT_RESPONSE_CMD: MacroReportResponsePacket,
+}
+
 
 def signal_handler(signal, frame):
     sys.exit(0)
 
 
-def initialize_devices():
-    init_devices = []
+class HIDRawDevice:
+    """
+    A stand-in for ``hid.device`` that talks to a Linux hidraw node directly.
+
+    Writes and reads go straight to the node exactly as hidapi's hidraw
+    backend does. Reads block in ``poll()`` on both the node and a wakeup
+    pipe, so a blocked reader is released by ``cancel()`` instead of having
+    to wake up periodically to check whether it should stop.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._poll = select.poll()
+        self._poll.register(self.fd, select.POLLIN)
+        self._poll.register(self._wakeup_r, select.POLLIN)
+        self._closed = False
+
+    @classmethod
+    def open(cls, path):
+        return cls(os.open(path, os.O_RDWR | os.O_CLOEXEC))
+
+    @staticmethod
+    def supports(path):
+        return sys.platform.startswith("linux") and path.startswith(
+            b"/dev/hidraw")
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        return os.write(self.fd, bytes(data))
+
+    def read(self, max_length, timeout_ms=None):
+        # NOTE: Like hid.device, no timeout means block until data arrives.
+        for fd, event in self._poll.poll(timeout_ms):
+            if fd == self._wakeup_r:
+                return b""
+            if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                raise OSError("Device disconnected")
+            return os.read(self.fd, max_length)
+        return b""
+
+    def cancel(self):
+        """Wakes up any blocked reader. Every read after this returns immediately."""
+        if not self._closed:
+            os.write(self._wakeup_w, b"\x00")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for fd in (self.fd, self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class HIDBackend:
+    """Finds boards with hidapi and opens them through hidraw where possible."""
+
+    def enumerate(self):
+        return hid.enumerate(VENDOR_ID, PRODUCT_ID)
+
+    def open(self, path):
+        if HIDRawDevice.supports(path):
+            return HIDRawDevice.open(path)
+
+        h = hid.device()
+        h.open_path(path)
+        return h
+
+    def locate(self, bus, address, timeout=HIDRAW_SETTLE_S):
+        """
+        Returns the enumerate() entry of the control interface of the USB
+        device at ``bus``/``address``, found through sysfs rather than a
+        full hid.enumerate(), or None if it has no hidraw node.
+        """
+        if not os.path.isdir(SYSFS_HIDRAW):
+            return None
+        # NOTE: udev creates the hidraw node a little after libusb reports
+        # the device, so give it a moment to show up.
+        deadline = time.monotonic() + timeout
+        while True:
+            d = self._find_hidraw(bus, address)
+            if d is not None or time.monotonic() >= deadline:
+                return d
+            time.sleep(HIDRAW_POLL_S)
+
+    @staticmethod
+    def _find_hidraw(bus, address):
+        for name in os.listdir(SYSFS_HIDRAW):
+            try:
+                # NOTE: hidrawN/device is the HID device, its parent the
+                # USB interface and that one's parent the USB device.
+                hid_dev = os.path.realpath(
+                    os.path.join(SYSFS_HIDRAW, name, "device"))
+                intf = os.path.dirname(hid_dev)
+                usb_dev = os.path.dirname(intf)
+                if (_read_sysfs(usb_dev, "busnum") != str(bus) or
+                        _read_sysfs(usb_dev, "devnum") != str(address) or
+                        int(_read_sysfs(intf, "bInterfaceNumber"), 16) != 1):
+                    continue
+                serial = _read_sysfs(usb_dev, "serial")
+            except (OSError, ValueError):
+                continue
+            return {
+                "path": f"/dev/{name}".encode(),
+                "serial_number": serial,
+                "interface_number": 1,
+            }
+        return None
+
+
+def _read_sysfs(path, name):
+    with open(os.path.join(path, name)) as f:
+        return f.read().strip()
+
+
+# NOTE: Where find_devices() and open_device() get boards from. Anything
+# with enumerate() and open(path) works, see simulator.SimulatorBackend.
+device_backend = None
+
+
+def get_device_backend():
+    global device_backend
+    if device_backend is None:
+        if os.environ.get(SIMULATOR_ENV):
+            from .simulator import SimulatorBackend
+            device_backend = SimulatorBackend.fromenv(
+                os.environ[SIMULATOR_ENV])
+        else:
+            device_backend = HIDBackend()
+    return device_backend
+
+
+def open_device(path):
+    return get_device_backend().open(path)
 
-    device_list = hid.enumerate(VENDOR_ID, PRODUCT_ID)
+
+def find_devices():
+    """Returns the hid.enumerate() entries for each board's control interface."""
+    device_list = get_device_backend().enumerate()
 
     ctrl_device = []
     for d in device_list:
         if d["interface_number"] == 1:
             ctrl_device.append(d)
 
-    for d in ctrl_device:
+    return ctrl_device
+
+
+def find_device(detected=None, exclude=()):
+    """
+    Returns the find_devices() entry of a board the monitor ``detected``.
+    Backends that can't locate it directly fall back to enumerating, by
+    its serial or else the first board whose serial is not in ``exclude``.
+    """
+    backend = get_device_backend()
+    locate = getattr(backend, "locate", None)
+    if detected is not None and locate is not None:
+        d = locate(detected.bus, detected.address)
+        if d is not None:
+            return d
+
+    serial = getattr(detected, "serial", None)
+    for d in find_devices():
+        if serial is not None:
+            if d["serial_number"] == serial:
+                return d
+        elif d["serial_number"] not in exclude:
+            return d
+    return None
+
+
+def initialize_devices(capture=None):
+    """Opens every board. ``capture`` is an optional capture.CaptureWriter."""
+    init_devices = []
+
+    for d in find_devices():
         try:
-            h = hid.device()
-            h.open_path(d["path"])
-            b = DuMangBoard(d["serial_number"], h)
+            h = open_device(d["path"])
+            serial = d["serial_number"]
+            b = DuMangBoard(serial,
+                            h,
+                            capture=capture.channel(serial) if capture else None)
             init_devices.append(b)
 
         except OSError as ex:
@@ -1153,28 +2397,168 @@ def initialize_devices():
     return init_devices
 
 
-class NoHotplugSupport(Exception):
-    pass
+def discover_boards(kbds):
+    """
+    Reads the DKMs of every board at the same time and returns their
+    ``configured_keys`` in the order of ``kbds``.
+    """
+    if len(kbds) < 2:
+        return [kbd.configured_keys for kbd in kbds]
+    # NOTE: configured_keys blocks until its board is read, and each board
+    # has its own send/receive threads, so one waiter per board is enough.
+    with ThreadPoolExecutor(max_workers=len(kbds),
+                            thread_name_prefix="discovery") as pool:
+        return list(pool.map(lambda kbd: kbd.configured_keys, kbds))
+
+
+def boottime_offset():
+    """
+    Seconds CLOCK_BOOTTIME is ahead of CLOCK_MONOTONIC, which grows by the
+    time spent suspended. None where there is no CLOCK_BOOTTIME.
+    """
+    boottime = getattr(time, "CLOCK_BOOTTIME", None)
+    if boottime is None:
+        return None
+    return time.clock_gettime(boottime) - time.monotonic()
+
+
+class ResumeDetector:
+    """
+    Notices the system was suspended since the last call to resumed().
+    ``clock`` stands in for boottime_offset(), eg. in benchmarks.
+    """
+
+    def __init__(self, clock=boottime_offset):
+        self._clock = clock
+        self._offset = clock()
+
+    def resumed(self):
+        offset = self._clock()
+        if offset is None or self._offset is None:
+            return False
+        slept = offset - self._offset
+        self._offset = offset
+        return slept >= SUSPEND_THRESHOLD_S
+
+
+# NOTE: From <sys/timerfd.h>, see ClockSetWatcher.
+TFD_CLOEXEC = 0o2000000
+TFD_NONBLOCK = 0o4000
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+CLOCK_REALTIME = 0
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class _Itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _Timespec), ("it_value", _Timespec)]
+
+
+class ClockSetWatcher:
+    """
+    Calls back whenever CLOCK_REALTIME is set, which the kernel also does
+    on every resume from suspend. A thread sleeps on a timerfd armed with
+    TFD_TIMER_CANCEL_ON_SET, far in the future, which wakes up only then.
+    Where there is no timerfd, it never calls back.
+    """
+
+    def __init__(self):
+        self._fd = None
+        self._thread = None
+        self._callback = None
+        self._stop_r = self._stop_w = None
+
+    def start(self, callback):
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            fd = self._libc.timerfd_create(CLOCK_REALTIME,
+                                           TFD_CLOEXEC | TFD_NONBLOCK)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd < 0 or not self._arm(fd):
+            logger.debug("No timerfd, resumes are noticed on the next wakeup")
+            if fd >= 0:
+                os.close(fd)
+            return
+        self._fd = fd
+        self._callback = callback
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _arm(self, fd):
+        # NOTE: About a century ahead, so it never expires on its own.
+        spec = _Itimerspec()
+        spec.it_value.tv_sec = int(time.time()) + 100 * 365 * 86400
+        return self._libc.timerfd_settime(
+            fd, TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET,
+            ctypes.byref(spec), None) == 0
+
+    def _run(self):
+        while True:
+            r, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in r:
+                return
+            try:
+                os.read(self._fd, 8)
+                was_set = False
+            except BlockingIOError:
+                continue
+            except OSError as ex:
+                if ex.errno != errno.ECANCELED:
+                    logger.error(f"Clock watch failed: {ex}")
+                    return
+                was_set = True
+            # NOTE: Cancelling disarms it.
+            self._arm(self._fd)
+            if was_set:
+                self._callback()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        os.write(self._stop_w, b"\0")
+        self._thread.join()
+        for fd in (self._fd, self._stop_r, self._stop_w):
+            os.close(fd)
+        self._thread = None
 
 
-class TooManyBoards(Exception):
+class NoHotplugSupport(Exception):
     pass
 
 
 class DetectedDevice:
 
-    def __init__(self, handle, on_close):
+    def __init__(self, handle, on_close, arrived_ns=None):
         self._handle = handle
         self._on_close = on_close
+        device = handle.getDevice()
+        # NOTE: What its hidraw node is found by, see find_device().
+        self.bus = device.getBusNumber()
+        self.address = device.getDeviceAddress()
+        # NOTE: When libusb reported it, before it settled.
+        self.arrived_ns = arrived_ns or time.monotonic_ns()
 
     def __str__(self):
         return "USB Detected Device at " + str(self._handle.getDevice())
 
+    @property
+    def serial(self):
+        # NOTE: Asks the device, so not for use in the hotplug callback.
+        try:
+            return self._handle.getSerialNumber()
+        except usb1.USBError:
+            return None
+
     def close(self):
         # Note: device may have already left when this method is called,
         # so catch USBErrorNoDevice around cleanup steps involving the device.
         try:
-            self.on_close(self)
+            self._on_close(self)
         except usb1.USBErrorNoDevice:
             pass
         self._handle.close()
@@ -1184,10 +2568,25 @@ class USBConnectionMonitor:
     """
     Manages the hotplug events.
     Monitors the arrival and departure of USB devices.
+
+    Events are debounced: a device is only notified once it stayed arrived
+    or left for ``settle_s`` after its last event, and one that arrived and
+    left again within that window is never notified at all. ``context``
+    stands in for a usb1.USBContext, eg. simulator.FakeUSBContext.
+
+    Only boards with one of the ``serials`` are notified, None allows
+    any. Of those, boards beyond ``max_boards`` are ignored, None allows
+    any number.
     """
 
-    def __init__(self, vendor_id, product_id):
-        self.context = usb1.USBContext()
+    def __init__(self,
+                 vendor_id,
+                 product_id,
+                 context=None,
+                 settle_s=HOTPLUG_SETTLE_S,
+                 max_boards=2,
+                 serials=None):
+        self.context = context or usb1.USBContext()
         if not self.context.hasCapability(usb1.CAP_HAS_HOTPLUG):
             raise NoHotplugSupport(
                 "Hotplug support is missing. Please update your libusb version."
@@ -1196,18 +2595,30 @@ class USBConnectionMonitor:
         self.vendor_id = vendor_id
         self.product_id = product_id
         self.notify_q = queue.Queue()
-        self._notify_threshold = 2
-        self._has_started = False
+        self.max_boards = max_boards
+        self.serials = serials
+        self.settle_s = settle_s
+        self.stats = Counter()
+        """Hotplug ``events`` seen, ``coalesced`` into a later one, and ``ready``/``wait``/``rejected``/``unknown`` boards."""
+        # NOTE: The latest (arrived, event ns, deadline) of each device
+        # that has not settled yet.
+        self._pending = {}
+        self._pending_cond = threading.Condition()
+        self._settler = None
+        self._settler_stopped = False
 
     def _on_device_left(self, detected_device):
         logger.debug(f"Device left: {detected_device!s}")
 
-    def _on_device_arrived(self, handle):
-        detected_device = DetectedDevice(handle, self._on_device_left)
+    def _on_device_arrived(self, handle, arrived_ns=None):
+        detected_device = DetectedDevice(handle, self._on_device_left,
+                                         arrived_ns)
         logger.debug(f"Device arrived: {detected_device!s}")
         return detected_device
 
     def _register_callback(self):
+        self._settler = threading.Thread(target=self._settle, daemon=True)
+        self._settler.start()
         self._callback_handle = self.context.hotplugRegisterCallback(
             self._on_hotplug_event,
             events=usb1.HOTPLUG_EVENT_DEVICE_ARRIVED
@@ -1218,46 +2629,134 @@ class USBConnectionMonitor:
 
     def _deregister_callback(self):
         self.context.hotplugDeregisterCallback(self._callback_handle)
+        with self._pending_cond:
+            self._settler_stopped = True
+            self._pending_cond.notify()
+        if self._settler and self._settler is not threading.current_thread():
+            self._settler.join()
 
     def _on_hotplug_event(self, context, device, event):
-        if event == usb1.HOTPLUG_EVENT_DEVICE_LEFT:
-            device_from_event = self._device_dict.pop(device, None)
-            if device_from_event is not None:
-                device_from_event.close()
-            self._update_status()
+        # NOTE: Runs inside libusb, so it only records the event for
+        # _settle() and must never raise.
+        try:
+            arrived = event == usb1.HOTPLUG_EVENT_DEVICE_ARRIVED
+            now_ns = time.monotonic_ns()
+            with self._pending_cond:
+                self.stats["events"] += 1
+                if device in self._pending:
+                    self.stats["coalesced"] += 1
+                self._pending[device] = (arrived, now_ns,
+                                         now_ns / 1e9 + self.settle_s)
+                self._pending_cond.notify()
+        except Exception:
+            logger.exception("Failed to handle hotplug event")
+
+    @property
+    def settling(self):
+        """Whether any device has events that have not settled yet."""
+        with self._pending_cond:
+            return bool(self._pending)
+
+    def _settled(self):
+        """Waits for and returns the (device, arrived, event ns) that settled, None once stopped."""
+        with self._pending_cond:
+            while not self._settler_stopped:
+                now = time.monotonic()
+                deadlines = [v[2] for v in self._pending.values()]
+                if deadlines and min(deadlines) <= now:
+                    settled = [(device, arrived, ns)
+                               for device, (arrived, ns, deadline) in
+                               self._pending.items() if deadline <= now]
+                    for device, _, _ in settled:
+                        del self._pending[device]
+                    return settled
+                self._pending_cond.wait(
+                    min(deadlines) - now if deadlines else None)
+            return None
+
+    def _settle(self):
+        while True:
+            settled = self._settled()
+            if settled is None:
+                return
+            # NOTE: Boards that left first, so ones arriving in their place
+            # are not turned away for being one too many.
+            for device, arrived, arrived_ns in sorted(
+                    settled, key=lambda s: s[1]):
+                try:
+                    if arrived:
+                        self._arrived(device, arrived_ns)
+                    else:
+                        self._left(device)
+                except Exception:
+                    logger.exception(f"Failed to handle hotplug of {device}")
+
+    def _left(self, device):
+        detected_device = self._device_dict.pop(device, None)
+        if detected_device is None:
+            # NOTE: Arrived and left again within the settle window.
+            return
+        detected_device.close()
+        self.stats["wait"] += 1
+        self.wait(detected_device)
+
+    def _arrived(self, device, arrived_ns):
+        if device in self._device_dict:
+            return
+        if self.serials is None and self._full(device):
             return
         try:
             handle = device.open()
         except usb1.USBError as ex:
             logger.error(ex, exc_info=True)
             return
-        self._device_dict[device] = self._on_device_arrived(handle)
-        self._update_status()
-
-    def _update_status(self):
-        total_connected = len(self._device_dict)
-        if total_connected == self._notify_threshold:
-            self._has_started = True
-            self.ready()
-        elif total_connected < self._notify_threshold:
-            if self._has_started:
-                self.wait()
-        else:
-            raise TooManyBoards(
-                "Too many boards connected. Not sure how to handle it.")
-
-    def ready(self):
-        self.notify_q.put(NOTIFY_STATUS_READY)
-
-    def wait(self):
-        self.notify_q.put(NOTIFY_STATUS_WAIT)
+        if self.serials is not None:
+            # NOTE: Checked before the cap, so boards in no pair never
+            # take the place of one that is.
+            try:
+                serial = handle.getSerialNumber()
+            except usb1.USBError:
+                serial = None
+            if serial not in self.serials:
+                self.stats["unknown"] += 1
+                logger.debug(f"Ignoring board {serial}, it is in no pair")
+                handle.close()
+                return
+            if self._full(device):
+                handle.close()
+                return
+        detected_device = self._on_device_arrived(handle, arrived_ns)
+        self._device_dict[device] = detected_device
+        self.stats["ready"] += 1
+        self.ready(detected_device)
+
+    def _full(self, device):
+        if (self.max_boards is None or
+                len(self._device_dict) < self.max_boards):
+            return False
+        self.stats["rejected"] += 1
+        logger.error(f"More than {self.max_boards} boards connected, "
+                     f"ignoring {device}. Pair them in a pairs file.")
+        return True
+
+    # NOTE: Every board that arrives or leaves is notified on its own,
+    # with its DetectedDevice, so only that board has to be reopened.
+    def ready(self, device=None):
+        self.notify_q.put((NOTIFY_STATUS_READY, device))
+
+    def wait(self, device=None):
+        self.notify_q.put((NOTIFY_STATUS_WAIT, device))
+
+    def get_event(self):
+        """Returns the next (status, DetectedDevice), the device is None for a stop."""
+        return self.notify_q.get()
 
     def get_status(self):
-        return self.notify_q.get()
+        return self.get_event()[0]
 
     def stop(self):
         self._deregister_callback()
-        self.notify_q.put(NOTIFY_STATUS_STOP)
+        self.notify_q.put((NOTIFY_STATUS_STOP, None))
 
     def join(self):
         pass
@@ -1269,8 +2768,8 @@ class USBConnectionMonitorRunner(USBConnectionMonitor):
     Simplest API, for userland drivers which only react to USB events.
     """
 
-    def __init__(self, vendor_id, product_id):
-        super().__init__(vendor_id, product_id)
+    def __init__(self, vendor_id, product_id, **kwargs):
+        super().__init__(vendor_id, product_id, **kwargs)
         self._observer = threading.Thread(target=self._run, daemon=True)
         self._shutdown_flag = threading.Event()
 
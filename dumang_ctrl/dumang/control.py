@@ -0,0 +1,317 @@
+"""
+Control socket of the ``dumang-sync`` daemon.
+
+The daemon owns the board handles and their DKM state, and serves it to
+``dumang-config`` over a Unix socket instead of each tool opening and
+reading the boards itself. Every message is a frame: a 4 byte big-endian
+length and that many bytes of UTF-8 JSON. A request is an object with an
+``op`` and its arguments, answered by ``{"ok": true, "result": ...}`` or
+``{"ok": false, "error": ..., "errors": [...]}``.
+"""
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+from .cache import decode_dkm, encode_dkm
+from .common import *
+
+logger = logging.getLogger(__name__)
+
+CONTROL_SOCKET_ENV = "DUMANG_CONTROL_SOCKET"
+CONTROL_SOCKET_NAME = "dumang-ctrl.sock"
+# NOTE: A verified load of two full boards can take a few seconds.
+CONTROL_TIMEOUT_S = 60
+
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+OP_DUMP = "dump"
+OP_LOAD = "load"
+OP_PULSE = "pulse"
+
+
+class ControlError(Exception):
+    """A request the daemon could not serve. ``errors`` lists config problems."""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or [message]
+
+
+def default_socket_path():
+    path = os.environ.get(CONTROL_SOCKET_ENV)
+    if path:
+        return Path(path)
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / CONTROL_SOCKET_NAME
+    return fallback_socket_dir() / CONTROL_SOCKET_NAME
+
+
+def fallback_socket_dir():
+    return Path(tempfile.gettempdir()) / f"dumang-ctrl-{os.getuid()}"
+
+
+def check_socket_dir(path):
+    """
+    Raises ControlError unless the directory of the socket at ``path`` is
+    this user's alone. Only checked for fallback_socket_dir(): anyone can
+    create it first and plant a socket that configs would be sent to.
+    """
+    directory = path.parent
+    if directory != fallback_socket_dir():
+        return
+    st = os.lstat(directory)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            stat.S_IMODE(st.st_mode) != 0o700):
+        raise ControlError(
+            f"{directory} is not a directory only this user can access")
+
+
+def _recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def read_frame(sock):
+    """Returns the next message, or None once the other end has closed."""
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is too large")
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        return None
+    return json.loads(payload)
+
+
+def write_frame(sock, message):
+    payload = json.dumps(message, separators=(",", ":")).encode()
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def board_state(kbd):
+    """What a RemoteBoard is built from, see OP_DUMP."""
+    version = getattr(kbd, "version", None)
+    return {
+        "serial": kbd.serial,
+        "nkro": kbd.nkro,
+        "report_rate": kbd.report_rate,
+        "version": list(version) if version is not None else None,
+        "keys": [encode_dkm(dkm) for dkm in kbd.configured_keys.values()],
+    }
+
+
+class ControlServer:
+    """
+    Serves ``handlers``, a dict of op to a function taking the request and
+    returning the result, on a Unix socket. Each connection gets a thread.
+    """
+
+    def __init__(self, handlers, path=None):
+        self.handlers = handlers
+        self.path = Path(path) if path is not None else default_socket_path()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        check_socket_dir(self.path)
+        if self.path.exists():
+            probe = ControlClient.connect(self.path)
+            if probe is not None:
+                probe.close()
+                raise ControlError(f"A daemon is already serving {self.path}")
+            # NOTE: Left behind by a daemon that did not exit cleanly.
+            self.path.unlink()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self._sock.bind(str(self.path))
+        finally:
+            os.umask(old_umask)
+        self._sock.listen()
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        logger.debug(f"Control socket listening on {self.path}")
+
+    def close(self):
+        if self._sock is None:
+            return
+        # NOTE: shutdown() wakes up the thread blocked in accept().
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._thread.join()
+        self._sock = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = read_frame(conn)
+                    if request is None:
+                        return
+                    write_frame(conn, self.handle(request))
+                except (OSError, ValueError) as ex:
+                    logger.debug(f"Control connection closed: {ex}")
+                    return
+
+    def handle(self, request):
+        op = request.get("op") if isinstance(request, dict) else None
+        handler = self.handlers.get(op)
+        if handler is None:
+            return {"ok": False, "error": f"Unknown op {op}", "errors": []}
+        try:
+            return {"ok": True, "result": handler(request)}
+        except ControlError as ex:
+            return {"ok": False, "error": str(ex), "errors": ex.errors}
+        except Exception as ex:
+            logger.error(f"Control request {op} failed", exc_info=True)
+            return {"ok": False, "error": str(ex), "errors": [str(ex)]}
+
+
+class ControlClient:
+    """One connection to the daemon. Calls are serialized."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, path=None):
+        """Returns a client, or None if no daemon is listening."""
+        path = Path(path) if path is not None else default_socket_path()
+        try:
+            check_socket_dir(path)
+        except FileNotFoundError:
+            return None
+        except ControlError as ex:
+            logger.warning(f"Not connecting to {path}: {ex}")
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONTROL_TIMEOUT_S)
+        try:
+            sock.connect(str(path))
+        except OSError:
+            sock.close()
+            return None
+        return cls(sock)
+
+    def call(self, op, **args):
+        with self._lock:
+            write_frame(self._sock, {"op": op, **args})
+            response = read_frame(self._sock)
+        if response is None:
+            raise ControlError("Daemon closed the connection")
+        if not response["ok"]:
+            raise ControlError(response["error"], response.get("errors"))
+        return response["result"]
+
+    def boards(self):
+        return [RemoteBoard(self, state) for state in self.call(OP_DUMP)]
+
+    def load(self, cfg, plan_only=False, verify=True):
+        return RemotePlan(
+            self.call(OP_LOAD, cfg=cfg, plan_only=plan_only, verify=verify))
+
+    def pulse(self, serial, key, onoff):
+        self.call(OP_PULSE, board=serial, key=key, on=onoff)
+
+    def close(self):
+        self._sock.close()
+
+
+class RemoteBoard:
+    """
+    Stands in for a DuMangBoard owned by the daemon, with the DKM state
+    it had when the client connected. Only light pulses can be requested.
+    """
+
+    def __init__(self, client, state):
+        self.client = client
+        self.serial = state["serial"]
+        self.nkro = state["nkro"]
+        self.report_rate = state["report_rate"]
+        if state["version"] is not None:
+            self.version = tuple(state["version"])
+        self.configured_keys = {
+            d["serial"]: decode_dkm(d)
+            for d in state["keys"]
+        }
+        self.discovery_timings = {}
+        self.cache = None
+
+    def request(self, packet, *args, **kwargs):
+        if not isinstance(packet, LightPulsePacket):
+            raise ControlError(
+                f"{packet.__class__.__name__} cannot be sent to the daemon")
+        future = Future()
+        try:
+            self.client.pulse(self.serial, packet.key.key, packet.onoff == 0x03)
+            future.set_result(None)
+        except (OSError, ControlError) as ex:
+            future.set_exception(ex)
+        return future
+
+    def drain(self, timeout=None):
+        return set()
+
+    def request_stats(self):
+        return {}
+
+    def subscribe(self, callback):
+        pass
+
+    def unsubscribe(self, callback):
+        pass
+
+    def kill_threads(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RemotePlan:
+    """The outcome of OP_LOAD, with the attributes of a ConfigPlan that tools print."""
+
+    def __init__(self, result):
+        self.keys = result["keys"]
+        self.packets = result["packets"]
+        self.saved = result["saved"]
+        self.failed = result["failed"]
+        self._lines = result["plan"]
+
+    def describe(self):
+        return iter(self._lines)
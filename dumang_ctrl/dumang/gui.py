@@ -7,6 +7,9 @@ from .common import *
 
 class KBDTableView(QTableWidget):
     itemLeave = pyqtSignal()
+    # NOTE: Emitted from the board's receive thread, Qt queues it
+    # onto the GUI thread.
+    keysChanged = pyqtSignal()
 
     HEADERS = ["Key Module Serial", "Layer 0", "Layer 1", "Layer 2", "Layer 3"]
 
@@ -17,6 +20,7 @@ class KBDTableView(QTableWidget):
         self.resizeColumnsToContents()
         self.resizeRowsToContents()
         self._last_item = None
+        self._pulsing_key = None
         self.viewport().installEventFilter(self)
         self.horizontalHeader().setStretchLastSection(True)
         self.horizontalHeader().setStretchLastSection(True)
@@ -53,21 +57,33 @@ class KBDTableView(QTableWidget):
         # NOTE: The lack of itemLeave/Exited requires us to track last item.
         # Previous solution as descriped in https://stackoverflow.com/questions/20064975
         # proved problematic when scrolling as it would trigger Enter events, but no Leave events.
-        if item != self._last_item and self._last_item is not None:
-            p = LightPulsePacket(
-                False, self.keys[self.item(self._last_item.row(),
-                                           0).data(0)].key)
-            kbd.put(p)
-
-        p = LightPulsePacket(True, self.keys[self.item(item.row(),
-                                                       0).data(0)].key)
-        kbd.put(p)
+        if item != self._last_item:
+            self._stop_pulse(kbd)
+
+        key = self.keys[self.item(item.row(), 0).data(0)].key
+        kbd.request(LightPulsePacket(True, key))
         self._last_item = item
+        self._pulsing_key = key
+
+    def _stop_pulse(self, kbd):
+        # NOTE: The key is kept rather than looked up from _last_item, whose
+        # row may be gone once the keys changed.
+        if self._pulsing_key is not None:
+            kbd.request(LightPulsePacket(False, self._pulsing_key))
+        self._last_item = None
+        self._pulsing_key = None
+
+    def _on_keysChanged(self, kbd):
+        self._stop_pulse(kbd)
+        self.keys = kbd.configured_keys
+        self.clearContents()
+        self.setRowCount(len(self.keys))
+        self.setData()
 
     def _on_itemLeave(self, kbd):
-        p = LightPulsePacket(
-            False, self.keys[self.item(self._last_item.row(), 0).data(0)].key)
-        kbd.put(p)
+        if self._last_item is None:
+            return
+        self._stop_pulse(kbd)
 
 
 class KBDWidget(QWidget):
@@ -85,6 +101,9 @@ class KBDWidget(QWidget):
         kbd_widget.itemEntered.connect(
             lambda item: kbd_widget._on_itemEntered(kbd, item))
         kbd_widget.itemLeave.connect(lambda: kbd_widget._on_itemLeave(kbd))
+        kbd_widget.keysChanged.connect(
+            lambda: kbd_widget._on_keysChanged(kbd))
+        kbd.subscribe(lambda *_: kbd_widget.keysChanged.emit())
         return kbd_widget
 
     def hideLayout(self, n):
@@ -0,0 +1,463 @@
+"""
+A simulated DK6 board half, for benchmarking and testing without hardware.
+
+``SimulatedBoard`` is a ``HIDRawDevice`` whose other end is a thread
+playing the board's firmware, so it has the same ``write``/``read``/
+``close`` surface as ``hid.device`` and also works with blocking reads,
+``cancel()`` and the asyncio boards.
+
+Set ``DUMANG_SIMULATOR`` to have ``initialize_devices()`` use simulated
+boards instead of real ones. It is a comma separated list of
+``name=value`` options (see ``SimulatorBackend.fromenv``), eg.
+
+    $ DUMANG_SIMULATOR="boards=2,keys=22,latency_ms=1,loss=0.01" dumang-config dump
+
+``FakeUSBContext`` likewise stands in for the ``usb1.USBContext`` of
+``USBConnectionMonitor``, replaying hotplug events such as the ones
+``hotplug_storm()`` makes up.
+"""
+import heapq
+import logging
+import os
+import queue
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+
+import usb1
+
+from .common import *
+
+logger = logging.getLogger(__name__)
+
+SIMULATOR_PATH_PREFIX = b"sim:"
+
+# NOTE: Unwritten macro steps read back as erased flash.
+ERASED_MACRO_STEP = (0xFF, 0x00, 0x0000)
+
+REPORT_RATE_CODES = {
+    rate: code
+    for code, rate in BoardInfoResponsePacket.REPORT_RATES.items()
+}
+
+
+class SimulatedDKM:
+    """State of one Key Module plugged into a simulated board."""
+
+    def __init__(self, serial, layers, macro=None, color=(0, 0, 0),
+                 version=(1, 0)):
+        self.serial = serial
+        self.layers = list(layers)
+        self.macro = dict(enumerate(macro or []))
+        self.color = tuple(color)
+        self.version = tuple(version)
+
+    def macro_step(self, idx):
+        return self.macro.get(idx, ERASED_MACRO_STEP)
+
+    def report(self, cmd, key):
+        return struct.pack(">BBIxBBBB", cmd, key, self.serial, *self.layers)
+
+
+def default_dkms(count, macro_len=4, serial_base=0x10000000):
+    """``count`` DKMs in the first slots, every third one with a macro."""
+    dkms = {}
+    for key in range(count):
+        has_macro = key % 3 == 0 and macro_len > 0
+        layers = [
+            Keycode.MACRO if has_macro else Keycode.A + key % 26,
+            Keycode.LAYER_TOGGLE_1 if key % 4 == 0 else Keycode.TRANSPARENT,
+            Keycode.TRANSPARENT,
+            Keycode.A + (key + 1) % 26,
+        ]
+        macro = [(MacroType.KEYDOWN, Keycode.A + i, MACRO_MIN_DELAY_MS + i)
+                 for i in range(macro_len)] if has_macro else []
+        dkms[key] = SimulatedDKM(serial_base + key, layers, macro,
+                                 (key % 16, 0x0F, 15 - key % 16),
+                                 (1, key % 4))
+    return dkms
+
+
+class SimulatedBoard(HIDRawDevice):
+    """
+    A board half answering every request command in ``common`` the way
+    the firmware does, and emitting key and DKM add/remove events on
+    demand.
+
+    ``latency_ms`` delays every report the board sends and ``loss`` is the
+    probability that a report, in either direction, is silently dropped.
+    ``rate`` caps the reports per second the firmware keeps up with, after
+    a burst of ``burst``. Reports beyond that are dropped, like an overrun.
+    """
+
+    def __init__(self,
+                 serial="SIM0",
+                 dkms=None,
+                 version=(1, 2),
+                 nkro=True,
+                 report_rate=DEFAULT_REPORT_RATE,
+                 latency_ms=0.0,
+                 loss=0.0,
+                 seed=None,
+                 rate=None,
+                 burst=16):
+        host, self._peer = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_SEQPACKET)
+        super().__init__(os.dup(host.fileno()))
+        host.close()
+
+        self.serial = serial
+        self.dkms = default_dkms(MAX_KEYS // 2) if dkms is None else dkms
+        self.version = version
+        self.nkro = nkro
+        self.report_rate = report_rate
+        self.latency_ms = latency_ms
+        self.loss = loss
+        self.rate = rate
+        self.burst = burst
+        self.overruns = 0
+        """Reports dropped because they arrived faster than ``rate``."""
+        self.received = Counter()
+        """Number of reports the board has accepted, keyed by command byte."""
+        self.synced = []
+        """BoardSyncPackets received from the other half, as raw bytes."""
+        self.pulsing = set()
+        """Keys whose light is currently pulsing."""
+        self.frozen = False
+        """Whether it stopped answering, see freeze()."""
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._seq = 0
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._wake_r, self._wake_w = os.pipe()
+        self._firmware = threading.Thread(target=self._run, daemon=True)
+        self._firmware.start()
+
+    def close(self):
+        super().close()
+        self.unplug()
+
+    def unplug(self):
+        """Stops the firmware and hangs up, like a board gone from under an open handle."""
+        if self._firmware.is_alive():
+            os.write(self._wake_w, b"\0")
+            self._firmware.join()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+
+    def freeze(self):
+        """Stops answering without hanging up, like a handle gone silent across a suspend."""
+        with self._lock:
+            self.frozen = True
+            self._pending.clear()
+
+    def key_down(self, ID, layer_info):
+        # NOTE: The command bytes are swapped, see KeyDownPacket.
+        self._emit(bytes([KEY_UP_CMD, ID, 0x01, layer_info]))
+
+    def key_up(self, ID, layer_info):
+        self._emit(bytes([KEY_DOWN_CMD, ID, 0x01, layer_info]))
+
+    def add_dkm(self, key, dkm):
+        with self._lock:
+            self.dkms[key] = dkm
+        self._emit(dkm.report(DKM_ADDED_CMD, key))
+
+    def remove_dkm(self, key):
+        with self._lock:
+            dkm = self.dkms.pop(key)
+        self._emit(dkm.report(DKM_REMOVED_CMD, key))
+
+    def _emit(self, report):
+        with self._lock:
+            self._emit_locked(report)
+        os.write(self._wake_w, b"\1")
+
+    def _emit_locked(self, report):
+        if self.frozen:
+            return
+        if self.loss and self._random.random() < self.loss:
+            return
+        due = time.monotonic() + self.latency_ms / 1000
+        heapq.heappush(self._pending, (due, self._seq, report))
+        self._seq += 1
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._peer, select.POLLIN)
+        poller.register(self._wake_r, select.POLLIN)
+
+        while True:
+            with self._lock:
+                due = self._pending[0][0] if self._pending else None
+            timeout = None if due is None else max(
+                0, (due - time.monotonic()) * 1000)
+
+            for fd, event in poller.poll(timeout):
+                if fd == self._wake_r:
+                    if b"\0" in os.read(self._wake_r, 64):
+                        self._peer.close()
+                        return
+                    continue
+                try:
+                    data = self._peer.recv(64)
+                except OSError:
+                    data = b""
+                if not data:
+                    self._peer.close()
+                    return
+                if self.loss and self._random.random() < self.loss:
+                    continue
+                if self.rate and not self._take_token():
+                    self.overruns += 1
+                    continue
+                self._handle(data)
+
+            now = time.monotonic()
+            while True:
+                with self._lock:
+                    if not self._pending or self._pending[0][0] > now:
+                        break
+                    _, _, report = heapq.heappop(self._pending)
+                try:
+                    self._peer.send(report.ljust(64, b"\0"))
+                except OSError:
+                    return
+
+    def _take_token(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _handle(self, data):
+        data = data.ljust(8, b"\0")
+        cmd = data[0]
+        self.received[cmd] += 1
+
+        with self._lock:
+            if cmd == BOARD_INFO_REQUEST_CMD:
+                self._emit_locked(
+                    bytes([
+                        BOARD_INFO_RESPONSE_CMD, 0x00, 0x00, *self.version,
+                        REPORT_RATE_CODES[self.report_rate], 0x00,
+                        0b100 if self.nkro else 0x00
+                    ]))
+            elif cmd == DKM_REPORT_REQUEST_CMD:
+                dkm = self.dkms.get(data[1])
+                if dkm is None:
+                    dkm = SimulatedDKM(0, [0x00] * MAX_LAYERS)
+                self._emit_locked(dkm.report(DKM_REPORT_RESPONSE_CMD, data[1]))
+            elif cmd == DKM_INFO_REQUEST_CMD:
+                dkm = self.dkms.get(data[1])
+                version = dkm.version if dkm else (0, 0)
+                self._emit_locked(
+                    bytes([DKM_INFO_RESPONSE_CMD, 0x00, 0x00, *version]))
+            elif cmd == DKM_COLOR_REQUEST_CMD:
+                dkm = self.dkms.get(data[1])
+                color = dkm.color if dkm else (0, 0, 0)
+                self._emit_locked(
+                    bytes([DKM_COLOR_RESPONSE_CMD, 0x00, 0x00, *color]))
+            elif cmd == MACRO_REPORT_REQUEST_CMD:
+                dkm = self.dkms.get(data[1])
+                idx = data[2] - MACRO_MIN_IDX
+                step = dkm.macro_step(idx) if dkm else ERASED_MACRO_STEP
+                self._emit_locked(
+                    struct.pack(">BBBBBH", MACRO_REPORT_RESPONSE_CMD, data[1],
+                                data[2], *step))
+            elif cmd == DKM_CONFIGURE_CMD:
+                # NOTE: Keys are addressed off by one here, see
+                # DKMConfigurePacket.
+                dkm = self.dkms.get(data[1] - 1)
+                if dkm:
+                    dkm.layers = [data[6], data[2], data[3], data[4]]
+            elif cmd == MACRO_CONFIGURE_CMD:
+                dkm = self.dkms.get(data[1])
+                if dkm:
+                    dkm.macro[data[2] - MACRO_MIN_IDX] = (
+                        data[3], data[4], data[5] * 256 + data[6])
+            elif cmd == DKM_COLOR_CONFIGURE_CMD:
+                dkm = self.dkms.get(data[1])
+                if dkm:
+                    dkm.color = (data[3] % 16, data[4] % 16, data[5] % 16)
+            elif cmd == NKRO_CONFIGURE_CMD:
+                self.nkro = bool(data[3])
+            elif cmd == REPORT_RATE_CONFIGURE_CMD:
+                self.report_rate = BoardInfoResponsePacket.REPORT_RATES.get(
+                    data[2], self.report_rate)
+            elif cmd == LIGHT_PULSE_CMD:
+                if data[2] == 0x03:
+                    self.pulsing.add(data[1])
+                else:
+                    self.pulsing.discard(data[1])
+            elif cmd == BOARD_SYNC_CMD:
+                self.synced.append(bytes(data))
+            else:
+                logger.debug(f"Simulated board ignoring CMD:{cmd:02X}")
+
+
+class SimulatorBackend:
+    """Stands in for hidapi in find_devices()/open_device(), see DUMANG_SIMULATOR."""
+
+    def __init__(self, boards):
+        self.boards = boards
+
+    @classmethod
+    def fromenv(cls, value):
+        """
+        Builds boards from ``DUMANG_SIMULATOR``. Options are ``boards``
+        (default 2), ``keys`` per board (default 22), ``macro_len``
+        (default 4), ``latency_ms``, ``loss``, ``seed``, ``rate`` and
+        ``burst``. Any value without options, eg. ``1``, uses the
+        defaults.
+        """
+        options = dict(
+            o.split("=", 1) for o in value.split(",") if "=" in o)
+        count = int(options.get("boards", 2))
+        keys = int(options.get("keys", MAX_KEYS // 2))
+        macro_len = int(options.get("macro_len", 4))
+        latency_ms = float(options.get("latency_ms", 0))
+        loss = float(options.get("loss", 0))
+        seed = options.get("seed")
+        rate = float(options["rate"]) if "rate" in options else None
+        burst = int(options.get("burst", 16))
+
+        boards = []
+        for n in range(count):
+            boards.append(
+                SimulatedBoard(
+                    serial=f"SIM{n}",
+                    dkms=default_dkms(
+                        keys, macro_len, serial_base=0x10000000 + n * 0x100),
+                    latency_ms=latency_ms,
+                    loss=loss,
+                    seed=None if seed is None else f"{seed}/{n}",
+                    rate=rate,
+                    burst=burst))
+        return cls(boards)
+
+    def enumerate(self):
+        return [{
+            "path": SIMULATOR_PATH_PREFIX + str(n).encode(),
+            "serial_number": board.serial,
+            "interface_number": 1,
+        } for n, board in enumerate(self.boards)]
+
+    def open(self, path):
+        return self.boards[int(path[len(SIMULATOR_PATH_PREFIX):])]
+
+
+class FakeUSBDevice:
+    """Stands in for the usb1.USBDevice of a board in FakeUSBContext."""
+
+    def __init__(self, serial, bus=1, address=1):
+        self.serial = serial
+        self.bus = bus
+        self.address = address
+
+    def __repr__(self):
+        return f"FakeUSBDevice({self.serial!r}, {self.bus}, {self.address})"
+
+    def getBusNumber(self):
+        return self.bus
+
+    def getDeviceAddress(self):
+        return self.address
+
+    def open(self):
+        return FakeUSBHandle(self)
+
+
+class FakeUSBHandle:
+    """Stands in for a usb1.USBDeviceHandle of a FakeUSBDevice."""
+
+    def __init__(self, device):
+        self._device = device
+
+    def getDevice(self):
+        return self._device
+
+    def getSerialNumber(self):
+        return self._device.serial
+
+    def close(self):
+        pass
+
+
+class FakeUSBContext:
+    """
+    Stands in for usb1.USBContext with hotplug support. Events passed to
+    replay() are delivered to the registered callbacks from
+    handleEvents(), like libusb does.
+    """
+
+    def __init__(self):
+        self._callbacks = {}
+        self._events = queue.Queue()
+        self._next_handle = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def hasCapability(self, capability):
+        return capability == usb1.CAP_HAS_HOTPLUG
+
+    def hotplugRegisterCallback(self, callback, events, vendor_id=None,
+                                product_id=None):
+        self._next_handle += 1
+        self._callbacks[self._next_handle] = (callback, events)
+        return self._next_handle
+
+    def hotplugDeregisterCallback(self, handle):
+        self._callbacks.pop(handle, None)
+        # NOTE: Wakes handleEvents(), the way deregistering does in libusb.
+        self._events.put(None)
+
+    def handleEvents(self):
+        event = self._events.get()
+        if event is None:
+            return
+        device, kind = event
+        for handle, (callback, events) in list(self._callbacks.items()):
+            if events & kind and callback(self, device, kind):
+                self._callbacks.pop(handle, None)
+
+    def replay(self, events, interval_s=0):
+        """Delivers each (FakeUSBDevice, HOTPLUG_EVENT_*) of ``events``, ``interval_s`` apart."""
+        for event in events:
+            self._events.put(event)
+            if interval_s:
+                time.sleep(interval_s)
+
+
+def hotplug_storm(devices, flaps, seed=None):
+    """
+    The hotplug events of ``flaps`` times a board in ``devices`` bouncing,
+    like on a flaky hub or a half inserted cable. Each time it leaves and
+    comes back at a new address, and all of them are back at the end.
+    Returns the events and the devices the boards are last at.
+    """
+    rand = random.Random(seed)
+    devices = list(devices)
+    events = []
+    for _ in range(flaps):
+        n = rand.randrange(len(devices))
+        old = devices[n]
+        devices[n] = FakeUSBDevice(old.serial, old.bus, old.address + 1)
+        events.append((old, usb1.HOTPLUG_EVENT_DEVICE_LEFT))
+        events.append((devices[n], usb1.HOTPLUG_EVENT_DEVICE_ARRIVED))
+    return events, devices
@@ -0,0 +1,185 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# NOTE: Each power of two is split into 2**(SUB_BUCKET_BITS - 1) linear
+# buckets, so a recorded value is off by at most ~1.6%. Values are
+# nanoseconds and anything above HISTOGRAM_MAX_NS (~68s) is clamped.
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+HISTOGRAM_MAX_NS = (1 << 36) - 1
+HISTOGRAM_BUCKETS = ((HISTOGRAM_MAX_NS.bit_length() - SUB_BUCKET_BITS) *
+                     SUB_BUCKET_HALF + SUB_BUCKET_COUNT)
+
+STAGE_QUEUE = "queue"
+"""Read from a board until picked up by the sync thread."""
+STAGE_CONVERT = "convert"
+"""Picked up until turned into a BoardSyncPacket."""
+STAGE_WRITE = "write"
+"""Turned into a BoardSyncPacket until written to the other board."""
+STAGE_TOTAL = "total"
+SYNC_STAGES = (STAGE_QUEUE, STAGE_CONVERT, STAGE_WRITE, STAGE_TOTAL)
+STAGE_RESTORE = "restore"
+"""A board arriving until layer changes are synced again, once per connect."""
+
+
+def _bucket(ns):
+    exp = ns.bit_length() - SUB_BUCKET_BITS
+    if exp <= 0:
+        return ns
+    return exp * SUB_BUCKET_HALF + (ns >> exp)
+
+
+def _highest_equivalent(idx):
+    if idx < SUB_BUCKET_COUNT:
+        return idx
+    exp, mantissa = divmod(idx, SUB_BUCKET_HALF)
+    exp -= 1
+    mantissa += SUB_BUCKET_HALF
+    return ((mantissa + 1) << exp) - 1
+
+
+def _to_us(ns):
+    return None if ns is None else round(ns / 1000, 1)
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket log-linear histogram of latencies in nanoseconds, along
+    the lines of HdrHistogram. Recording is constant time and memory does
+    not grow with the number of samples.
+    """
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def record(self, ns):
+        ns = min(max(ns, 0), HISTOGRAM_MAX_NS)
+        self.counts[_bucket(ns)] += 1
+        self.count += 1
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        target = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(_highest_equivalent(idx), self.max)
+
+    def merge(self, other):
+        for idx, n in enumerate(other.counts):
+            self.counts[idx] += n
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "p50_us": _to_us(self.percentile(50)),
+            "p99_us": _to_us(self.percentile(99)),
+            "max_us": _to_us(self.max if self.count else None),
+        }
+
+
+class SyncTrace:
+    """Timestamps of one layer change on its way from ``board`` to the other half."""
+
+    __slots__ = ("stats", "board", "read_ns", "dequeued_ns", "converted_ns")
+
+    def __init__(self, stats, board, read_ns, dequeued_ns, converted_ns):
+        self.stats = stats
+        self.board = board
+        self.read_ns = read_ns
+        self.dequeued_ns = dequeued_ns
+        self.converted_ns = converted_ns
+
+    def written(self, written_ns):
+        self.stats.record(self, written_ns)
+
+
+class PipelineStats:
+    """
+    Per-stage latency histograms of the sync pipeline, keyed by the serial
+    of the board a layer change was read from.
+
+    ``dequeued_ns`` is None for changes that never went through a queue
+    (eg. the fast path), in which case only the other stages are recorded.
+    How long each board took to be synced again after it was plugged in is
+    kept alongside, as STAGE_RESTORE.
+    """
+
+    def __init__(self):
+        # NOTE: Reentrant as dump() runs from a signal handler, possibly
+        # on a thread that is in the middle of record().
+        self._lock = threading.RLock()
+        self.histograms = defaultdict(
+            lambda: {stage: LatencyHistogram() for stage in SYNC_STAGES})
+        self.restores = defaultdict(LatencyHistogram)
+
+    def trace(self, board, read_ns, dequeued_ns=None):
+        return SyncTrace(self, board, read_ns, dequeued_ns,
+                         time.monotonic_ns())
+
+    def record(self, trace, written_ns):
+        with self._lock:
+            h = self.histograms[trace.board]
+            if trace.dequeued_ns is not None:
+                h[STAGE_QUEUE].record(trace.dequeued_ns - trace.read_ns)
+                h[STAGE_CONVERT].record(trace.converted_ns -
+                                        trace.dequeued_ns)
+            else:
+                h[STAGE_CONVERT].record(trace.converted_ns - trace.read_ns)
+            h[STAGE_WRITE].record(written_ns - trace.converted_ns)
+            h[STAGE_TOTAL].record(written_ns - trace.read_ns)
+
+    def restored(self, board, ns):
+        with self._lock:
+            self.restores[board].record(ns)
+
+    def summary(self):
+        with self._lock:
+            summary = {
+                str(board): {
+                    stage: h.summary()
+                    for stage, h in stages.items()
+                } for board, stages in self.histograms.items()
+            }
+            for board, h in self.restores.items():
+                summary.setdefault(str(board), {})[STAGE_RESTORE] = h.summary()
+            return summary
+
+    def log(self, log=logger):
+        summary = self.summary()
+        if not summary:
+            log.info("No layer changes recorded yet")
+        for board, stages in summary.items():
+            for stage, s in stages.items():
+                if not s["count"]:
+                    continue
+                log.info(f"Board {board} {stage:<7} n={s['count']} "
+                         f"p50={s['p50_us']}us p99={s['p99_us']}us "
+                         f"max={s['max_us']}us")
+
+    def dump(self, path):
+        path = Path(path)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.summary(), f, indent=2)
+            os.replace(tmp, path)
+        except OSError as ex:
+            logger.warning(f"Could not write stats to {path}: {ex}")
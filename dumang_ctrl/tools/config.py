@@ -1,13 +1,19 @@
+import asyncio
 import click
 import logging
 import signal
 import sys
 import json
+import time
 import yaml
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import dumang_ctrl as pkginfo
 from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.cache import DiscoveryCache, encode_dkm
+from dumang_ctrl.dumang.capture import CaptureWriter
+from dumang_ctrl.dumang.control import ControlClient, ControlError
 
 logger = logging.getLogger("DuMang Config")
 logger.setLevel(logging.INFO)
@@ -29,8 +35,18 @@ CFG_JSON_FORMAT = "json"
 CFG_FORMATS = [CFG_YAML_FORMAT, CFG_JSON_FORMAT]
 DEFAULT_CFG_FORMAT = CFG_YAML_FORMAT
 
+# NOTE: How long load waits for queued writes to reach the boards.
+LOAD_TIMEOUT_S = 10
+# NOTE: Longest a batch of writes or its readbacks may take, past the
+# retries of each request.
+VERIFY_TIMEOUT_S = 10
+
 CTX_KEYBOARDS_KEY = "KEYBOARDS"
 CTX_THREADS_KEY = "THREADS"
+CTX_ASYNCIO_KEY = "ASYNCIO"
+CTX_WINDOW_KEY = "WINDOW"
+CTX_CAPTURE_KEY = "CAPTURE"
+CTX_REMOTE_KEY = "REMOTE"
 
 
 class NestedDict(OrderedDict):
@@ -63,137 +79,531 @@ def init_receive_threads(kbds):
     return [Job(target=kbd.receive_thread, daemon=True) for kbd in kbds]
 
 
-def find_kbd_by_serial(kbds, serial):
-    for kbd in kbds:
-        if kbd.serial == serial:
-            return kbd
-    return None
-
-
-def find_key_by_serial(kbd, serial):
-    return kbd.configured_keys.get(serial, None)
-
-
-def configure_layers(board, key, cfg_key):
-    layer_keycodes = {}
-    for layer in cfg_key:
-        if not layer.startswith(LABEL_LAYER_PREFIX):
-            continue
-        layer_int = int(layer.split(LABEL_LAYER_PREFIX[-1])[1])
-        layer_keycodes[layer_int] = Keycode.fromstr(cfg_key[layer])
+def log_discovery_timings(kbd):
+    timings = ", ".join(f"{phase} {elapsed * 1000:.0f} ms"
+                        for phase, elapsed in kbd.discovery_timings.items())
+    if timings:
+        logger.info(f"Board {kbd.serial} discovery: {timings}")
 
-    if (key.layer_keycodes != layer_keycodes):
-        logger.debug(
-            f"Configuring DKM serial {cfg_key[LABEL_SERIAL]} to {layer_keycodes}"
-        )
-        board.put(DKMConfigurePacket(key, layer_keycodes))
-        return True
 
-    return False
+def log_request_stats(kbd):
+    for cmd, stats in kbd.request_stats().items():
+        logger.debug(f"Board {kbd.serial} CMD:{cmd:02X} {stats}")
+    if hasattr(kbd, "send_stats"):
+        for name, stats in kbd.send_stats().items():
+            logger.debug(f"Board {kbd.serial} send {name} {stats}")
 
 
-def configure_macro(board, key, cfg_key):
-    cfg_macro = cfg_key.get(LABEL_MACRO)
-    if cfg_macro:
-        cfg_macro_obj_list = [
-            Macro(m[LABEL_KEY], idx, m[LABEL_TYPE], int(m[LABEL_DELAY_MS]))
-            for idx, m in enumerate(cfg_macro)
-        ]
+class ConfigError(Exception):
+    """A config file that cannot be applied, with every problem found in it."""
 
-        if key.macro != cfg_macro_obj_list:
-            logger.debug(
-                f"Configuring DKM serial {cfg_key[LABEL_SERIAL]} macro")
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} error(s) in config")
+        self.errors = errors
 
-            for m in cfg_macro_obj_list:
-                board.put(m.topacket(key.key))
-            board.put(
-                MacroConfigurePacket(key.key,
-                                     len(cfg_macro_obj_list) + 1, MacroType(0),
-                                     Keycode(0), 0))
-            return True
 
-    return False
+class KeyConfig:
+    """One validated DKM entry of a config file."""
 
+    def __init__(self, serial, board_serial, layer_keycodes, macro, color):
+        self.serial = serial
+        self.board_serial = board_serial
+        self.layer_keycodes = layer_keycodes
+        self.macro = macro
+        self.color = color
 
-def configure_color(board, key, cfg_key):
-    cfg_color = cfg_key.get(LABEL_COLOR, None)
-    if cfg_color and isinstance(cfg_color, str):
-        red, green, blue = tuple(int(cfg_color[i:i + 2], 16) for i in (0, 2, 4))
-        if key.color != (red, green, blue):
-            board.put(DKMColorConfigurePacket(key.key, red, green, blue))
-            logger.debug(
-                f"Configuring DKM serial {cfg_key[LABEL_SERIAL]} color to #{cfg_color}"
-            )
-            return True
 
-    return False
+class BoardConfig:
+    """One validated board entry of a config file."""
 
+    def __init__(self, serial, nkro, report_rate, keys):
+        self.serial = serial
+        self.nkro = nkro
+        self.report_rate = report_rate
+        self.keys = keys
 
-def configure_key(board, key, cfg_key):
-    did_configure = configure_layers(board, key, cfg_key)
-    did_configure |= configure_macro(board, key, cfg_key)
-    did_configure |= configure_color(board, key, cfg_key)
-
-    if not did_configure:
-        logger.debug(
-            f"DKM serial {cfg_key[LABEL_SERIAL]} already properly configured")
-
-    return did_configure
 
+def parse_layers(cfg_key, errors, where):
+    layer_keycodes = {}
+    for layer, keystr in cfg_key.items():
+        if not isinstance(layer, str):
+            errors.append(f"{where}: unknown setting {layer}")
+            continue
+        if not layer.startswith(LABEL_LAYER_PREFIX):
+            continue
+        try:
+            layer_int = int(layer[len(LABEL_LAYER_PREFIX):])
+        except ValueError:
+            layer_int = None
+        if layer_int not in range(MAX_LAYERS):
+            errors.append(f"{where}: unknown layer {layer}")
+            continue
+        keycode = Keycode.fromstr(keystr)
+        if keycode is None:
+            errors.append(f"{where}: unknown keycode {keystr} for {layer}")
+            continue
+        layer_keycodes[layer_int] = keycode
+    return layer_keycodes
 
-def configure_keys(cfg_kbd, kbds):
-    n = 0
-    for k in cfg_kbd[LABEL_KEYS]:
-        cfg_key = k[LABEL_KEY]
 
-        key_serial = cfg_key.get(LABEL_SERIAL, None)
-        if key_serial is None:
-            logger.error(f"DKM config without serial {k}")
-            sys.exit(1)
+def parse_macro(cfg_key, errors, where):
+    cfg_macro = cfg_key.get(LABEL_MACRO)
+    if not cfg_macro:
+        return None
+    if not isinstance(cfg_macro, list):
+        errors.append(f"{where}: macro is not a list of steps")
+        return None
+    # NOTE: The terminator takes one more step, see KeyChange.packets().
+    if len(cfg_macro) > MACRO_MAX_IDX - MACRO_MIN_IDX - 1:
+        errors.append(f"{where}: macro has {len(cfg_macro)} steps, at most "
+                      f"{MACRO_MAX_IDX - MACRO_MIN_IDX - 1} fit")
+        return None
+
+    macro = []
+    for idx, m in enumerate(cfg_macro):
+        step = f"{where} macro step {idx}"
+        if not isinstance(m, dict):
+            errors.append(f"{step}: not a {LABEL_TYPE}/{LABEL_KEY}/"
+                          f"{LABEL_DELAY_MS} mapping")
+            continue
+        n_errors = len(errors)
+        keycode = Keycode.fromstr(m.get(LABEL_KEY))
+        type_ = MacroType.fromstr(m.get(LABEL_TYPE))
+        try:
+            delay = int(m.get(LABEL_DELAY_MS))
+        except (TypeError, ValueError):
+            delay = None
+        if keycode is None:
+            errors.append(f"{step}: unknown keycode {m.get(LABEL_KEY)}")
+        if type_ is None:
+            errors.append(f"{step}: unknown type {m.get(LABEL_TYPE)}")
+        if delay is None or not MACRO_MIN_DELAY_MS <= delay <= MACRO_MAX_DELAY_MS:
+            errors.append(f"{step}: delay_ms {m.get(LABEL_DELAY_MS)} is not "
+                          f"between {MACRO_MIN_DELAY_MS} and {MACRO_MAX_DELAY_MS}")
+        if len(errors) == n_errors:
+            macro.append(Macro(keycode, idx, type_, delay))
+    return macro
+
+
+def parse_color(cfg_key, errors, where):
+    cfg_color = cfg_key.get(LABEL_COLOR)
+    if cfg_color is None:
+        return None
+    try:
+        if not isinstance(cfg_color, str) or len(cfg_color) != 6:
+            raise ValueError
+        red, green, blue = tuple(int(cfg_color[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        errors.append(f"{where}: color {cfg_color} is not an RRGGBB hex string")
+        return None
+    # NOTE: Compare the way the LEDs store it, see DKMColorConfigurePacket.
+    return (red % 16, green % 16, blue % 16)
+
+
+def parse_config(cfg):
+    """Validates a whole config up front, raising ConfigError on any problem."""
+    errors = []
+    boards = []
+    seen = set()
+    if not isinstance(cfg, list):
+        raise ConfigError(["config is not a list of boards"])
+
+    for n, cfg_kbd in enumerate(cfg):
+        cfg_board = cfg_kbd.get(LABEL_BOARD) if isinstance(cfg_kbd,
+                                                           dict) else None
+        if not isinstance(cfg_board, dict):
+            errors.append(f"entry {n}: not a board")
+            continue
+        board_serial = cfg_board.get(LABEL_SERIAL)
+        where = f"board {board_serial}"
+
+        nkro = cfg_board.get(LABEL_NKRO)
+        if nkro is not None and not isinstance(nkro, bool):
+            errors.append(f"{where}: nkro {nkro} is not true or false")
+            nkro = None
+        report_rate = cfg_board.get(LABEL_REPORT_RATE)
+        if (report_rate is not None and
+                report_rate not in ReportRateConfigurePacket.REPORT_RATES):
+            errors.append(
+                f"{where}: report_rate {report_rate} is not one of "
+                f"{list(ReportRateConfigurePacket.REPORT_RATES)}")
+            report_rate = None
+
+        keys = []
+        for k in cfg_board.get(LABEL_KEYS) or []:
+            cfg_key = k.get(LABEL_KEY) if isinstance(k, dict) else None
+            if not isinstance(cfg_key, dict):
+                errors.append(f"{where}: {k} is not a key")
+                continue
+            key_serial = cfg_key.get(LABEL_SERIAL)
+            if key_serial is None:
+                errors.append(f"{where}: DKM config without serial {k}")
+                continue
+            key_where = f"{where} DKM {key_serial}"
+            if key_serial in seen:
+                errors.append(f"{key_where}: configured more than once")
+                continue
+            seen.add(key_serial)
+            keys.append(
+                KeyConfig(key_serial, board_serial,
+                          parse_layers(cfg_key, errors, key_where),
+                          parse_macro(cfg_key, errors, key_where),
+                          parse_color(cfg_key, errors, key_where)))
+        boards.append(BoardConfig(board_serial, nkro, report_rate, keys))
+
+    if errors:
+        raise ConfigError(errors)
+    return boards
+
+
+def _macro_step_check(m):
+    return lambda p: (p.type, p.keycode, p.delay) == (m.type, m.keycode,
+                                                      m.delay)
+
+
+class KeyChange:
+    """What has to be written to one DKM for it to match its config."""
+
+    def __init__(self, board, dkm):
+        self.board = board
+        self.dkm = dkm
+        self.layer_keycodes = None
+        self.macro = None
+        self.macro_steps = []
+        """Steps of ``macro`` that differ from what the DKM holds."""
+        self.macro_terminated = False
+        self.color = None
+
+    @property
+    def saved(self):
+        """Macro packets skipped compared with rewriting the whole macro."""
+        if self.macro is None:
+            return 0
+        return len(self.macro) + 1 - len(self.macro_steps) - int(
+            self.macro_terminated)
+
+    def writes(self):
+        """
+        Each packet to write, with the request that reads it back and a
+        check of the response.
+        """
+        key = self.dkm.key
+        writes = []
+        if self.layer_keycodes is not None:
+            writes.append(
+                (DKMConfigurePacket(self.dkm, self.layer_keycodes),
+                 DKMReportRequestPacket(key),
+                 lambda p: p.layer_keycodes == self.layer_keycodes))
+        for m in self.macro_steps:
+            writes.append((m.topacket(key), MacroReportRequestPacket(key, m.idx),
+                           _macro_step_check(m)))
+        if self.macro_terminated:
+            # NOTE: The step right after the last one ends the macro.
+            idx = len(self.macro)
+            writes.append(
+                (MacroConfigurePacket(key, idx, MacroType(0), Keycode(0), 0),
+                 MacroReportRequestPacket(key, idx),
+                 lambda p: p.type.type == 0))
+        if self.color is not None:
+            writes.append(
+                (DKMColorConfigurePacket(key, *self.color),
+                 DKMColorRequestPacket(key),
+                 lambda p: (p.red, p.green, p.blue) == tuple(self.color)))
+        return writes
+
+    def packets(self):
+        return [p for p, _, _ in self.writes()]
+
+    def macro_readbacks(self):
+        """
+        Each request reading back the whole macro, up to and including
+        the step that ends it, with a check of the response.
+        """
+        key = self.dkm.key
+        reads = [(MacroReportRequestPacket(key, m.idx), _macro_step_check(m))
+                 for m in self.macro]
+        end = len(self.macro)
+        if end < MACRO_MAX_IDX - MACRO_MIN_IDX:
+            # NOTE: Discovery stops at either, see DKMDiscovery._on_macro.
+            reads.append((MacroReportRequestPacket(key, end),
+                          lambda p: p.type.type in (0, 0xFF)))
+        return reads
+
+    def update(self):
+        # NOTE: The in-memory DKM is updated as packets are queued.
+        if self.layer_keycodes is not None:
+            self.dkm.layer_keycodes = self.layer_keycodes
+        if self.macro is not None:
+            self.dkm.macro = self.macro
+        if self.color is not None:
+            self.dkm.color = self.color
+
+    def apply(self):
+        logger.debug(f"Configuring DKM serial {self.dkm.serial}")
+        for p in self.packets():
+            self.board.request(p)
+        self.update()
+
+
+class BoardChange:
+    """Every write one board needs, in the order they are sent."""
+
+    def __init__(self, board):
+        self.board = board
+        self.keys = []
+        self.nkro = None
+        self.report_rate = None
+        self.resent = 0
+
+    def packets(self):
+        packets = [p for change in self.keys for p in change.packets()]
+        if self.nkro is not None:
+            packets.append(NKROConfigurePacket(self.nkro))
+        if self.report_rate is not None:
+            packets.append(ReportRateConfigurePacket(self.report_rate))
+        return packets
+
+    def apply(self):
+        for change in self.keys:
+            change.apply()
+        self._apply_board()
+
+    def apply_verified(self, pacer):
+        """
+        Writes ``pacer.window`` packets at a time, reading each batch back
+        before the next and re-sending only what did not stick. Returns the
+        changes with writes that still failed after PACING_RETRIES
+        re-sends.
+        """
+        pending = [(change, *write)
+                   for change in self.keys
+                   for write in change.writes()]
+        for change in self.keys:
+            change.update()
+        attempts = Counter()
+        failed = []
+        while pending:
+            batch, pending = pending[:pacer.window], pending[pacer.window:]
+            written = [self.board.request(w[1]) for w in batch]
+            wait(written, timeout=VERIFY_TIMEOUT_S)
+
+            readbacks = [(self.board.request(readback), check)
+                         for _, _, readback, check in batch]
+            wait([f for f, _ in readbacks], timeout=VERIFY_TIMEOUT_S)
+            lost = [
+                w for w, (f, check) in zip(batch, readbacks)
+                if not f.done() or f.exception() is not None or
+                not check(f.result())
+            ]
+            if lost:
+                pacer.lost()
+            else:
+                pacer.verified()
+
+            retry = []
+            for w in lost:
+                change, p = w[0], w[1]
+                attempts[id(w)] += 1
+                if attempts[id(w)] > PACING_RETRIES:
+                    logger.error(
+                        f"Board {self.board.serial}: DKM {change.dkm.serial} "
+                        f"did not read back as written: {p!r}")
+                    if change not in failed:
+                        failed.append(change)
+                else:
+                    retry.append(w)
+            pending = retry + pending
+
+        self.resent = sum(attempts.values())
+        self._verify_macros(failed)
+        self._apply_board()
+        return failed
+
+    def _verify_macros(self, failed):
+        """
+        Reads every written macro back whole, so steps the plan left alone
+        and the step ending it are checked too. Adds those that differ to
+        ``failed``.
+        """
+        reads = [(change, self.board.request(request), check)
+                 for change in self.keys
+                 if change.macro is not None and change not in failed
+                 for request, check in change.macro_readbacks()]
+        wait([f for _, f, _ in reads], timeout=VERIFY_TIMEOUT_S)
+        for change, f, check in reads:
+            if change in failed:
+                continue
+            if not f.done() or f.exception() is not None or not check(
+                    f.result()):
+                logger.error(f"Board {self.board.serial}: DKM "
+                             f"{change.dkm.serial} macro did not read back "
+                             f"as written")
+                failed.append(change)
+
+    def _apply_board(self):
+        if self.nkro is not None:
+            logger.info(f"Configuring NKRO to: {self.nkro}")
+            self.board.request(NKROConfigurePacket(self.nkro))
+            self.board.nkro = self.nkro
+        if self.report_rate is not None:
+            logger.info(f"Configuring Report Rate to: {self.report_rate}")
+            self.board.request(ReportRateConfigurePacket(self.report_rate))
+            self.board.report_rate = self.report_rate
+
+
+class ConfigPlan:
+    """The writes that take a set of boards to a validated config."""
+
+    def __init__(self, kbds):
+        self.boards = {kbd.serial: BoardChange(kbd) for kbd in kbds}
+
+    @property
+    def keys(self):
+        return sum(len(b.keys) for b in self.boards.values())
+
+    @property
+    def packets(self):
+        return sum(len(b.packets()) for b in self.boards.values())
+
+    @property
+    def saved(self):
+        return sum(
+            k.saved for b in self.boards.values() for k in b.keys)
+
+    def describe(self):
+        for serial, change in self.boards.items():
+            packets = change.packets()
+            yield f"Board {serial}: {len(change.keys)} keys, {len(packets)} packets"
+            for p in packets:
+                yield f"  {p}"
+
+    def apply(self):
+        for change in self.boards.values():
+            change.apply()
+
+    def apply_verified(self):
+        """
+        Applies every board at the same time, each paced by its own
+        BulkPacer. Returns the changes that failed, keyed by board serial.
+        """
+        changes = list(self.boards.values())
+        pacers = [BulkPacer() for _ in changes]
+        with ThreadPoolExecutor(max_workers=max(1, len(changes)),
+                                thread_name_prefix="load") as pool:
+            failed = list(pool.map(BoardChange.apply_verified, changes, pacers))
+        for change, pacer in zip(changes, pacers):
+            logger.debug(f"Board {change.board.serial} pacing "
+                         f"{pacer.summary()}, resent {change.resent} packets")
+        return {
+            change.board.serial: f
+            for change, f in zip(changes, failed)
+        }
 
-        board = None
-        for kbd in kbds:
-            key = find_key_by_serial(kbd, key_serial)
-            if key is not None:
-                board = kbd
-                break
-        if key is None:
-            logger.error(f"DKM with serial {key_serial} not found")
-            sys.exit(1)
 
-        cfg_kbd_serial = cfg_kbd[LABEL_SERIAL]
-        if board.serial != cfg_kbd_serial:
-            logger.warning(
-                f"DKM with serial {key_serial} found on a different board. Maybe moved from board {cfg_kbd_serial} to {board.serial} ?"
-            )
+def index_keys(kbds):
+    """Maps every DKM serial to the board it is on and its DKM, read once."""
+    index = {}
+    for kbd, keys in zip(kbds, discover_boards(kbds)):
+        for dkm in keys.values():
+            if dkm.serial is not None:
+                index[dkm.serial] = (kbd, dkm)
+    return index
+
+
+def plan_key(kbd, dkm, cfg_key):
+    change = KeyChange(kbd, dkm)
+    layer_keycodes = dict(dkm.layer_keycodes or {})
+    layer_keycodes.update(cfg_key.layer_keycodes)
+    if layer_keycodes != dkm.layer_keycodes:
+        change.layer_keycodes = layer_keycodes
+    if cfg_key.macro is not None and cfg_key.macro != dkm.macro:
+        change.macro = cfg_key.macro
+        # NOTE: Only steps that changed are written, and the terminator
+        # only when the length did.
+        change.macro_steps = [
+            m for m in cfg_key.macro
+            if m.idx >= len(dkm.macro) or dkm.macro[m.idx] != m
+        ]
+        change.macro_terminated = len(cfg_key.macro) != len(dkm.macro)
+    if cfg_key.color is not None and cfg_key.color != dkm.color:
+        change.color = cfg_key.color
+    return change
+
+
+def plan_config(cfg, kbds):
+    """
+    Validates ``cfg`` and works out the writes that take ``kbds`` to it.
+    Nothing is written, and ConfigError lists every problem found.
+    """
+    boards = parse_config(cfg)
+    index = index_keys(kbds)
+    plan = ConfigPlan(kbds)
+    errors = []
+
+    for cfg_board in boards:
+        for cfg_key in cfg_board.keys:
+            found = index.get(cfg_key.serial)
+            if found is None:
+                errors.append(f"DKM with serial {cfg_key.serial} not found")
+                continue
+            kbd, dkm = found
+            if kbd.serial != cfg_key.board_serial:
+                logger.warning(
+                    f"DKM with serial {cfg_key.serial} found on a different board. Maybe moved from board {cfg_key.board_serial} to {kbd.serial} ?"
+                )
+            change = plan_key(kbd, dkm, cfg_key)
+            if change.packets():
+                plan.boards[kbd.serial].keys.append(change)
+            else:
+                logger.debug(
+                    f"DKM serial {cfg_key.serial} already properly configured")
+
+        board = plan.boards.get(cfg_board.serial)
+        if board is None:
+            continue
+        if cfg_board.nkro is not None and board.board.nkro != cfg_board.nkro:
+            board.nkro = cfg_board.nkro
+        if (cfg_board.report_rate is not None and
+                board.board.report_rate != cfg_board.report_rate):
+            board.report_rate = cfg_board.report_rate
+
+    if errors:
+        raise ConfigError(errors)
+    return plan
+
+
+def store_confirmed(kbd, change=None):
+    """
+    Caches the keys of ``kbd`` once the DKMs ``change`` wrote to read back
+    from the board the way they are held in memory. Invalidates the cache
+    if any of them does not.
+    """
+    changed = [c.dkm for c in change.keys] if change else []
+    if changed:
+        reread = DKMDiscovery(kbd,
+                              kbd.discovery_window,
+                              keys=[dkm.key for dkm in changed]).run()
+        for dkm in changed:
+            found = reread.get(dkm.serial)
+            if found is None or encode_dkm(found) != encode_dkm(dkm):
+                logger.error(f"Board {kbd.serial}: DKM {dkm.serial} did not "
+                             f"read back as configured, not caching it")
+                kbd.cache.invalidate(kbd.serial)
+                return False
+    kbd.cache.store(kbd, kbd.configured_keys)
+    return True
 
-        if configure_key(board, key, cfg_key):
-            n += 1
 
-    return n
+def configure_boards(cfg, kbds):
+    plan = plan_config(cfg, kbds)
+    plan.apply()
+    return plan.keys
 
 
-def configure_boards(cfg, kbds):
-    n = 0
-    for cfg_kbd in cfg:
-        cfg_board = cfg_kbd[LABEL_BOARD]
-        n += configure_keys(cfg_board, kbds)
-        board = find_kbd_by_serial(kbds, cfg_board[LABEL_SERIAL])
-        if board:
-            cfg_nkro = cfg_board.get(LABEL_NKRO, None)
-            if cfg_nkro:
-                if board.nkro != cfg_nkro:
-                    logger.info(f"Configuring NKRO to: {cfg_nkro}")
-                    board.put(NKROConfigurePacket(cfg_nkro))
-
-            cfg_report_rate = cfg_board.get(LABEL_REPORT_RATE, None)
-            if cfg_report_rate:
-                if board.report_rate != cfg_report_rate:
-                    logger.info(
-                        f"Configuring Report Rate to: {cfg_report_rate}")
-                    board.put(ReportRateConfigurePacket(cfg_report_rate))
-
-    return n
+def log_config_errors(e):
+    for error in e.errors:
+        logger.error(error)
+    logger.error("Nothing was written")
 
 
 @click.group(help="Configuration Tool", invoke_without_command=True)
@@ -201,8 +611,31 @@ def configure_boards(cfg, kbds):
 @click.option(
     "--very-verbose", help="Enable Very Verbose Logging", is_flag=True)
 @click.option("--version", help="Print Version", is_flag=True)
+@click.option(
+    "--window",
+    help="Requests kept in flight while reading the boards",
+    default=DEFAULT_DISCOVERY_WINDOW,
+    show_default=True)
+@click.option(
+    "--no-cache",
+    help="Always read the boards instead of using cached state",
+    is_flag=True)
+@click.option(
+    "--asyncio",
+    "use_asyncio",
+    help="Drive the boards from a single asyncio event loop (Linux only)",
+    is_flag=True)
+@click.option(
+    "--capture",
+    help="Append every HID report read and written to this file",
+    type=click.Path(dir_okay=False))
+@click.option(
+    "--no-daemon",
+    help="Open the boards directly even if dumang-sync is running",
+    is_flag=True)
 @click.pass_context
-def cli(ctx, verbose, very_verbose, version):
+def cli(ctx, verbose, very_verbose, version, window, no_cache, use_asyncio,
+        capture, no_daemon):
     signal.signal(signal.SIGINT, signal_handler)
 
     if very_verbose:
@@ -216,15 +649,39 @@ def cli(ctx, verbose, very_verbose, version):
         click.echo(f"Report issues to: {pkginfo.url}")
         return
 
-    # TODO: Can both config and sync tools run at the same time?
-    kbds = initialize_devices()
+    ctx.ensure_object(dict)
+    ctx.obj[CTX_ASYNCIO_KEY] = use_asyncio
+    ctx.obj[CTX_WINDOW_KEY] = window
+    ctx.obj[CTX_THREADS_KEY] = []
+    ctx.obj[CTX_CAPTURE_KEY] = None
+    ctx.obj[CTX_REMOTE_KEY] = None
+    if capture:
+        ctx.obj[CTX_CAPTURE_KEY] = CaptureWriter(capture)
+        ctx.call_on_close(ctx.obj[CTX_CAPTURE_KEY].close)
+    if use_asyncio:
+        # NOTE: Boards are opened by the subcommand, on its event loop.
+        return
+
+    # NOTE: A running dumang-sync owns the boards and already knows their
+    # state, so ask it rather than opening them alongside it.
+    if not (capture or no_daemon) and connect_daemon(ctx):
+        if no_cache or window != DEFAULT_DISCOVERY_WINDOW:
+            logger.warning("--window and --no-cache don't apply to the "
+                           "boards dumang-sync has already read, pass "
+                           "--no-daemon to read them directly")
+        return
+
+    kbds = initialize_devices(ctx.obj[CTX_CAPTURE_KEY])
     if not kbds:
         logger.error("Keyboard not detected")
         sys.exit(1)
 
-    ctx.ensure_object(dict)
+    cache = None if no_cache else DiscoveryCache()
+    for kbd in kbds:
+        kbd.discovery_window = window
+        kbd.cache = cache
+
     ctx.obj[CTX_KEYBOARDS_KEY] = kbds
-    ctx.obj[CTX_THREADS_KEY] = []
 
     ctx.obj[CTX_THREADS_KEY].extend(init_send_threads(kbds))
     ctx.obj[CTX_THREADS_KEY].extend(init_receive_threads(kbds))
@@ -233,46 +690,123 @@ def cli(ctx, verbose, very_verbose, version):
         t.start()
 
 
+def connect_daemon(ctx):
+    client = ControlClient.connect()
+    if client is None:
+        return False
+    try:
+        kbds = client.boards()
+    except (OSError, ControlError) as ex:
+        logger.warning(f"Not using dumang-sync: {ex}")
+        client.close()
+        return False
+
+    logger.debug("Using the boards of the running dumang-sync")
+    ctx.obj[CTX_REMOTE_KEY] = client
+    ctx.obj[CTX_KEYBOARDS_KEY] = kbds
+    ctx.call_on_close(client.close)
+    return True
+
+
+def board_to_cfg(kbd):
+    cfg_board = {
+        LABEL_BOARD: {
+            LABEL_SERIAL: kbd.serial,
+            LABEL_NKRO: kbd.nkro,
+            LABEL_REPORT_RATE: kbd.report_rate,
+            LABEL_KEYS: []
+        }
+    }
+
+    cfg_keys = cfg_board[LABEL_BOARD][LABEL_KEYS]
+    for _, dkm in kbd.configured_keys.items():
+        cfg_key = {LABEL_KEY: NestedDict()}
+        if dkm.serial is not None:
+            cfg_key[LABEL_KEY][LABEL_SERIAL] = dkm.serial
+        for l, kc in dkm.layer_keycodes.items():
+            # NOTE: Use str() here to get ANY of the valid
+            # aliases should a keycode have them.
+            cfg_key[LABEL_KEY][f"{LABEL_LAYER_PREFIX}{l}"] = str(kc)
+        if dkm.macro:
+            cfg_key[LABEL_KEY][LABEL_MACRO] = [{
+                LABEL_TYPE: str(m.type),
+                LABEL_KEY: str(m.keycode),
+                LABEL_DELAY_MS: m.delay,
+            } for m in dkm.macro]
+        if dkm.color:
+            cfg_key[LABEL_KEY][
+                LABEL_COLOR] = "{0:02x}{1:02x}{2:02x}".format(*dkm.color)
+        cfg_keys.append(cfg_key)
+
+    return cfg_board
+
+
+async def open_async_boards(window, capture=None):
+    from dumang_ctrl.dumang.aio import initialize_async_devices
+
+    kbds = await initialize_async_devices(capture)
+    if not kbds:
+        logger.error("Keyboard not detected")
+        sys.exit(1)
+
+    # NOTE: Every board is read at the same time on the one loop.
+    await asyncio.gather(*(kbd.discover(window) for kbd in kbds))
+    return kbds
+
+
+async def async_dump(window, capture=None):
+    kbds = await open_async_boards(window, capture)
+    cfg_dict = []
+    for kbd in kbds:
+        cfg_dict.append(board_to_cfg(kbd))
+        log_discovery_timings(kbd)
+        log_request_stats(kbd)
+        kbd.close()
+    return cfg_dict
+
+
+async def async_load(cfg, window, capture=None, plan_only=False):
+    kbds = await open_async_boards(window, capture)
+    try:
+        plan = plan_config(cfg, kbds)
+    except ConfigError:
+        for kbd in kbds:
+            kbd.close()
+        raise
+    if not plan_only:
+        plan.apply()
+    for kbd in kbds:
+        not_done = await kbd.drain(timeout=LOAD_TIMEOUT_S)
+        if not_done:
+            logger.error(
+                f"Board {kbd.serial}: {len(not_done)} writes did not complete")
+        log_discovery_timings(kbd)
+        log_request_stats(kbd)
+        kbd.close()
+    return plan
+
+
 @cli.command(help="Dump the current configuration")
 @click.option(
     "--format", type=click.Choice(CFG_FORMATS), default=DEFAULT_CFG_FORMAT)
 @click.pass_context
 def dump(ctx, format):
-    n = 0
-    cfg_dict = []
-    for _, kbd in enumerate(ctx.obj[CTX_KEYBOARDS_KEY]):
-        cfg_board = {
-            LABEL_BOARD: {
-                LABEL_SERIAL: kbd.serial,
-                LABEL_NKRO: kbd.nkro,
-                LABEL_REPORT_RATE: kbd.report_rate,
-                LABEL_KEYS: []
-            }
-        }
-
-        cfg_keys = cfg_board[LABEL_BOARD][LABEL_KEYS]
-        for _, dkm in kbd.configured_keys.items():
-            cfg_key = {LABEL_KEY: NestedDict()}
-            if dkm.serial is not None:
-                cfg_key[LABEL_KEY][LABEL_SERIAL] = dkm.serial
-            for l, kc in dkm.layer_keycodes.items():
-                # NOTE: Use str() here to get ANY of the valid
-                # aliases should a keycode have them.
-                cfg_key[LABEL_KEY][f"{LABEL_LAYER_PREFIX}{l}"] = str(kc)
-            if dkm.macro:
-                cfg_key[LABEL_KEY][LABEL_MACRO] = [{
-                    LABEL_TYPE: str(m.type),
-                    LABEL_KEY: str(m.keycode),
-                    LABEL_DELAY_MS: m.delay,
-                } for m in dkm.macro]
-            if dkm.color:
-                cfg_key[LABEL_KEY][
-                    LABEL_COLOR] = "{0:02x}{1:02x}{2:02x}".format(*dkm.color)
-            cfg_keys.append(cfg_key)
-            n += 1
-
-        cfg_dict.append(cfg_board)
-        kbd.kill_threads()
+    if ctx.obj[CTX_ASYNCIO_KEY]:
+        cfg_dict = asyncio.run(
+            async_dump(ctx.obj[CTX_WINDOW_KEY], ctx.obj[CTX_CAPTURE_KEY]))
+    else:
+        kbds = ctx.obj[CTX_KEYBOARDS_KEY]
+        start = time.monotonic()
+        discover_boards(kbds)
+        logger.debug(f"Read {len(kbds)} boards in "
+                     f"{(time.monotonic() - start) * 1000:.0f} ms")
+        cfg_dict = []
+        for kbd in kbds:
+            cfg_dict.append(board_to_cfg(kbd))
+            log_discovery_timings(kbd)
+            log_request_stats(kbd)
+            kbd.kill_threads()
+    n = sum(len(b[LABEL_BOARD][LABEL_KEYS]) for b in cfg_dict)
 
     if format == CFG_YAML_FORMAT:
         yaml.dump(
@@ -289,22 +823,98 @@ def dump(ctx, format):
         t.join()
 
 
+def log_configured(plan):
+    logger.info(f"Configured {plan.keys} keys with {plan.packets} packets, "
+                f"{plan.saved} unchanged macro packets skipped.")
+
+
+def print_plan(plan):
+    for line in plan.describe():
+        click.echo(line)
+    click.echo(f"{plan.packets} packets for {plan.keys} keys, "
+               f"{plan.saved} unchanged macro packets skipped")
+
+
 @cli.command(help="Load the current configuration")
 @click.option(
     "--format", type=click.Choice(CFG_FORMATS), default=DEFAULT_CFG_FORMAT)
+@click.option(
+    "--plan",
+    "plan_only",
+    help="Print the packets that would be written, without writing them",
+    is_flag=True)
+@click.option(
+    "--no-verify",
+    help="Write everything at once without reading it back",
+    is_flag=True)
 @click.argument("filename")
 @click.pass_context
-def load(ctx, format, filename):
+def load(ctx, format, plan_only, no_verify, filename):
     cfgfile = open(filename)
     if format == CFG_YAML_FORMAT:
         cfg = yaml.safe_load(cfgfile)
     elif format == CFG_JSON_FORMAT:
         cfg = json.load(cfgfile)
 
-    n = configure_boards(cfg, ctx.obj[CTX_KEYBOARDS_KEY])
+    remote = ctx.obj[CTX_REMOTE_KEY]
+    try:
+        # NOTE: Checked before the boards are read, so a bad config fails fast.
+        parse_config(cfg)
+        if remote:
+            plan = remote.load(cfg, plan_only, not no_verify)
+        elif ctx.obj[CTX_ASYNCIO_KEY]:
+            plan = asyncio.run(
+                async_load(cfg, ctx.obj[CTX_WINDOW_KEY],
+                           ctx.obj[CTX_CAPTURE_KEY], plan_only))
+        else:
+            plan = plan_config(cfg, ctx.obj[CTX_KEYBOARDS_KEY])
+    except (ConfigError, ControlError) as e:
+        log_config_errors(e)
+        sys.exit(1)
+
+    if plan_only:
+        print_plan(plan)
+    if remote:
+        for serial, dkms in plan.failed.items():
+            for dkm_serial in dkms:
+                logger.error(f"Board {serial}: DKM {dkm_serial} did not read "
+                             f"back as written")
+        if not plan_only:
+            log_configured(plan)
+        if any(plan.failed.values()):
+            sys.exit(1)
+        return
+    if ctx.obj[CTX_ASYNCIO_KEY]:
+        if not plan_only:
+            log_configured(plan)
+        return
+
+    failed = {}
+    if plan_only:
+        pass
+    elif no_verify:
+        plan.apply()
+    else:
+        failed = plan.apply_verified()
     for kbd in ctx.obj[CTX_KEYBOARDS_KEY]:
+        not_done = kbd.drain(timeout=LOAD_TIMEOUT_S)
+        if not_done:
+            logger.error(
+                f"Board {kbd.serial}: {len(not_done)} writes did not complete")
+        if kbd.cache and not plan_only:
+            # NOTE: The in-memory DKMs were updated as packets were queued,
+            # only what the board reads back is cached.
+            if not_done or failed.get(kbd.serial):
+                kbd.cache.invalidate(kbd.serial)
+            else:
+                store_confirmed(kbd, plan.boards.get(kbd.serial))
+        log_discovery_timings(kbd)
+        log_request_stats(kbd)
         kbd.kill_threads()
-    logger.info(f"Configured {n} keys.")
+    if not plan_only:
+        log_configured(plan)
+    if any(failed.values()):
+        sys.exit(1)
 
     for t in ctx.obj[CTX_THREADS_KEY]:
         t.join()
@@ -313,6 +923,10 @@ def load(ctx, format, filename):
 @cli.command(help="Inspect the current configuration via a GUI")
 @click.pass_context
 def inspect(ctx):
+    if ctx.obj[CTX_ASYNCIO_KEY]:
+        logger.error("inspect does not support --asyncio")
+        sys.exit(1)
+
     logger.info("Launching GUI")
     from dumang_ctrl.dumang.gui import inspect_gui
     kbds = ctx.obj[CTX_KEYBOARDS_KEY]
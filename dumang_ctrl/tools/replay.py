@@ -0,0 +1,147 @@
+import click
+import logging
+import sys
+import time
+
+from dumang_ctrl.dumang import common
+from dumang_ctrl.dumang.capture import RECORD_READ, ReplayBackend
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.tools import sync as sync_tool
+from dumang_ctrl.tools.config import log_discovery_timings, log_request_stats
+
+logger = logging.getLogger("DuMang Replay")
+logger.setLevel(logging.INFO)
+
+REPLAY_TIMEOUT_S = 600
+# NOTE: Time allowed for writes queued by the last reads to go out.
+REPLAY_SETTLE_S = 0.5
+
+
+def start_threads(threads):
+    for t in threads:
+        t.start()
+
+
+def stop_threads(kbds, threads):
+    # NOTE: Stop first, so no Job goes back to waiting after its JobKiller.
+    for t in threads:
+        t.stop()
+    for kbd in kbds:
+        kbd.kill_threads()
+    for t in threads:
+        t.join()
+
+
+def wait_replayed(kbds):
+    deadline = time.monotonic() + REPLAY_TIMEOUT_S
+    for kbd in kbds:
+        kbd.handle.wait_done(max(0, deadline - time.monotonic()))
+
+
+def check_replayed(kbds):
+    """Logs an error for every board whose capture was not played back in full. Returns False if any."""
+    ok = True
+    for kbd in kbds:
+        device = kbd.handle
+        if device.done:
+            continue
+        ok = False
+        if device.stalled:
+            logger.error(
+                f"Board {kbd.serial}: replay stalled, {device.unanswered} "
+                f"captured responses answer requests that were never made")
+        else:
+            logger.error(f"Board {kbd.serial}: replay did not finish "
+                         f"within {REPLAY_TIMEOUT_S}s")
+    return ok
+
+
+def log_replay(kbds, elapsed):
+    for kbd in kbds:
+        device = kbd.handle
+        reads = sum(1 for r in device.records if r[1] == RECORD_READ)
+        captured_writes = len(device.records) - reads
+        logger.info(f"Board {kbd.serial}: {reads} reads replayed, "
+                    f"{len(device.writes)}/{captured_writes} writes, "
+                    f"{device.mismatched} not in the capture")
+    logger.info(f"Replayed in {elapsed * 1000:.1f} ms")
+
+
+@click.group(help="Replay a capture through the sync or config logic")
+@click.option("--verbose", help="Enable Verbose Logging", is_flag=True)
+@click.option(
+    "--realtime",
+    help="Deliver reports at their captured times instead of right away",
+    is_flag=True)
+@click.argument("capture_file", type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def cli(ctx, verbose, realtime, capture_file):
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+        sync_tool.logger.setLevel(logging.DEBUG)
+
+    common.device_backend = ReplayBackend(capture_file, realtime)
+
+
+@cli.command(help="Replay a dumang-sync capture")
+@click.option(
+    "--fast-path", help="Use dumang-sync's fast path", is_flag=True)
+def sync(fast_path):
+    kbds = initialize_devices()
+    if len(kbds) != 2:
+        logger.error(f"Capture has {len(kbds)} boards, sync needs 2")
+        return
+
+    kbd1, kbd2 = kbds
+    if fast_path:
+        sync_tool.init_fast_path(kbd1, kbd2)
+    threads = []
+    threads.extend(sync_tool.init_send_threads(kbd1, kbd2))
+    threads.extend(sync_tool.init_receive_threads(kbd1, kbd2))
+    threads.extend(sync_tool.init_synchronization_threads(kbd1, kbd2))
+
+    start = time.monotonic()
+    start_threads(threads)
+    wait_replayed(kbds)
+    elapsed = time.monotonic() - start
+    time.sleep(REPLAY_SETTLE_S)
+    stop_threads(kbds, threads)
+
+    log_replay(kbds, elapsed)
+    sync_tool.pipeline_stats.log(logger)
+    if not check_replayed(kbds):
+        sys.exit(1)
+
+
+@cli.command(help="Replay a dumang-config capture by reading the boards back")
+@click.option(
+    "--window",
+    help="Requests kept in flight while reading the boards",
+    default=DEFAULT_DISCOVERY_WINDOW,
+    show_default=True)
+def dump(window):
+    kbds = initialize_devices()
+    threads = []
+    for kbd in kbds:
+        kbd.discovery_window = window
+        threads.append(Job(target=kbd.send_thread, daemon=True))
+        threads.append(Job(target=kbd.receive_thread, daemon=True))
+
+    start = time.monotonic()
+    start_threads(threads)
+    for kbd in kbds:
+        logger.info(f"Board {kbd.serial}: {len(kbd.configured_keys)} DKMs")
+    elapsed = time.monotonic() - start
+    wait_replayed(kbds)
+    stop_threads(kbds, threads)
+
+    for kbd in kbds:
+        log_discovery_timings(kbd)
+        log_request_stats(kbd)
+    log_replay(kbds, elapsed)
+    if not check_replayed(kbds):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,14 +1,40 @@
+import asyncio
 import click
 import logging
+import queue
 import threading
 import signal
+import time
+
+import yaml
 
 import dumang_ctrl as pkginfo
+from dumang_ctrl.dumang.capture import CaptureWriter
 from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.control import (OP_DUMP, OP_LOAD, OP_PULSE,
+                                        ControlError, ControlServer,
+                                        board_state)
+from dumang_ctrl.dumang.stats import PipelineStats
+from dumang_ctrl.tools import config
 
 logger = logging.getLogger("DuMang Sync")
 logger.setLevel(logging.INFO)
 
+LABEL_PAIR = "pair"
+LABEL_NAME = "name"
+LABEL_SERIALS = "serials"
+DEFAULT_PAIR_NAME = "default"
+
+pipeline_stats = PipelineStats()
+stats_file = None
+capture = None
+
+# NOTE: The boards being synced, of every pair, as served over the control
+# socket.
+boards = []
+load_lock = threading.Lock()
+control_server = None
+
 
 def layer_toggle_process(p):
     if isinstance(p, KeyUpPacket):
@@ -19,22 +45,52 @@ def layer_toggle_process(p):
     return BoardSyncPacket(p.ID, layer_active, p.layer_info)
 
 
-def send_response(p, q):
+def trace_response(response, p, source, dequeued_ns=None):
+    if source is not None and p.read_ns is not None:
+        response.trace = pipeline_stats.trace(source.serial, p.read_ns,
+                                              dequeued_ns)
+
+
+def send_response(p, q, source=None, dequeued_ns=None):
     response = None
 
     if isinstance(p, (KeyDownPacket, KeyUpPacket)):
         response = layer_toggle_process(p)
+        trace_response(response, p, source, dequeued_ns)
 
     if response:
         q.put(response)
 
 
+def forward_layer_change(p, kbd, source=None):
+    if not isinstance(p, (KeyDownPacket, KeyUpPacket)):
+        return False
+
+    response = layer_toggle_process(p)
+    trace_response(response, p, source)
+    try:
+        kbd.write_packet(response)
+    except OSError as ex:
+        logger.debug(f"Fast path write failed, queueing instead: {ex}")
+        kbd.put(response)
+    return True
+
+
+def init_fast_path(kbd1, kbd2):
+    # NOTE: Layer changes are written to the other board straight from the
+    # receive thread, skipping recv_q, the sync thread and send_q. Anything
+    # else still goes through the sync threads.
+    kbd1.forward = lambda p: forward_layer_change(p, kbd2, kbd1)
+    kbd2.forward = lambda p: forward_layer_change(p, kbd1, kbd2)
+
+
 def sync_thread(kbd1, kbd2):
     p = kbd1.recv_q.get()
+    dequeued_ns = time.monotonic_ns()
     if isinstance(p, JobKiller):
         logger.debug("Kill Sync Thread")
         return
-    send_response(p, kbd2.send_q)
+    send_response(p, kbd2.send_q, kbd1, dequeued_ns)
     kbd1.recv_q.task_done()
 
 
@@ -70,103 +126,630 @@ def init_receive_threads(kbd1, kbd2):
     return [r1, r2]
 
 
-def kill_and_join_threads(kbd1, kbd2, threads):
-    if kbd1:
-        kbd1.kill_threads()
-    if kbd2:
-        kbd2.kill_threads()
-
+def stop_board(kbd, threads):
+    # NOTE: Stop first, so no Job goes back to waiting after its JobKiller.
     for t in threads:
         t.stop()
-
+    kbd.kill_threads()
     for t in threads:
         t.join()
+    kbd.close()
 
-    threads = []
 
-    if kbd1:
-        kbd1.close()
-    if kbd2:
-        kbd2.close()
+def discard_queued(kbd):
+    while True:
+        try:
+            kbd.recv_q.get_nowait()
+        except queue.Empty:
+            return
 
 
-def device_init_thread(monitor):
-    threads = []
-    kbd1 = None
-    kbd2 = None
+class SyncSession:
+    """
+    The boards of one pair dumang-sync has open, by serial, and the
+    threads syncing them. Boards are opened and closed one at a time as they arrive and
+    leave, so replugging one half leaves the other half running.
+
+    Once started, a watchdog also looks for handles that went stale while
+    their board never left, eg. across a suspend libusb did not report,
+    and reopens them in place. It sleeps until a board goes stale, a
+    hotplug event, a resume or a board stays quiet for
+    HEARTBEAT_INTERVAL_S. ``resume_wakeup`` stands in for the
+    ClockSetWatcher telling it about resumes, eg. in benchmarks.
+    """
+
+    def __init__(self, fast_path=False, resume=None, resume_wakeup=None):
+        self.fast_path = fast_path
+        self.kbds = {}
+        self.workers = {}
+        self.sync_threads = []
+        # NOTE: BoardInfoResponsePackets of boards that left, by serial.
+        self.info = {}
+        self.resume = resume or ResumeDetector()
+        self.resume_wakeup = resume_wakeup or ClockSetWatcher()
+        self._serials = {}
+        # NOTE: Both the device and the watchdog thread open and close boards.
+        self._lock = threading.RLock()
+        self._watchdog = None
+        self._wake = threading.Event()
+        self._heartbeats = {}
+        self._stale_since = {}
+        # NOTE: When to look for each stale board again, and the backoff.
+        self._retries = {}
+
+    def start(self):
+        self._watchdog = Job(target=self.watch, daemon=True)
+        self._watchdog.start()
+        # NOTE: The watchdog's sleep doesn't count time spent suspended.
+        self.resume_wakeup.start(self._wake.set)
+
+    def arrived(self, device=None, d=None):
+        """
+        Opens the board ``device`` is and, once both halves are open, syncs
+        them. ``d`` is its find_device() entry, if already looked up.
+        """
+        # NOTE: Hotplug events often follow a resume, have it looked for.
+        self._wake.set()
+        if d is None:
+            d = find_device(device, exclude=self.kbds)
+        if d is None:
+            logger.warning("Could not find the board that was plugged in")
+            return
+        serial = d["serial_number"]
+
+        with self._lock:
+            if serial in self.kbds:
+                # NOTE: Back without having left, eg. after a suspend. The
+                # handle it is open with can only be stale.
+                self._serials = {
+                    dev: s for dev, s in self._serials.items() if s != serial
+                }
+                self._serials[device] = serial
+                self._reopen(serial, d)
+                return
 
-    while True:
-        status = monitor.get_status()
-        if status == NOTIFY_STATUS_READY:
-            logger.debug("Keyboard Detected!")
-            logger.debug("Initializing...")
-            # If both boards aren't connected, one of these may be `None`.
-            # In which case we will enter this state twice.
-            # We only want to begin the sync threads once we have
-            # two devices.
-            kbd1, kbd2 = initialize_devices()
-
-            if not (kbd1 and kbd2):
+            try:
+                h = open_device(d["path"])
+            except OSError as ex:
+                logger.error(ex, exc_info=True)
+                logger.error("Likely permissions error.")
+                return
+
+            kbd = DuMangBoard(
+                serial,
+                h,
+                capture=capture.channel(serial) if capture else None,
+                info=self.info.get(serial))
+            kbd.on_stale = self._on_stale
+            self._serials[device] = serial
+            self.kbds[serial] = kbd
+            self.workers[serial] = [
+                Job(target=kbd.send_thread, daemon=True),
+                Job(target=kbd.receive_thread, daemon=True),
+            ]
+            for t in self.workers[serial]:
+                t.start()
+
+            if len(self.kbds) < 2:
                 logger.info("Waiting for other Keyboard...")
-                continue
+                return
 
             logger.debug("Both keyboards detected.")
-            logger.debug("Starting sync threads...")
-            threads.extend(init_send_threads(kbd1, kbd2))
-            threads.extend(init_receive_threads(kbd1, kbd2))
-            threads.extend(init_synchronization_threads(kbd1, kbd2))
+            self._start_sync()
+        if device is not None:
+            restore_ns = time.monotonic_ns() - device.arrived_ns
+            pipeline_stats.restored(serial, restore_ns)
+            logger.info(f"Board {serial} synced {restore_ns / 1e6:.1f} ms "
+                        f"after it was plugged in")
+
+    def left(self, device=None):
+        self._wake.set()
+        with self._lock:
+            serial = self._serials.pop(device, None)
+            if serial is None:
+                return
+            logger.debug(f"Board {serial} disconnected")
+            self._stop_sync()
+            kbd = self.kbds.pop(serial)
+            self.info[serial] = kbd.board_info()
+            self._heartbeats.pop(serial, None)
+            self._stale_since.pop(serial, None)
+            self._retries.pop(serial, None)
+            stop_board(kbd, self.workers.pop(serial))
+
+    def close(self):
+        self.resume_wakeup.stop()
+        if self._watchdog:
+            self._watchdog.stop()
+            self._wake.set()
+            self._watchdog.join()
+        with self._lock:
+            self._stop_sync()
+            for serial, kbd in self.kbds.items():
+                stop_board(kbd, self.workers[serial])
+            self.kbds.clear()
+            self.workers.clear()
+            self._serials.clear()
+
+    def _on_stale(self, kbd):
+        self._wake.set()
+
+    def watch(self):
+        """One round of the watchdog, see SyncSession."""
+        self._wake.clear()
+        # NOTE: close() stops the watchdog before waking it.
+        if self._watchdog.shutdown_flag.is_set():
+            return
+        resumed = self.resume.resumed()
+        if resumed:
+            logger.info("Resumed from suspend, reopening boards...")
+        now = time.monotonic()
+        wake_at = now + HEARTBEAT_INTERVAL_S
+
+        with self._lock:
+            for serial, kbd in list(self.kbds.items()):
+                if resumed:
+                    kbd.mark_stale()
+                if kbd.stale:
+                    self._stale_since.setdefault(serial, time.monotonic_ns())
+                    retry_at, backoff = self._retries.get(
+                        serial, (now, STALE_RETRY_MIN_S))
+                    if retry_at <= now:
+                        if self._reopen(serial):
+                            continue
+                        retry_at = now + backoff
+                        self._retries[serial] = (
+                            retry_at, min(backoff * 2, STALE_RETRY_MAX_S))
+                    wake_at = min(wake_at, retry_at)
+                    continue
+
+                heartbeat_at = kbd.last_read + HEARTBEAT_INTERVAL_S
+                if heartbeat_at <= now:
+                    pending = self._heartbeats.get(serial)
+                    if pending is None or pending.done():
+                        self._heartbeats[serial] = kbd.heartbeat()
+                    heartbeat_at = now + HEARTBEAT_INTERVAL_S
+                wake_at = min(wake_at, heartbeat_at)
+        self._wake.wait(max(0, wake_at - time.monotonic()))
+
+    def _reopen(self, serial, d=None):
+        if d is None:
+            # NOTE: Where the board is now, it may have come back elsewhere.
+            d = next((d for d in find_devices() if d["serial_number"] == serial),
+                     None)
+            if d is None:
+                return False
+        try:
+            h = open_device(d["path"])
+        except OSError as ex:
+            logger.debug(f"Board {serial} not back yet: {ex}")
+            return False
+
+        self.kbds[serial].reopen(h)
+        self._heartbeats.pop(serial, None)
+        self._retries.pop(serial, None)
+        stale_ns = self._stale_since.pop(serial, None)
+        if stale_ns is not None:
+            restore_ns = time.monotonic_ns() - stale_ns
+            pipeline_stats.restored(serial, restore_ns)
+            logger.info(f"Board {serial} reopened {restore_ns / 1e6:.1f} ms "
+                        f"after its handle was found stale")
+        else:
+            logger.info(f"Board {serial} reopened")
+        return True
+
+    def _start_sync(self):
+        kbd1, kbd2 = self.kbds.values()
+        # NOTE: Key presses read while the other half was away are stale.
+        discard_queued(kbd1)
+        discard_queued(kbd2)
+        if self.fast_path:
+            init_fast_path(kbd1, kbd2)
+        self.sync_threads = init_synchronization_threads(kbd1, kbd2)
+        for t in self.sync_threads:
+            t.start()
+
+        boards.extend((kbd1, kbd2))
+        # NOTE: Read the DKMs now so control requests find them ready.
+        # Not while capturing, since dumang-replay sync never asks for them.
+        if capture is None:
+            threading.Thread(
+                target=discover_boards, args=([kbd1, kbd2],),
+                daemon=True).start()
+
+    def _stop_sync(self):
+        for kbd in self.kbds.values():
+            if kbd in boards:
+                boards.remove(kbd)
+        if not self.sync_threads:
+            return
+        for t in self.sync_threads:
+            t.stop()
+        for kbd in self.kbds.values():
+            kbd.forward = None
+            kbd.recv_q.put(JobKiller())
+        for t in self.sync_threads:
+            t.join()
+        self.sync_threads = []
+
+
+class PairConfig:
+    """One validated pair entry of a pairs file."""
+
+    def __init__(self, name, serials):
+        self.name = name
+        self.serials = serials
+
+
+def parse_pairs(cfg):
+    """
+    Validates a pairs file, a list of ``pair`` entries each naming the
+    ``serials`` of the two halves synced together, eg.
+
+        - pair:
+            name: bench-1
+            serials: ["SERIAL1", "SERIAL2"]
+
+    Raises config.ConfigError on any problem.
+    """
+    errors = []
+    pairs = []
+    seen = set()
+    if not isinstance(cfg, list):
+        raise config.ConfigError(["pairs file is not a list of pairs"])
+
+    for n, entry in enumerate(cfg):
+        cfg_pair = entry.get(LABEL_PAIR) if isinstance(entry, dict) else None
+        if not isinstance(cfg_pair, dict):
+            errors.append(f"entry {n}: not a pair")
+            continue
+        name = str(cfg_pair.get(LABEL_NAME, n))
+        serials = cfg_pair.get(LABEL_SERIALS)
+        if not isinstance(serials, list) or len(serials) != 2:
+            errors.append(f"pair {name}: serials {serials} are not two boards")
+            continue
+        serials = [str(serial) for serial in serials]
+        for serial in serials:
+            if serial in seen:
+                errors.append(f"pair {name}: board {serial} is in more than "
+                              "one pair")
+            seen.add(serial)
+        pairs.append(PairConfig(name, serials))
+
+    if errors:
+        raise config.ConfigError(errors)
+    return pairs
+
+
+class PairedSync:
+    """
+    Routes the boards the monitor notifies to one SyncSession per pair of
+    ``pairs``, or to a single session for whichever two boards arrive if
+    there are no ``pairs``. Every pair has its own thread opening and
+    closing its boards, so a pair that is slow to open or reconnecting
+    never holds up another.
+    """
+
+    def __init__(self, pairs=None, fast_path=False):
+        self.pairs = pairs
+        self.fast_path = fast_path
+        self.sessions = {}
+        self._queues = {}
+        self._threads = {}
+        # NOTE: Pair name of every board notified, by device.
+        self._devices = {}
+
+    @property
+    def kbds(self):
+        # NOTE: Copied, since every pair's thread changes its own.
+        return {
+            serial: kbd
+            for session in list(self.sessions.values())
+            for serial, kbd in list(session.kbds.items())
+        }
+
+    def _pair_of(self, serial):
+        for pair in self.pairs:
+            if serial in pair.serials:
+                return pair.name
+        return None
+
+    def _locate(self, device):
+        """Returns the serial of ``device`` and its find_device() entry if it had to be looked up."""
+        serial = getattr(device, "serial", None)
+        if serial is not None:
+            return serial, None
+        d = find_device(device, exclude=self.kbds)
+        if d is None:
+            return None, None
+        return d["serial_number"], d
+
+    def arrived(self, device):
+        if self.pairs is None:
+            self._devices[device] = DEFAULT_PAIR_NAME
+            self._post(DEFAULT_PAIR_NAME, (NOTIFY_STATUS_READY, device, None))
+            return
 
-            for t in threads:
-                t.start()
+        serial, d = self._locate(device)
+        name = self._pair_of(serial) if serial is not None else None
+        if name is None:
+            logger.warning(f"Board {serial} is not in any pair, ignoring it")
+            return
+        self._devices[device] = name
+        self._post(name, (NOTIFY_STATUS_READY, device, d))
+
+    def left(self, device):
+        name = self._devices.pop(device, None)
+        if name is not None:
+            self._post(name, (NOTIFY_STATUS_WAIT, device, None))
+
+    def _post(self, name, event):
+        q = self._queues.get(name)
+        if q is None:
+            session = SyncSession(self.fast_path)
+            session.start()
+            self.sessions[name] = session
+            q = self._queues[name] = queue.Queue()
+            t = self._threads[name] = threading.Thread(
+                target=self._run, args=(session, q), daemon=True)
+            t.start()
+        q.put(event)
+
+    def _run(self, session, q):
+        while True:
+            status, device, d = q.get()
+            if status == NOTIFY_STATUS_READY:
+                session.arrived(device, d)
+            elif status == NOTIFY_STATUS_WAIT:
+                # NOTE: Only the board that left is closed, the other one
+                # keeps its handle and threads until it is back.
+                session.left(device)
+            else:
+                return
 
+    def close(self):
+        for q in self._queues.values():
+            q.put((NOTIFY_STATUS_STOP, None, None))
+        for t in self._threads.values():
+            t.join()
+        for session in self.sessions.values():
+            session.close()
+
+
+def load_pairs(path):
+    with open(path) as f:
+        return parse_pairs(yaml.safe_load(f))
+
+
+def connected_boards():
+    kbds = list(boards)
+    if not kbds:
+        raise ControlError("Keyboard not connected")
+    return kbds
+
+
+def control_dump(request):
+    kbds = connected_boards()
+    discover_boards(kbds)
+    return [board_state(kbd) for kbd in kbds]
+
+
+def control_load(request):
+    kbds = connected_boards()
+    # NOTE: Two clients loading at once would interleave their writes.
+    with load_lock:
+        try:
+            plan = config.plan_config(request["cfg"], kbds)
+        except config.ConfigError as e:
+            raise ControlError(str(e), e.errors)
+
+        failed = {}
+        if not request.get("plan_only"):
+            if request.get("verify", True):
+                failed = plan.apply_verified()
+            else:
+                plan.apply()
+                for kbd in kbds:
+                    kbd.drain(timeout=config.LOAD_TIMEOUT_S)
+            logger.info(f"Configured {plan.keys} keys over the control socket")
+
+    return {
+        "keys": plan.keys,
+        "packets": plan.packets,
+        "saved": plan.saved,
+        "plan": list(plan.describe()),
+        "failed": {
+            serial: [change.dkm.serial for change in changes]
+            for serial, changes in failed.items()
+        },
+    }
+
+
+def control_pulse(request):
+    for kbd in connected_boards():
+        if kbd.serial == request["board"]:
+            kbd.request(LightPulsePacket(request["on"], request["key"]))
+            return None
+    raise ControlError(f"Board {request['board']} not connected")
+
+
+CONTROL_HANDLERS = {
+    OP_DUMP: control_dump,
+    OP_LOAD: control_load,
+    OP_PULSE: control_pulse,
+}
+
+
+def device_init_thread(monitor, fast_path=False, pairs=None):
+    paired = PairedSync(pairs, fast_path)
+
+    while True:
+        status, device = monitor.get_event()
+        if status == NOTIFY_STATUS_READY:
+            logger.debug("Keyboard Detected!")
+            paired.arrived(device)
         elif status == NOTIFY_STATUS_WAIT:
             logger.debug("Keyboard Disconnected!")
+            paired.left(device)
+        elif status == NOTIFY_STATUS_STOP:
             logger.debug("Stopping sync threads...")
+            if not paired.kbds:
+                logger.info(
+                    "Could not find devices. Make sure you've setup udev rules!"
+                )
+            paired.close()
+            return
 
-            # NOTE: Kill threads and wait for devices to be reconnected.
-            kill_and_join_threads(kbd1, kbd2, threads)
 
-            kbd1 = None
-            kbd2 = None
-        elif status == NOTIFY_STATUS_STOP:
-            logger.debug("Stopping sync threads...")
+async def async_sync_loop(kbd1, kbd2):
+    while True:
+        p = await kbd1.recv()
+        dequeued_ns = time.monotonic_ns()
+        if isinstance(p, (KeyDownPacket, KeyUpPacket)):
+            response = layer_toggle_process(p)
+            trace_response(response, p, kbd1, dequeued_ns)
+            await kbd2.send(response)
+
+
+def close_async_boards(kbds, tasks):
+    for t in tasks:
+        t.cancel()
+    for kbd in kbds:
+        kbd.close()
+
+
+async def async_device_loop(monitor):
+    # NOTE: Imported here since the asyncio boards are Linux only.
+    from dumang_ctrl.dumang.aio import initialize_async_devices
+
+    loop = asyncio.get_running_loop()
+    kbds = []
+    tasks = []
 
-            if not (kbd1 or kbd2):
+    while True:
+        status = await loop.run_in_executor(None, monitor.get_status)
+        if status == NOTIFY_STATUS_READY:
+            logger.debug("Keyboard Detected!")
+            if len(kbds) == 2:
+                # NOTE: Both boards were found when the first one arrived.
+                continue
+            close_async_boards(kbds, tasks)
+            kbds = await initialize_async_devices(capture)
+
+            if len(kbds) < 2:
+                logger.info("Waiting for other Keyboard...")
+                continue
+
+            kbd1, kbd2 = kbds
+            logger.debug("Both keyboards detected.")
+            tasks = [
+                asyncio.create_task(async_sync_loop(kbd1, kbd2)),
+                asyncio.create_task(async_sync_loop(kbd2, kbd1)),
+            ]
+        elif status == NOTIFY_STATUS_WAIT:
+            logger.debug("Keyboard Disconnected!")
+            close_async_boards(kbds, tasks)
+            kbds = []
+            tasks = []
+        elif status == NOTIFY_STATUS_STOP:
+            if not kbds:
                 logger.info(
                     "Could not find devices. Make sure you've setup udev rules!"
                 )
-                return
+            close_async_boards(kbds, tasks)
+            return
 
-            # NOTE: Same as the NOTIFY_STATUS_WAIT case above. However,
-            # here we want to return from the loop.
-            kill_and_join_threads(kbd1, kbd2, threads)
 
-            kbd1 = None
-            kbd2 = None
+# NOTE: Created by sync() so importing this module doesn't need libusb.
+monitor = None
+device_thread = None
 
-            return
 
+def dump_pipeline_stats():
+    if stats_file:
+        pipeline_stats.dump(stats_file)
+    else:
+        pipeline_stats.log(logger)
 
-monitor = USBConnectionMonitorRunner(VENDOR_ID, PRODUCT_ID)
-device_thread = threading.Thread(
-    target=device_init_thread, args=(monitor,), daemon=True)
+
+def sync_stats_handler(signal, frame):
+    dump_pipeline_stats()
 
 
 def sync_terminate_handler(signal, frame):
     monitor.stop()
-    device_thread.join()
+    if device_thread:
+        device_thread.join()
     monitor.join()
 
 
-def sync():
+def start_control_server():
+    global control_server
+
+    server = ControlServer(CONTROL_HANDLERS)
+    try:
+        server.start()
+    except (ControlError, OSError) as ex:
+        logger.warning(f"Control socket not available: {ex}")
+        return
+    control_server = server
+    logger.info(f"Serving dumang-config on {server.path}")
+
+
+def sync(use_asyncio=False,
+         fast_path=False,
+         stats_path=None,
+         capture_path=None,
+         control=True,
+         pairs_path=None):
+    global monitor, device_thread, stats_file, capture
+
     logger.info("Staring DuMang Layer Sync...")
+    pairs = None
+    if pairs_path:
+        if use_asyncio:
+            raise click.UsageError("--pairs is not supported with --asyncio")
+        try:
+            pairs = load_pairs(pairs_path)
+        except config.ConfigError as e:
+            for error in e.errors:
+                logger.error(error)
+            raise click.ClickException(f"Invalid pairs file {pairs_path}")
+        logger.info(f"Syncing {len(pairs)} pair(s) from {pairs_path}")
+    stats_file = stats_path
+    if capture_path:
+        capture = CaptureWriter(capture_path)
+    monitor = USBConnectionMonitorRunner(
+        VENDOR_ID,
+        PRODUCT_ID,
+        max_boards=2 * len(pairs) if pairs is not None else 2,
+        serials={s for pair in pairs for s in pair.serials}
+        if pairs is not None else None)
     signal.signal(signal.SIGINT, sync_terminate_handler)
-
+    signal.signal(signal.SIGUSR1, sync_stats_handler)
     monitor.start()
-    device_thread.start()
 
-    device_thread.join()
+    if use_asyncio:
+        if control:
+            logger.info("The control socket is not served with --asyncio")
+        asyncio.run(async_device_loop(monitor))
+    else:
+        if control:
+            start_control_server()
+        device_thread = threading.Thread(
+            target=device_init_thread,
+            args=(monitor, fast_path, pairs),
+            daemon=True)
+        device_thread.start()
+        device_thread.join()
+
     monitor.join()
+    if control_server:
+        control_server.close()
+    if stats_file:
+        pipeline_stats.dump(stats_file)
+    if capture:
+        capture.close()
 
 
 @click.command(help="Enable Layer Sync between two keyboard halves")
@@ -174,7 +757,34 @@ def sync():
 @click.option(
     "--very-verbose", help="Enable Very Verbose Logging", is_flag=True)
 @click.option("--version", help="Print Version", is_flag=True)
-def cli(verbose, very_verbose, version):
+@click.option(
+    "--asyncio",
+    "use_asyncio",
+    help="Run both boards on a single asyncio event loop (Linux only)",
+    is_flag=True)
+@click.option(
+    "--fast-path",
+    help="Forward layer changes directly from the receiving board's thread",
+    is_flag=True)
+@click.option(
+    "--stats-file",
+    help="Write latency stats as JSON here, on SIGUSR1 and at exit, instead of "
+    "logging them",
+    type=click.Path(dir_okay=False))
+@click.option(
+    "--capture",
+    help="Append every HID report read and written to this file",
+    type=click.Path(dir_okay=False))
+@click.option(
+    "--no-control",
+    help="Don't serve dumang-config over the control socket",
+    is_flag=True)
+@click.option(
+    "--pairs",
+    help="Sync the pairs of boards listed in this YAML file, each on its own",
+    type=click.Path(exists=True, dir_okay=False))
+def cli(verbose, very_verbose, version, use_asyncio, fast_path, stats_file,
+        capture, no_control, pairs):
     if very_verbose:
         logging.getLogger().setLevel(logging.DEBUG)
     elif verbose:
@@ -186,7 +796,7 @@ def cli(verbose, very_verbose, version):
         click.echo(f"Report issues to: {pkginfo.url}")
         return
 
-    sync()
+    sync(use_asyncio, fast_path, stats_file, capture, not no_control, pairs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,30 @@
+import pytest
+
+from dumang_ctrl.dumang.common import *
+
+
+@pytest.fixture
+def start_board():
+    """Starts the send and receive threads of a DuMangBoard on a simulated board (or any handle and its ``serial``), stopped after the test."""
+    started = []
+
+    def start(sim, serial=None, **kwargs):
+        kbd = DuMangBoard(serial or sim.serial, sim, **kwargs)
+        threads = [
+            Job(target=kbd.send_thread, daemon=True),
+            Job(target=kbd.receive_thread, daemon=True),
+        ]
+        for t in threads:
+            t.start()
+        started.append((kbd, threads))
+        return kbd
+
+    yield start
+
+    for kbd, threads in started:
+        for t in threads:
+            t.stop()
+        kbd.kill_threads()
+        for t in threads:
+            t.join()
+        kbd.close()
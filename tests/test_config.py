@@ -0,0 +1,93 @@
+import pytest
+
+from dumang_ctrl.dumang.cache import DiscoveryCache
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.simulator import SimulatedBoard, default_dkms
+from dumang_ctrl.tools import config
+
+
+def macro_cfg(sim, dkm, steps):
+    return [{
+        config.LABEL_BOARD: {
+            config.LABEL_SERIAL: sim.serial,
+            config.LABEL_KEYS: [{
+                config.LABEL_KEY: {
+                    config.LABEL_SERIAL: f"{dkm.serial:08X}",
+                    config.LABEL_MACRO: [{
+                        config.LABEL_TYPE: "KEYDOWN",
+                        config.LABEL_KEY: key,
+                        config.LABEL_DELAY_MS: 100,
+                    } for key in steps],
+                }
+            }],
+        }
+    }]
+
+
+def reread_macro(kbd, dkm):
+    found = DKMDiscovery(kbd).run()[f"{dkm.serial:08X}"]
+    return [m.keycode.keycode for m in found.macro]
+
+
+def test_shrunk_macro_reads_back_shrunk(start_board):
+    sim = SimulatedBoard(dkms=default_dkms(1, macro_len=3))
+    dkm = sim.dkms[0]
+    kbd = start_board(sim)
+
+    plan = config.plan_config(macro_cfg(sim, dkm, ["A"]), [kbd])
+    plan.apply()
+    kbd.drain()
+
+    assert reread_macro(kbd, dkm) == [Keycode.A]
+
+
+def test_verified_shrink_is_cached_as_read_back(start_board, tmp_path):
+    sim = SimulatedBoard(dkms=default_dkms(1, macro_len=3))
+    dkm = sim.dkms[0]
+    cache = DiscoveryCache(tmp_path)
+    kbd = start_board(sim)
+    kbd.cache = cache
+
+    plan = config.plan_config(macro_cfg(sim, dkm, ["A"]), [kbd])
+    assert not any(plan.apply_verified().values())
+    assert config.store_confirmed(kbd, plan.boards[sim.serial])
+
+    cached = cache.load(kbd)[f"{dkm.serial:08X}"]
+    assert [m.keycode.keycode for m in cached.macro] == [Keycode.A]
+
+
+def key_cfg(**settings):
+    return [{
+        config.LABEL_BOARD: {
+            config.LABEL_SERIAL: "SIM0",
+            config.LABEL_KEYS: [{
+                config.LABEL_KEY: {
+                    config.LABEL_SERIAL: "10000000",
+                    **settings
+                }
+            }],
+        }
+    }]
+
+
+def config_errors(cfg):
+    with pytest.raises(config.ConfigError) as ex:
+        config.parse_config(cfg)
+    return ex.value.errors
+
+
+def test_macro_steps_that_are_not_mappings_are_config_errors():
+    cfg = key_cfg(**{config.LABEL_MACRO: ["A", [config.LABEL_KEY]]})
+    errors = config_errors(cfg)
+    assert len(errors) == 2
+    assert all("macro step" in e for e in errors)
+
+    assert config_errors(key_cfg(**{config.LABEL_MACRO: "A"}))
+
+
+def test_layers_that_are_not_strings_are_config_errors():
+    cfg = key_cfg(**{f"{config.LABEL_LAYER_PREFIX}0": "A"})
+    cfg[0][config.LABEL_BOARD][config.LABEL_KEYS][0][config.LABEL_KEY][1] = "B"
+    assert len(config_errors(cfg)) == 1
+
+    assert config_errors(key_cfg(**{f"{config.LABEL_LAYER_PREFIX}0": ["A"]}))
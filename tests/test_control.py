@@ -0,0 +1,40 @@
+import tempfile
+
+import pytest
+
+from dumang_ctrl.dumang import control
+from dumang_ctrl.dumang.control import (CONTROL_SOCKET_ENV, ControlClient,
+                                        ControlError, ControlServer)
+
+
+@pytest.fixture
+def fallback_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv(CONTROL_SOCKET_ENV, raising=False)
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    return control.fallback_socket_dir()
+
+
+def test_planted_socket_dir_is_refused(fallback_dir):
+    # NOTE: Made first by someone else, or just open to them.
+    fallback_dir.mkdir(mode=0o755)
+    fallback_dir.chmod(0o755)
+
+    with pytest.raises(ControlError):
+        ControlServer({}).start()
+    assert ControlClient.connect() is None
+
+
+def test_probe_of_a_running_daemon_is_closed(fallback_dir, monkeypatch):
+    server = ControlServer({})
+    server.start()
+    closed = []
+    close = ControlClient.close
+    monkeypatch.setattr(ControlClient, "close",
+                        lambda self: closed.append(self) or close(self))
+    try:
+        with pytest.raises(ControlError):
+            ControlServer({}).start()
+    finally:
+        server.close()
+    assert len(closed) == 1
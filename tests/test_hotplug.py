@@ -0,0 +1,32 @@
+import usb1
+
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.simulator import FakeUSBContext, FakeUSBDevice
+
+
+def test_boards_in_no_pair_leave_room_for_paired_ones():
+    context = FakeUSBContext()
+    monitor = USBConnectionMonitorRunner(VENDOR_ID,
+                                         PRODUCT_ID,
+                                         context=context,
+                                         settle_s=0,
+                                         max_boards=2,
+                                         serials={"SIM0", "SIM1"})
+    monitor.start()
+    try:
+        # NOTE: Strays first, which used to fill up max_boards.
+        devices = [
+            FakeUSBDevice(serial, address=n)
+            for n, serial in enumerate(["STRAY0", "STRAY1", "SIM0", "SIM1"])
+        ]
+        context.replay(
+            (d, usb1.HOTPLUG_EVENT_DEVICE_ARRIVED) for d in devices)
+
+        ready = [monitor.get_event() for _ in range(2)]
+    finally:
+        monitor.stop()
+        monitor.join()
+
+    assert sorted(device.serial for _, device in ready) == ["SIM0", "SIM1"]
+    assert monitor.stats["unknown"] == 2
+    assert monitor.stats["rejected"] == 0
@@ -0,0 +1,48 @@
+from dumang_ctrl.dumang import common
+from dumang_ctrl.dumang.cache import encode_dkm
+from dumang_ctrl.dumang.capture import (REPORT_SIZE, CaptureWriter,
+                                        ReplayBackend, ReplayDevice)
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.simulator import SimulatedBoard, default_dkms
+
+
+def dump(kbd):
+    return {
+        serial: encode_dkm(dkm)
+        for serial, dkm in kbd.configured_keys.items()
+    }
+
+
+def test_capture_replays_through_discovery(start_board, tmp_path,
+                                           monkeypatch):
+    path = tmp_path / "dump.cap"
+    sim = SimulatedBoard(dkms=default_dkms(8, macro_len=2))
+    writer = CaptureWriter(path)
+    kbd = start_board(sim, capture=writer.channel(sim.serial))
+    kbd.discovery_window = 1
+    captured = dump(kbd)
+    writer.close()
+
+    # NOTE: A wider window pipelines the requests in another order than
+    # they were captured in.
+    monkeypatch.setattr(common, "device_backend", ReplayBackend(path))
+    (replayed, ) = [
+        start_board(common.open_device(d["path"]), d["serial_number"])
+        for d in find_devices()
+    ]
+    replayed.discovery_window = DEFAULT_DISCOVERY_WINDOW
+
+    assert dump(replayed) == captured
+    assert replayed.handle.wait_done(5)
+    assert replayed.handle.mismatched == 0
+
+
+def test_unrequested_responses_stall_instead_of_blocking():
+    request = bytes([DKM_REPORT_REQUEST_CMD, 0x01])
+    response = bytes([DKM_REPORT_RESPONSE_CMD, 0x01, 0x02])
+    device = ReplayDevice([(0, 1, request), (1, 0, response)], stall_s=0.1)
+
+    assert device.read(REPORT_SIZE, 1000) == b""
+    assert not device.wait_done(5)
+    assert device.stalled
+    assert device.unanswered == 1
@@ -0,0 +1,78 @@
+import time
+
+from dumang_ctrl.dumang import common
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.simulator import SimulatedBoard, SimulatorBackend
+from dumang_ctrl.tools import sync
+
+
+class Device:
+    """Stands in for the monitor's DetectedDevice of a simulated board."""
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.bus = None
+        self.address = None
+        self.arrived_ns = time.monotonic_ns()
+
+
+def test_idle_watchdog_sleeps_until_a_board_goes_stale(monkeypatch):
+    sims = [SimulatedBoard(serial=f"SIM{n}") for n in range(2)]
+    monkeypatch.setattr(common, "device_backend", SimulatorBackend(sims))
+    session = sync.SyncSession(resume=ResumeDetector(lambda: 0))
+    rounds = []
+    watch = session.watch
+    monkeypatch.setattr(session, "watch", lambda: rounds.append(1) or watch())
+    for sim in sims:
+        session.arrived(Device(sim.serial))
+    session.start()
+    try:
+        time.sleep(1)
+        idle_rounds = len(rounds)
+
+        session.kbds["SIM1"].mark_stale()
+        deadline = time.monotonic() + 1
+        while session.kbds["SIM1"].stale and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not session.kbds["SIM1"].stale
+    finally:
+        session.close()
+    assert idle_rounds <= 2
+
+
+class Wakeup:
+    """Stands in for ClockSetWatcher."""
+
+    def start(self, callback):
+        self.resumed = callback
+
+    def stop(self):
+        pass
+
+
+def test_resume_reopens_a_silent_handle_right_away(monkeypatch):
+    sims = [SimulatedBoard(serial=f"SIM{n}") for n in range(2)]
+    backend = SimulatorBackend(sims)
+    monkeypatch.setattr(common, "device_backend", backend)
+    slept = [0.0]
+    wakeup = Wakeup()
+    session = sync.SyncSession(resume=ResumeDetector(lambda: slept[0]),
+                               resume_wakeup=wakeup)
+    for sim in sims:
+        session.arrived(Device(sim.serial))
+    session.start()
+    try:
+        # NOTE: Nothing fails, the old handle just never answers again.
+        sims[1].freeze()
+        resumed = SimulatedBoard(serial="SIM1")
+        backend.boards[1] = resumed
+        slept[0] += 60
+        wakeup.resumed()
+
+        deadline = time.monotonic() + 0.5
+        while (session.kbds["SIM1"].handle is not resumed and
+               time.monotonic() < deadline):
+            time.sleep(0.01)
+        assert session.kbds["SIM1"].handle is resumed
+    finally:
+        session.close()
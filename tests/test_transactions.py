@@ -0,0 +1,97 @@
+import asyncio
+
+from dumang_ctrl.dumang.aio import AsyncDuMangBoard
+from dumang_ctrl.dumang.common import *
+from dumang_ctrl.dumang.simulator import SimulatedBoard, default_dkms
+
+
+def test_discovery_with_latency_above_timeout(start_board):
+    # NOTE: Every request times out and is retried, so each gets a late
+    # response to its first attempt on top of the one it is resolved with.
+    sim = SimulatedBoard(
+        dkms=default_dkms(3, macro_len=2),
+        latency_ms=DEFAULT_REQUEST_TIMEOUT_MS * 1.2)
+    kbd = start_board(sim)
+
+    keys = kbd.configured_keys
+
+    assert len(keys) == len(sim.dkms)
+    for dkm in sim.dkms.values():
+        found = keys[f"{dkm.serial:08X}"]
+        assert [found.layer_keycodes[l].keycode
+                for l in range(MAX_LAYERS)] == dkm.layers
+        assert found.color == dkm.color
+        assert found.version == dkm.version
+        assert [(m.type.type, m.keycode.keycode, m.delay)
+                for m in found.macro] == list(dkm.macro.values())
+    assert not kbd.transactions.pending()
+
+
+def test_late_response_is_not_matched_to_next_request():
+    sent = []
+    transactions = TransactionManager(sent.append)
+    first = Transaction(DKMColorRequestPacket(DuMangKeyModule(1)),
+                        DKM_COLOR_RESPONSE_CMD, 10, 1)
+    second = Transaction(DKMColorRequestPacket(DuMangKeyModule(2)),
+                         DKM_COLOR_RESPONSE_CMD, 10, 1)
+    transactions.submit(first)
+    transactions.submit(second)
+    transactions.sending(first)
+    transactions.sent(first)
+    first.deadline = 0
+    assert transactions.expire() == [first]
+    transactions.sent(first)
+
+    response = DuMangPacket.parse(
+        bytes([DKM_COLOR_RESPONSE_CMD, 0, 0, 1, 2, 3]).ljust(64, b"\0"))
+    # NOTE: Answers the first attempt. The one to the retry is late and
+    # arrives before the second request was even written.
+    assert transactions.complete(response)
+    assert transactions.complete(response)
+    assert first.future.result() is response
+    assert not second.future.done()
+    assert sent[-1] is second
+
+
+class LosesOneColor(SimulatedBoard):
+    """Drops the first color response and nothing else."""
+
+    def _emit_locked(self, report):
+        if report[0] == DKM_COLOR_RESPONSE_CMD and not getattr(
+                self, "lost", False):
+            self.lost = True
+            return
+        super()._emit_locked(report)
+
+
+def test_lost_response_costs_one_retry(start_board):
+    sim = LosesOneColor(dkms=default_dkms(20, macro_len=0))
+    kbd = start_board(sim)
+
+    keys = kbd.configured_keys
+
+    assert sim.lost
+    for dkm in sim.dkms.values():
+        assert keys[f"{dkm.serial:08X}"].color == dkm.color
+    assert kbd.transactions.stats[DKM_COLOR_REQUEST_CMD].retries == 1
+
+
+def test_async_discovery_with_latency_above_timeout():
+    sim = SimulatedBoard(
+        dkms=default_dkms(6, macro_len=2),
+        latency_ms=DEFAULT_REQUEST_TIMEOUT_MS * 1.2)
+
+    async def discover():
+        kbd = AsyncDuMangBoard(sim.serial, sim)
+        try:
+            return await kbd.discover()
+        finally:
+            kbd.close()
+
+    keys = asyncio.run(discover())
+
+    assert len(keys) == len(sim.dkms)
+    for dkm in sim.dkms.values():
+        found = keys[f"{dkm.serial:08X}"]
+        assert found.color == dkm.color
+        assert found.version == dkm.version